@@ -5,7 +5,7 @@ import tempfile
 from django.contrib import admin
 from django.http import HttpResponse
 from django.conf import settings
-from .models import Cow, Lactation, LactationData, MultiparousFeatures, Prediction, PrimiparousFeatures, DatabaseExport
+from .models import Cow, Lactation, LactationData, MultiparousFeatures, Prediction, PrimiparousFeatures, DatabaseExport, UploadJob
 
 # Register your models here.
 admin.site.register(Cow)
@@ -14,6 +14,7 @@ admin.site.register(LactationData)
 admin.site.register(MultiparousFeatures)
 admin.site.register(PrimiparousFeatures)
 admin.site.register(Prediction)
+admin.site.register(UploadJob)
 
 @admin.register(DatabaseExport)
 class DatabaseExportAdmin(admin.ModelAdmin):
@@ -0,0 +1,128 @@
+"""Process-wide registry of the trained models and feature scalers.
+
+Each artifact is loaded once per process and reused by every upload. Before
+an artifact is handed out its file is checked with os.stat; when the
+modification time or size has changed the file is hashed, and it is only
+loaded again if the SHA-256 differs from the loaded copy. Replacing a model
+file therefore takes effect on the next upload without restarting the server
+or worker.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import joblib
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_PATHS = {
+    "primi_model": "api/ml_models/primi_svr.pkl",
+    "multi_model": "api/ml_models/multi_voting_ensemble.pkl",
+    "primi_scaler": "api/scalers/primiparous_scaler.joblib",
+    "multi_scaler": "api/scalers/multiparous_scaler.joblib",
+}
+
+
+@dataclass
+class LoadedArtifact:
+    name: str
+    path: str
+    artifact: object
+    sha256: str
+    mtime_ns: int
+    size: int
+    loaded_at: datetime
+
+    @property
+    def version(self) -> str:
+        return self.sha256[:12]
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "path": os.path.relpath(self.path, settings.BASE_DIR),
+            "version": self.version,
+            "sha256": self.sha256,
+            "modified_at": datetime.fromtimestamp(self.mtime_ns / 1e9, tz=timezone.utc),
+            "loaded_at": self.loaded_at,
+        }
+
+
+class ArtifactRegistry:
+    """Loads artifacts on first use and reloads them when their file changes.
+
+    Args:
+        paths (dict): Artifact name -> path relative to settings.BASE_DIR.
+    """
+    def __init__(self, paths: dict):
+        self.paths = paths
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str):
+        """Return the current version of an artifact, loading it if needed."""
+        return self.get_entry(name).artifact
+
+    def get_entry(self, name: str) -> LoadedArtifact:
+        if name not in self.paths:
+            raise KeyError(f"Unknown artifact '{name}', expected one of {', '.join(self.paths)}")
+
+        path = os.path.join(settings.BASE_DIR, self.paths[name])
+        stat = os.stat(path)
+        entry = self._loaded.get(name)
+        if entry is not None and (entry.mtime_ns, entry.size) == (stat.st_mtime_ns, stat.st_size):
+            return entry
+
+        with self._lock:
+            entry = self._loaded.get(name)
+            if entry is not None and (entry.mtime_ns, entry.size) == (stat.st_mtime_ns, stat.st_size):
+                return entry
+            entry = self._load(name, path, stat, entry)
+            self._loaded[name] = entry
+            return entry
+
+    def versions(self) -> list:
+        """Describe every artifact, loading any that have not been used yet."""
+        return [self.get_entry(name).as_dict() for name in self.paths]
+
+    def clear(self):
+        with self._lock:
+            self._loaded.clear()
+
+    def _load(self, name, path, stat, previous):
+        # The stat taken before reading is stored, so a file replaced while
+        # it is being read is loaded again on the next call
+        with open(path, "rb") as f:
+            data = f.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        if previous is not None and previous.sha256 == sha256:
+            # Touched but not changed, keep the loaded object
+            logger.info(f"Artifact {name} touched, version {previous.version} unchanged")
+            artifact = previous.artifact
+            loaded_at = previous.loaded_at
+        else:
+            artifact = joblib.load(io.BytesIO(data))
+            loaded_at = datetime.now(timezone.utc)
+            if previous is None:
+                logger.info(f"Loaded artifact {name} version {sha256[:12]}")
+            else:
+                logger.info(f"Reloaded artifact {name}: {previous.version} -> {sha256[:12]}")
+
+        return LoadedArtifact(
+            name=name, path=path, artifact=artifact, sha256=sha256,
+            mtime_ns=stat.st_mtime_ns, size=stat.st_size, loaded_at=loaded_at
+        )
+
+
+registry = ArtifactRegistry(ARTIFACT_PATHS)
+
+
+def get_artifact(name: str):
+    """Return a model or scaler from the process-wide registry."""
+    return registry.get(name)
@@ -0,0 +1,101 @@
+"""Bulk database writes used by the upload pipeline."""
+import io
+
+import pandas as pd
+from django.db import connection
+
+from .models import LactationData
+
+BATCH_SIZE = 5000
+
+LACTATION_DATA_COLUMNS = ["lactation_id", "dim", "date", "milk_yield"]
+
+
+def insert_lactation_data(records: pd.DataFrame):
+    """Insert daily records, leaving any (lactation, dim) already stored untouched.
+
+    Uses COPY on PostgreSQL and batched bulk_create elsewhere. Must be called
+    inside a transaction.
+
+    Args:
+        records (pd.DataFrame): One row per daily record with the columns
+            lactation_id, dim, date and milk_yield.
+    """
+    records = records[LACTATION_DATA_COLUMNS]
+    if connection.vendor == "postgresql":
+        copy_lactation_data(records)
+        return
+
+    for start in range(0, len(records), BATCH_SIZE):
+        batch = records.iloc[start:start + BATCH_SIZE]
+        LactationData.objects.bulk_create(
+            [
+                LactationData(lactation_id=lactation_id, dim=dim, date=date, milk_yield=milk_yield)
+                for lactation_id, dim, date, milk_yield in batch.itertuples(index=False)
+            ],
+            batch_size=BATCH_SIZE,
+            ignore_conflicts=True
+        )
+
+
+def copy_lactation_data(records: pd.DataFrame):
+    """COPY records into a temporary table, then insert the new ones."""
+    table = LactationData._meta.db_table
+    buffer = io.StringIO()
+    records.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS lactation_data_upload "
+            "(lactation_id bigint, dim integer, date date, milk_yield double precision) "
+            "ON COMMIT DROP"
+        )
+        copy_from(cursor, "COPY lactation_data_upload FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(
+            f"INSERT INTO {table} (lactation_id, dim, date, milk_yield) "
+            "SELECT lactation_id, dim, date, milk_yield FROM lactation_data_upload "
+            "ON CONFLICT (lactation_id, dim) DO NOTHING"
+        )
+        cursor.execute("TRUNCATE lactation_data_upload")
+
+
+def copy_from(cursor, sql: str, buffer: io.StringIO):
+    """Run a COPY ... FROM STDIN with either psycopg2 or psycopg 3."""
+    raw_cursor = cursor.cursor
+    if hasattr(raw_cursor, "copy_expert"):
+        raw_cursor.copy_expert(sql, buffer)
+    else:
+        with raw_cursor.copy(sql) as copy:
+            copy.write(buffer.getvalue())
+
+
+def upsert(model, rows: list, unique_fields: list, update_fields: list = None):
+    """Insert rows, overwriting the stored row wherever unique_fields clash.
+
+    Runs one INSERT ... ON CONFLICT DO UPDATE per batch on both PostgreSQL and
+    SQLite, so storing the results of a re-uploaded herd refreshes them
+    instead of violating the unique constraint.
+
+    Args:
+        model: The model class of the rows.
+        rows (list): Unsaved model instances.
+        unique_fields (list): Fields of the unique constraint to match on.
+        update_fields (list, optional): Fields to overwrite on a clash.
+            Defaults to every concrete field except the primary key,
+            unique_fields and fields set on creation (auto_now_add), so a
+            stored row keeps its creation time.
+    """
+    if update_fields is None:
+        update_fields = [
+            field.name for field in model._meta.concrete_fields
+            if not field.primary_key and field.name not in unique_fields
+            and not getattr(field, "auto_now_add", False)
+        ]
+    model.objects.bulk_create(
+        rows,
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=update_fields
+    )
@@ -2,6 +2,8 @@ from channels.generic.websocket import JsonWebsocketConsumer
 from asgiref.sync import async_to_sync
 import logging
 
+from .models import UploadJob
+
 logger = logging.getLogger(__name__)
 
 class ProgressConsumer(JsonWebsocketConsumer):
@@ -13,6 +15,12 @@ class ProgressConsumer(JsonWebsocketConsumer):
             logger.error("Unauthenticated WebSocket connection attempt")
             self.close()
             return
+
+        url_user_id = self.scope["url_route"]["kwargs"].get("user_id")
+        if url_user_id is not None and int(url_user_id) != user.id:
+            logger.error(f"User {user.id} tried to connect to progress for user {url_user_id}")
+            self.close()
+            return
             
         self.group_name = f"user_{user.id}_progress"
         logger.info(f"Adding user to group: {self.group_name}")
@@ -23,6 +31,20 @@ class ProgressConsumer(JsonWebsocketConsumer):
         )
         self.accept()
         logger.info("WebSocket connection accepted")
+        self.send_current_job(user)
+
+    def send_current_job(self, user):
+        """Catch a reconnecting client up on an upload that is still running."""
+        job = (UploadJob.objects
+               .filter(user=user, status__in=[UploadJob.QUEUED, UploadJob.RUNNING])
+               .order_by("-created_at")
+               .first())
+        if job is not None:
+            self.send_json({
+                "job_id": job.id,
+                "stage": job.stage,
+                "progress": f"Upload job {job.id} is {job.status} ({job.stage})"
+            })
 
     def disconnect(self, close_code):
         logger.info(f"WebSocket disconnected with code: {close_code}")
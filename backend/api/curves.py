@@ -0,0 +1,168 @@
+"""Lactation curves in columnar form, and compact binary encodings of them.
+
+A curve is one lactation with its records as parallel dim and milk_yield
+arrays, so the keys of a record are not repeated for every day. Besides
+JSON, curves are served as Apache Arrow IPC when pyarrow is installed, and
+always in the float32 binary layout written by encode_curves_binary.
+"""
+import json
+import struct
+
+import numpy as np
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from .models import LactationData
+from .processing.downsampling import lttb, series_offsets
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# Leading bytes of the binary layout, ending in its version
+CURVES_MAGIC = b"LCV1"
+
+
+def get_curves(lactations, max_points: int = None) -> list:
+    """Read the records of lactations as one curve per lactation.
+
+    Args:
+        lactations: A Lactation queryset selecting the curves.
+        max_points (int, optional): Downsample each curve to at most this
+            many points with LTTB.
+
+    Returns:
+        list: A dict per lactation, ordered by lactation id, with its
+        lactation_id, cow_id and parity, and NumPy arrays of dim and
+        milk_yield ordered by DIM.
+    """
+    records = (LactationData.objects
+               .filter(lactation__in=lactations.values("id"))
+               .order_by("lactation_id", "dim")
+               .values_list("lactation_id", "dim", "milk_yield"))
+    lactations = list(lactations.order_by("id").values_list("id", "cow__cow_id", "parity"))
+    if lactations:
+        columns = np.array(list(records), dtype=np.float64).reshape(-1, 3).T
+    else:
+        columns = np.empty((3, 0))
+    lactation_ids = columns[0].astype(np.int64)
+    dims = columns[1].astype(np.int32)
+    milk_yields = columns[2]
+    if max_points:
+        keep = lttb(series_offsets(lactation_ids), dims, milk_yields, max_points)
+        lactation_ids, dims, milk_yields = lactation_ids[keep], dims[keep], milk_yields[keep]
+
+    # Records are sorted by lactation, so each curve is one slice of the columns
+    ids = np.array([lactation_id for lactation_id, _, _ in lactations], dtype=np.int64)
+    starts = np.searchsorted(lactation_ids, ids, side="left")
+    ends = np.searchsorted(lactation_ids, ids, side="right")
+    return [
+        {
+            "lactation_id": lactation_id,
+            "cow_id": cow_id,
+            "parity": parity,
+            "dim": dims[start:end],
+            "milk_yield": milk_yields[start:end],
+        }
+        for (lactation_id, cow_id, parity), start, end in zip(lactations, starts, ends)
+    ]
+
+
+def _columns(curves: list) -> tuple:
+    lengths = [len(curve["dim"]) for curve in curves]
+    offsets = np.zeros(len(curves) + 1, dtype=np.uint32)
+    np.cumsum(lengths, out=offsets[1:])
+    dims = np.concatenate([curve["dim"] for curve in curves] or [np.empty(0)]).astype("<i4")
+    milk_yields = np.concatenate([curve["milk_yield"] for curve in curves] or [np.empty(0)]).astype("<f4")
+    return offsets, dims, milk_yields
+
+
+def encode_curves_binary(curves: list) -> bytes:
+    """Encode curves in the compact binary layout.
+
+    All numbers are little-endian:
+
+    - 4 bytes: CURVES_MAGIC
+    - uint32: length of the header in bytes
+    - header: UTF-8 JSON with the lactation_id, cow_id and parity lists of
+      the curves, padded with spaces to a multiple of 4 bytes
+    - uint32[curves + 1]: offset of the first point of each curve, and the
+      total number of points
+    - int32[points]: dim of every point
+    - float32[points]: milk_yield of every point
+
+    Every array starts on a 4 byte boundary, so a client can view it as a
+    typed array without copying.
+    """
+    header = json.dumps({
+        "lactation_id": [curve["lactation_id"] for curve in curves],
+        "cow_id": [curve["cow_id"] for curve in curves],
+        "parity": [curve["parity"] for curve in curves],
+    }, separators=(",", ":")).encode()
+    header += b" " * (-len(header) % 4)
+    offsets, dims, milk_yields = _columns(curves)
+    return b"".join([
+        CURVES_MAGIC, struct.pack("<I", len(header)), header,
+        offsets.astype("<u4").tobytes(), dims.tobytes(), milk_yields.tobytes(),
+    ])
+
+
+def encode_curves_arrow(curves: list) -> bytes:
+    """Encode curves as an Arrow IPC stream with one row per lactation."""
+    offsets, dims, milk_yields = _columns(curves)
+    offsets = pyarrow.array(offsets.astype(np.int32))
+    table = pyarrow.table({
+        "lactation_id": pyarrow.array([curve["lactation_id"] for curve in curves], pyarrow.int64()),
+        "cow_id": pyarrow.array([curve["cow_id"] for curve in curves], pyarrow.string()),
+        "parity": pyarrow.array([curve["parity"] for curve in curves], pyarrow.int32()),
+        "dim": pyarrow.ListArray.from_arrays(offsets, pyarrow.array(dims)),
+        "milk_yield": pyarrow.ListArray.from_arrays(offsets, pyarrow.array(milk_yields)),
+    })
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class _CurveRenderer(BaseRenderer):
+    charset = None
+    render_style = "binary"
+
+    def encode(self, curves: list) -> bytes:
+        raise NotImplementedError
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, list):
+            return self.encode(data)
+        # Errors are not curves, and are sent as JSON
+        response = (renderer_context or {}).get("response")
+        if response is not None:
+            response["Content-Type"] = "application/json"
+        return JSONRenderer().render(data)
+
+
+class CurveBinaryRenderer(_CurveRenderer):
+    """Renders curves in the layout of encode_curves_binary, for ?format=bin."""
+    media_type = "application/octet-stream"
+    format = "bin"
+
+    def encode(self, curves):
+        return encode_curves_binary(curves)
+
+
+class CurveArrowRenderer(_CurveRenderer):
+    """Renders curves as an Arrow IPC stream, for ?format=arrow."""
+    media_type = "application/vnd.apache.arrow.stream"
+    format = "arrow"
+
+    def encode(self, curves):
+        return encode_curves_arrow(curves)
+
+
+def curve_renderers() -> list:
+    """The renderers curves can be served with, Arrow only when pyarrow is installed."""
+    renderers = [JSONRenderer, CurveBinaryRenderer]
+    if pyarrow is not None:
+        renderers.append(CurveArrowRenderer)
+    return renderers
@@ -0,0 +1,101 @@
+"""Per-upload identity map of a user's cows and lactations."""
+from .bulk import BATCH_SIZE
+from .models import Cow, Lactation
+
+
+class LactationIdentityMap:
+    """Resolves (Cow ID, Parity) pairs to Lactation objects once per upload.
+
+    The user's cows and lactations are read the first time their cow ids are
+    seen, missing ones are bulk created, and every later lookup is answered
+    from memory so all pipeline stages share the same objects and ids.
+
+    Args:
+        user: The owner of the cows.
+    """
+    def __init__(self, user):
+        self.user = user
+        self.cows = {}
+        self.lactations = {}
+        self._loaded_cow_ids = set()
+
+    @staticmethod
+    def key(cow_id, parity) -> tuple:
+        """The (cow_id as stored, parity) key of a lactation."""
+        return str(cow_id), int(parity)
+
+    def get(self, cow_id, parity):
+        """Return the Lactation for a cow and parity, or None if it does not exist."""
+        self.load({cow_id})
+        return self.lactations.get(self.key(cow_id, parity))
+
+    def lookup(self, lactation_keys) -> dict:
+        """Find the existing lactations among (Cow ID, Parity) pairs.
+
+        Returns:
+            dict: Maps each pair, as given, to its Lactation. Pairs without a
+            stored lactation are left out.
+        """
+        lactation_keys = list(lactation_keys)
+        self.load({cow_id for cow_id, _ in lactation_keys})
+        found = {}
+        for cow_id, parity in lactation_keys:
+            lactation = self.lactations.get(self.key(cow_id, parity))
+            if lactation is not None:
+                found[(cow_id, parity)] = lactation
+        return found
+
+    def resolve(self, lactation_keys) -> dict:
+        """Get or create the Cow and Lactation rows for (Cow ID, Parity) pairs.
+
+        Returns:
+            dict: Maps (cow_id as stored, parity) to the Lactation.
+        """
+        lactation_keys = {self.key(cow_id, parity) for cow_id, parity in lactation_keys}
+        self.load({cow_id for cow_id, _ in lactation_keys})
+
+        missing_cows = {cow_id for cow_id, _ in lactation_keys} - self.cows.keys()
+        if missing_cows:
+            Cow.objects.bulk_create(
+                [Cow(cow_id=cow_id, owner=self.user) for cow_id in missing_cows],
+                batch_size=BATCH_SIZE,
+                ignore_conflicts=True
+            )
+            self.load(missing_cows, refresh=True)
+
+        missing_lactations = lactation_keys - self.lactations.keys()
+        if missing_lactations:
+            Lactation.objects.bulk_create(
+                [
+                    Lactation(
+                        cow=self.cows[cow_id], parity=parity,
+                        parity_type=Lactation.PRIMIPAROUS if parity == 1 else Lactation.MULTIPAROUS
+                    )
+                    for cow_id, parity in missing_lactations
+                ],
+                batch_size=BATCH_SIZE
+            )
+            self.load({cow_id for cow_id, _ in missing_lactations}, refresh=True)
+
+        return {key: self.lactations[key] for key in lactation_keys}
+
+    def load(self, cow_ids, refresh: bool = False):
+        """Read the cows and lactations of cow ids not loaded yet."""
+        cow_ids = {str(cow_id) for cow_id in cow_ids}
+        if not refresh:
+            cow_ids -= self._loaded_cow_ids
+        if not cow_ids:
+            return
+
+        cow_ids = sorted(cow_ids)
+        for start in range(0, len(cow_ids), BATCH_SIZE):
+            batch = cow_ids[start:start + BATCH_SIZE]
+            cows = {}
+            for cow in Cow.objects.filter(owner=self.user, cow_id__in=batch):
+                self.cows[cow.cow_id] = cows[cow.id] = cow
+            # Ordered so the oldest lactation wins if there are duplicates
+            lactations = Lactation.objects.filter(cow_id__in=cows).order_by("-id")
+            for lactation in lactations:
+                lactation.cow = cows[lactation.cow_id]
+                self.lactations[(lactation.cow.cow_id, lactation.parity)] = lactation
+        self._loaded_cow_ids.update(cow_ids)
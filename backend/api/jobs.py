@@ -0,0 +1,238 @@
+"""DB-backed queue that runs uploads outside of the web request."""
+import asyncio
+import logging
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import UploadJob
+from .pipeline import UploadPipeline
+from .progress import ProgressReporter
+from .response_cache import invalidate_user_cache
+from .versions import bump_data_version
+
+logger = logging.getLogger(__name__)
+
+_runner_lock = threading.Lock()
+_runner_thread = None
+_runner_loop = None
+_runner_wakeup = threading.Event()
+
+
+def enqueue_upload(uploaded_file) -> UploadJob:
+    """Queue an uploaded file for processing.
+
+    With UPLOAD_JOB_RUNNER set to "thread" the job is picked up by a thread in
+    this process once the transaction commits, otherwise it waits for
+    `manage.py run_upload_worker`.
+    """
+    job = UploadJob.objects.create(user=uploaded_file.user, upload_file=uploaded_file)
+    if settings.UPLOAD_JOB_RUNNER == "thread":
+        loop = server_event_loop()
+        transaction.on_commit(lambda: start_in_process_runner(loop))
+    return job
+
+
+async def _running_loop():
+    return asyncio.get_running_loop()
+
+
+def server_event_loop():
+    """Return the ASGI server's event loop when called from a view served over
+    ASGI, otherwise None.
+
+    async_to_sync runs the coroutine on the server's loop when there is one,
+    and on a new loop that has stopped by the time it returns when there is not.
+    """
+    loop = async_to_sync(_running_loop)()
+    return loop if loop.is_running() else None
+
+
+def claim_next_job():
+    """Mark the oldest queued job as running and return it.
+
+    The status check is part of the UPDATE so two workers can never claim the
+    same job. Returns None when the queue is empty.
+    """
+    while True:
+        job = UploadJob.objects.filter(status=UploadJob.QUEUED).order_by("created_at", "id").first()
+        if job is None:
+            return None
+
+        started_at = timezone.now()
+        claimed = UploadJob.objects.filter(id=job.id, status=UploadJob.QUEUED).update(
+            status=UploadJob.RUNNING, started_at=started_at, heartbeat_at=started_at
+        )
+        if claimed:
+            job.status = UploadJob.RUNNING
+            job.started_at = job.heartbeat_at = started_at
+            return job
+
+
+def fail_stale_jobs(jobs=None) -> int:
+    """Fail running jobs whose runner stopped, as after a restart of its process.
+
+    A job is stale once its last heartbeat is more than UPLOAD_JOB_STALE_AFTER
+    seconds old. Such jobs are failed rather than queued again, as the upload
+    may itself have brought the process down.
+
+    Args:
+        jobs (QuerySet, optional): The jobs to check. Defaults to all jobs.
+
+    Returns:
+        int: The number of jobs failed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.UPLOAD_JOB_STALE_AFTER)
+    jobs = UploadJob.objects.all() if jobs is None else jobs
+    stale = jobs.filter(status=UploadJob.RUNNING).filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+    )
+    failed = 0
+    for job in stale:
+        # Skipped if the runner reported back since the job was read
+        updated = UploadJob.objects.filter(
+            id=job.id, status=UploadJob.RUNNING, heartbeat_at=job.heartbeat_at
+        ).update(
+            status=UploadJob.FAILED,
+            stage="failed",
+            errors=job.errors + ["The upload was interrupted before it finished. Please upload the file again."],
+            finished_at=timezone.now()
+        )
+        if updated:
+            logger.warning(f"Failed stale upload job {job.id}, last heartbeat at {job.heartbeat_at}")
+            # The interrupted upload may have stored some of its data
+            bump_data_version(job.user_id)
+            invalidate_user_cache(job.user_id)
+            failed += 1
+    return failed
+
+
+@contextmanager
+def heartbeat(job_id: int, interval: float = None):
+    """Record the job's heartbeat every interval seconds while the block runs."""
+    interval = settings.UPLOAD_JOB_HEARTBEAT_INTERVAL if interval is None else interval
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(interval):
+                try:
+                    UploadJob.objects.filter(id=job_id).update(heartbeat_at=timezone.now())
+                except DatabaseError as e:
+                    logger.warning(f"Could not record the heartbeat of upload job {job_id}: {e}")
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"upload-job-{job_id}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_job(job: UploadJob, loop=None):
+    """Run the upload pipeline for a claimed job and record the outcome.
+
+    Args:
+        job (UploadJob): A job returned by claim_next_job.
+        loop (asyncio.AbstractEventLoop, optional): The ASGI server's event
+            loop, used to deliver progress over the in-memory channel layer.
+    """
+    logger.info(f"=== Starting upload job {job.id} for user {job.user_id} ===")
+    progress = ProgressReporter(job.user_id, job.id, loop=loop)
+    pipeline = UploadPipeline(job.user, job, progress)
+
+    try:
+        with heartbeat(job.id):
+            pipeline.run(job.upload_file.file.path)
+
+    except ValueError as e:
+        logger.error(f"Error in data processing: {str(e)}")
+        logger.error(traceback.format_exc())
+        job.errors = job.errors + [f"Error processing file: {str(e)}"]
+        job.status = UploadJob.FAILED
+
+    except Exception as e:
+        logger.error("=== Unexpected Error ===")
+        logger.error(str(e))
+        logger.error(traceback.format_exc())
+        job.errors = job.errors + [f"Unexpected error: {str(e)}"]
+        job.status = UploadJob.FAILED
+
+    else:
+        job.status = UploadJob.SUCCEEDED
+        logger.info(f"=== Upload job {job.id} complete ===")
+
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "errors", "finished_at"])
+    # Even a failed upload may have stored some of its data
+    bump_data_version(job.user_id)
+    invalidate_user_cache(job.user_id)
+    if job.status == UploadJob.FAILED:
+        progress.stage("failed", job.errors[-1])
+    return job
+
+
+def run_pending_jobs(loop=None) -> int:
+    """Fail stale jobs, then run queued jobs until the queue is empty and
+    return how many ran."""
+    close_old_connections()
+    fail_stale_jobs()
+    count = 0
+    while True:
+        close_old_connections()
+        job = claim_next_job()
+        if job is None:
+            return count
+        run_job(job, loop=loop)
+        count += 1
+
+
+def start_in_process_runner(loop=None):
+    """Drain the queue on a background thread unless one is already running.
+
+    Args:
+        loop (asyncio.AbstractEventLoop, optional): The ASGI server's event
+            loop, from server_event_loop, needed to reach websockets on the
+            in-memory channel layer.
+    """
+    global _runner_thread, _runner_loop
+
+    with _runner_lock:
+        _runner_loop = loop or _runner_loop
+        _runner_wakeup.set()
+        if _runner_thread is not None:
+            return
+        _runner_thread = threading.Thread(
+            target=_drain_queue, name="upload-job-runner", daemon=True
+        )
+        _runner_thread.start()
+
+
+def _drain_queue():
+    global _runner_thread
+
+    try:
+        while True:
+            _runner_wakeup.clear()
+            try:
+                run_pending_jobs(loop=_runner_loop)
+            except Exception:
+                logger.error(traceback.format_exc())
+            # Jobs queued after the last claim set the flag again, so only exit
+            # once nothing new has arrived.
+            with _runner_lock:
+                if not _runner_wakeup.is_set():
+                    _runner_thread = None
+                    return
+    finally:
+        close_old_connections()
@@ -0,0 +1,117 @@
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+
+from api.processing.dijkstra import DIJKSTRA_PARAMS, dijkstra, fit_dijkstra
+from api.processing.feature_construction_helpers import build_lactation_index, get_lactation
+from api.processing.multi_features import DAYS_TO_PEAK_PARAMS
+
+# The batch fit as each feature construction path calls it
+FIT_VARIANTS = {
+    "primiparous": {},
+    "multiparous": {"refit_at_lower_bound": DAYS_TO_PEAK_PARAMS},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the batched Dijkstra fit, called as by the primiparous and the "
+        "multiparous features, against lmfit and report how closely the fitted "
+        "curves agree."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+            help="Numbers of lactations to fit."
+        )
+        parser.add_argument(
+            "--file",
+            help="Cleaned data (pickle or CSV with Cow, Parity, DIM and MilkTotal) to take "
+                 "lactations from. Synthetic lactations are used by default."
+        )
+        parser.add_argument(
+            "--max-dim", type=int, default=305, help="Only fit records up to this DIM."
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        curves = self.load_curves(options, max(options["sizes"]))
+        self.stdout.write(
+            f"{'batch fit':>12} {'lactations':>10} {'lmfit (s)':>10} {'batch (s)':>10} {'speed-up':>9} "
+            f"{'305d MY diff p50':>17} {'p99':>8} {'max':>8} {'better fit: batch':>18} {'lmfit':>6}"
+        )
+        for size in options["sizes"]:
+            sample = curves[:size]
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                start = time.perf_counter()
+                reference = fit_dijkstra(sample, method="lmfit")
+                reference_time = time.perf_counter() - start
+            reference_sse = self.sum_of_squares(sample, reference)
+
+            for variant, fit_options in FIT_VARIANTS.items():
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    start = time.perf_counter()
+                    batch = fit_dijkstra(sample, **fit_options)
+                    batch_time = time.perf_counter() - start
+
+                yield_difference = np.abs(dijkstra(305, *batch.T) - dijkstra(305, *reference.T))
+                batch_sse = self.sum_of_squares(sample, batch)
+                # Count fits whose sum of squares is lower by more than the fit tolerance
+                batch_better = int(np.sum(batch_sse < reference_sse * (1 - 1e-6)))
+                reference_better = int(np.sum(reference_sse < batch_sse * (1 - 1e-6)))
+                self.stdout.write(
+                    f"{variant:>12} {len(sample):>10} {reference_time:>10.2f} {batch_time:>10.2f} "
+                    f"{reference_time / batch_time:>8.1f}x "
+                    f"{np.nanmedian(yield_difference):>17.1e} "
+                    f"{np.nanpercentile(yield_difference, 99):>8.1e} "
+                    f"{np.nanmax(yield_difference):>8.1e} {batch_better:>18} {reference_better:>6}"
+                )
+
+    def load_curves(self, options, count):
+        if options["file"] is None:
+            return self.synthetic_curves(count, options["max_dim"], options["seed"])
+
+        path = options["file"]
+        try:
+            data = pd.read_pickle(path) if path.endswith(".pkl") else pd.read_csv(path)
+            index = build_lactation_index(data)
+        except (OSError, KeyError, ValueError) as e:
+            raise CommandError(f"Could not read {path}: {e}")
+
+        curves = [get_lactation(index, *key, max_dim=options["max_dim"]) for key in index]
+        if len(curves) < count:
+            # Reuse lactations to reach the largest size
+            curves = [curves[i % len(curves)] for i in range(count)]
+        return curves[:count]
+
+    def synthetic_curves(self, count, max_dim, seed):
+        """Dijkstra curves with random parameters, normal noise and some missed days."""
+        rng = np.random.default_rng(seed)
+        specs = DIJKSTRA_PARAMS
+        params = np.column_stack([
+            rng.uniform(15, 40, count),
+            rng.uniform(0.02, 0.08, count),
+            rng.uniform(0.02, 0.08, count),
+            rng.uniform(0, specs['c']['max'], count),
+        ])
+        dim = np.arange(1, max_dim + 1, dtype=float)
+        curves = []
+        for a, b, b0, c in params:
+            kept = rng.random(len(dim)) > 0.05
+            t = dim[kept]
+            y = dijkstra(t, a, b, b0, c) + rng.normal(0, 2, len(t))
+            curves.append((t, y))
+        return curves
+
+    @staticmethod
+    def sum_of_squares(curves, params):
+        return np.array([
+            np.sum((dijkstra(t, *fit) - y) ** 2) for (t, y), fit in zip(curves, params)
+        ])
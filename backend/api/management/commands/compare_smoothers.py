@@ -0,0 +1,84 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+
+from api.processing.clean import SMOOTHERS, correct_lactations, detect_outliers, get_smoother
+from api.processing.validate import validate
+
+
+class Command(BaseCommand):
+    help = (
+        "Time each smoother on an upload file and report how well its outliers "
+        "and smoothed values agree with the LOWESS reference."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="CSV file in the upload format.")
+        parser.add_argument(
+            "--smoother", action="append", choices=list(SMOOTHERS),
+            help="Smoother to compare with LOWESS, may be repeated. Defaults to all of them."
+        )
+        parser.add_argument("--frac", type=float, default=0.1, help="Span passed to every smoother.")
+        parser.add_argument("--workers", type=int, default=1, help="Processes passed to every smoother.")
+
+    def handle(self, *args, **options):
+        try:
+            data = pd.read_csv(options["file"])
+            validated_data, _, _ = validate(data)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read {options['file']}: {e}")
+
+        lactations = correct_lactations(validated_data)
+        missing_keys = int(lactations[["Cow", "Parity"]].isna().any(axis=1).sum())
+        self.stdout.write(
+            f"{len(lactations)} records in "
+            f"{lactations.groupby(by=['Cow', 'Parity']).ngroups} lactations, "
+            f"{missing_keys} without a cow or parity, smoothed as lactations of their own"
+        )
+
+        names = ["lowess"] + [name for name in options["smoother"] or SMOOTHERS if name != "lowess"]
+        results = {}
+        for name in names:
+            start = time.perf_counter()
+            smoothed = get_smoother(name)(
+                lactations.copy(), y_column="MilkTotal", smoothed_column="SmoothedMilkTotal",
+                frac=options["frac"], workers=options["workers"]
+            )
+            elapsed = time.perf_counter() - start
+            flagged = detect_outliers(smoothed, "SmoothedMilkTotal", "MilkTotal", "my_residual")
+            results[name] = flagged
+            self.stdout.write(
+                f"{name:>16}: {elapsed:8.3f}s, {int(flagged['is_outlier'].sum())} outliers"
+            )
+
+        reference = results["lowess"]
+        for name in names[1:]:
+            # Only records smoothed by both are compared
+            common = reference.index.intersection(results[name].index)
+            self.report_agreement(
+                name, reference.loc[common], results[name].loc[common],
+                excluded=len(reference.index.union(results[name].index)) - len(common)
+            )
+
+    def report_agreement(self, name, reference, candidate, excluded=0):
+        ref_outliers = reference["is_outlier"].to_numpy()
+        outliers = candidate["is_outlier"].to_numpy()
+        both = int((ref_outliers & outliers).sum())
+        either = int((ref_outliers | outliers).sum())
+        difference = np.abs(
+            candidate["SmoothedMilkTotal"].to_numpy() - reference["SmoothedMilkTotal"].to_numpy()
+        )
+
+        self.stdout.write(f"\n{name} vs lowess")
+        self.stdout.write(f"  records compared:            {len(reference)}, {excluded} excluded")
+        self.stdout.write(f"  outliers found by both:      {both}")
+        self.stdout.write(f"  only by lowess:              {int(ref_outliers.sum()) - both}")
+        self.stdout.write(f"  only by {name}:{' ' * max(1, 20 - len(name))}{int(outliers.sum()) - both}")
+        self.stdout.write(f"  outlier agreement (Jaccard): {both / either if either else 1.0:.3f}")
+        self.stdout.write(f"  record agreement:            {(ref_outliers == outliers).mean():.4f}")
+        self.stdout.write(
+            f"  smoothed difference (kg):    mean {np.nanmean(difference):.3f}, "
+            f"p95 {np.nanpercentile(difference, 95):.3f}, max {np.nanmax(difference):.3f}"
+        )
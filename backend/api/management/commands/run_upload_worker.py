@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Process queued upload jobs, polling the database for new ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Process the jobs that are currently queued and exit."
+        )
+
+    def handle(self, *args, **options):
+        poll_interval = settings.UPLOAD_WORKER_POLL_INTERVAL
+        self.stdout.write(f"Upload worker started (polling every {poll_interval}s)")
+
+        while True:
+            count = run_pending_jobs()
+            if count:
+                self.stdout.write(f"Processed {count} upload job(s)")
+            if options["once"]:
+                return
+            time.sleep(poll_interval)
@@ -0,0 +1,35 @@
+"""Authenticate websocket connections with a simplejwt access token."""
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import User
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+@database_sync_to_async
+def get_user(user_id):
+    return User.objects.filter(id=user_id, is_active=True).first()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """Sets scope["user"] from a `?token=<access token>` query parameter.
+
+    Browsers cannot send an Authorization header when opening a websocket, so
+    the frontend passes the same access token it uses for the API. Without a
+    valid token the user set by AuthMiddlewareStack is left in place.
+    """
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get("query_string", b"").decode())
+        token = query.get("token", [None])[0]
+
+        if token:
+            try:
+                user = await get_user(AccessToken(token)["user_id"])
+            except (TokenError, KeyError):
+                user = None
+            if user is not None:
+                scope = dict(scope, user=user)
+
+        return await super().__call__(scope, receive, send)
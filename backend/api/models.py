@@ -8,8 +8,44 @@ class UploadFile(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     file = models.FileField(upload_to=user_directory_path)   # Store files in a folder called uploads
     upload_time = models.DateTimeField(auto_now_add=True)
+
+
+class UploadJob(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed")
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    upload_file = models.ForeignKey(UploadFile, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    stage = models.CharField(max_length=20, default=QUEUED)  # Pipeline stage currently running
+    rows_total = models.IntegerField(default=0)  # Rows in the uploaded file
+    rows_processed = models.IntegerField(default=0)  # Rows stored so far
+    lactations_total = models.IntegerField(default=0)  # Eligible lactations
+    lactations_processed = models.IntegerField(default=0)  # Lactations predicted so far
+    messages = models.JSONField(default=list)
+    errors = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Last time the runner reported the job alive
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    def __str__(self):
+        return f"Upload job {self.id} ({self.status})"
     
 
+
 class Cow(models.Model):
     cow_id = models.CharField(max_length=20)
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -151,11 +187,25 @@ class Prediction(models.Model):
 
     class Meta:
         unique_together = ("lactation", "prediction_type")
+        indexes = [
+            # Keyset pagination of the predictions list
+            models.Index(fields=["created_at", "id"], name="prediction_created_id_idx"),
+        ]
 
     def __str__(self):
         return f"Prediction for {self.lactation.cow.cow_id} - Parity {self.lactation.parity}"
     
 
+class DataVersion(models.Model):
+    """Counter bumped whenever a user's cows, lactations or predictions change."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="data_version")
+    version = models.BigIntegerField()
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Data version {self.version} of {self.user}"
+
+
 class DatabaseExport(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,446 @@
+"""Run an uploaded herd file through validation, cleaning, storage, feature
+construction and prediction."""
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg
+import numpy as np
+import pandas as pd
+
+from .artifacts import get_artifact
+from .bulk import BATCH_SIZE, insert_lactation_data, upsert
+from .identity_map import LactationIdentityMap
+from .plots import prerender_plots
+from .models import Lactation, LactationData, MultiparousFeatures, Prediction, PrimiparousFeatures
+from .processing.validate import validate
+from .processing.clean import clean
+from .processing.multi_features import multi_feature_construction
+from .processing.primi_features import primi_feature_construction
+from .processing.extrapolation import PERSISTENCY_WINDOW, approximate_persistency, extrapolate
+from .processing.feature_construction_helpers import build_lactation_index
+
+logger = logging.getLogger(__name__)
+
+MULTIPAROUS_FEATURE_LIST = [
+    'parity', 'milk_total_1_10', 'milk_total_11_20', 'milk_total_21_30',
+    'milk_total_31_40', 'milk_total_41_50', 'milk_total_51_60', 'month_sin',
+    'month_cos', 'prev_a', 'prev_305_my', 'prev_lact_length', 'prev_my_end',
+    'prev_days_to_peak', 'prev_peak_my', 'prev_persistency', 'current_a',
+    'predicted_305_my', 'current_days_to_peak', 'current_peak_my',
+    'predicted_persistency', 'my_variance', 'rate_of_my_change',
+    'prev_dijkstra_b_eqn', 'prev_dijkstra_b0_eqn', 'prev_dijkstra_c_eqn',
+    'current_dijkstra_b_eqn', 'current_dijkstra_b0_eqn', 'current_dijkstra_c_eqn'
+]
+
+PRIMIPAROUS_FEATURE_LIST = [
+    'milk_total_1_10',
+    'milk_total_11_20',
+    'milk_total_21_30',
+    'milk_total_31_40',
+    'milk_total_41_50',
+    'milk_total_51_60',
+    'month_sin',
+    'month_cos',
+    'a',
+    'my_variance',
+    'rate_of_my_change',
+    'predicted_305_my',
+    'current_dijkstra_b_eqn',
+    'current_dijkstra_b_b0_eqn',
+    'current_dijkstra_b0_eqn',
+    'current_dijkstra_c_eqn',
+]
+
+# Feature fields named differently from the constructed feature columns
+FEATURE_COLUMNS = {
+    'Parity': 'parity',
+    'MilkTotal_1-10': 'milk_total_1_10',
+    'MilkTotal_11-20': 'milk_total_11_20',
+    'MilkTotal_21-30': 'milk_total_21_30',
+    'MilkTotal_31-40': 'milk_total_31_40',
+    'MilkTotal_41-50': 'milk_total_41_50',
+    'MilkTotal_51-60': 'milk_total_51_60',
+}
+
+# Features table and model input columns, in the order the models expect
+PREDICTION_FEATURES = {
+    Lactation.MULTIPAROUS: (MultiparousFeatures, MULTIPAROUS_FEATURE_LIST),
+    Lactation.PRIMIPAROUS: (PrimiparousFeatures, PRIMIPAROUS_FEATURE_LIST),
+}
+
+# Prediction fields refreshed when a re-uploaded lactation is predicted again
+PREDICTION_UPDATE_FIELDS = [
+    'prediction_value', 'approximate_persistency',
+    *[f'extend_{cycles}_cycle' for cycles in range(1, 11)],
+    'days_to_target', 'plot_path',
+]
+
+
+class UploadPipeline:
+    """Processes one uploaded file for a user, recording progress on its job.
+
+    Args:
+        user: The user who uploaded the file.
+        job (UploadJob, optional): The job to report the stage, row counts and
+            messages to. When omitted the pipeline runs without reporting.
+        progress (ProgressReporter, optional): Streams stage and lactation
+            progress to the user's websocket.
+    """
+    def __init__(self, user, job=None, progress=None):
+        self.user = user
+        self.job = job
+        self.progress = progress
+        self.warnings = []
+        self.lactations = LactationIdentityMap(user)
+
+    def update_job(self, **fields):
+        """Save the given fields on the job, if there is one."""
+        if self.job is None:
+            return
+        for name, value in fields.items():
+            setattr(self.job, name, value)
+        self.job.save(update_fields=list(fields))
+
+    def add_messages(self, messages: list):
+        if self.job is None or not messages:
+            return
+        self.update_job(messages=self.job.messages + list(messages))
+
+    def set_stage(self, stage: str, message: str, **fields):
+        """Record the start of a stage on the job and announce it."""
+        self.add_messages(self.warnings)
+        self.warnings = []
+        self.update_job(stage=stage, **fields)
+        if self.progress is not None:
+            self.progress.stage(stage, message)
+
+    def send_progress_message(self, message: str):
+        """Stream a message to the user, keeping it for the job's messages."""
+        self.warnings.append(message)
+        if self.progress is not None:
+            self.progress.message(message)
+
+    def report_lactation(self, processed: int, total: int, message: str):
+        if self.progress is not None:
+            self.progress.lactation(processed, total, message)
+
+    def run(self, file_path: str):
+        """Run every stage of the pipeline on the CSV at file_path.
+
+        Raises:
+            ValueError: If the file fails validation or processing.
+        """
+        self.set_stage("loading", "Loading file...")
+        logger.info("Reading CSV file...")
+        data = pd.read_csv(file_path)
+        logger.info(f"CSV loaded successfully. Shape: {data.shape}")
+
+        self.set_stage("validating", "Validating data...", rows_total=len(data))
+        logger.info("Starting data validation...")
+        validated_data, eligible_lactations, validation_messages = validate(data)
+        for msg in validation_messages:
+            self.send_progress_message(msg)
+        logger.info(f"Validation complete. Messages: {validation_messages}")
+
+        self.set_stage("cleaning", "Cleaning data...")
+        logger.info("Starting data cleaning...")
+        cleaned_data, cleaning_messages = clean(
+            validated_data,
+            workers=settings.SMOOTHING_WORKERS,
+            smoother=settings.OUTLIER_SMOOTHER
+        )
+        for msg in cleaning_messages:
+            self.send_progress_message(msg)
+
+        self.set_stage(
+            "storing", "Storing lactation data...",
+            lactations_total=len(eligible_lactations)
+        )
+        logger.info("Storing lactation data...")
+        self.store_lactation_data(
+            cleaned_data, eligible_lactations, self.user
+        )
+
+        self.set_stage("features", "Creating input features...")
+        logger.info("Creating input features...")
+        input_features = self.create_input_features(
+            eligible_lactations, cleaned_data, self.user
+        )
+
+        self.set_stage("predicting", "Making predictions...")
+        logger.info("Making predictions...")
+        self.make_prediction(eligible_lactations, input_features)
+
+        self.set_stage("complete", "Processing complete!")
+
+        if settings.PRERENDER_PLOTS:
+            logger.info("Rendering extrapolation plots...")
+            prerender_plots(self.user)
+
+    def store_lactation_data(
+        self, 
+        cleaned_data: pd.DataFrame, 
+        eligible_lactations: list, 
+        user
+    ):
+        """Store lactation data for eligible cows and their current and previous lactations.
+
+        Cows and lactations are resolved through the upload's identity map,
+        which bulk creates any missing ones, then the daily records are inserted in bulk within a single
+        transaction. Records already stored for a lactation and DIM are kept.
+        
+        Args:
+            cleaned_data (pd.DataFrame): The full cleaned dataset.
+            eligible_lactations (list): List of tuples containing (Cow ID, Parity) for eligible lactations.
+            user: The user uploading the data.
+        """
+        eligible = pd.DataFrame(eligible_lactations, columns=["Cow", "Parity"])
+        lactation_keys = pd.concat(
+            [eligible, eligible.assign(Parity=eligible["Parity"] - 1)]
+        ).drop_duplicates()
+        subset = cleaned_data.merge(lactation_keys, on=["Cow", "Parity"], how="inner")
+
+        lactations_with_data = set(zip(subset["Cow"], subset["Parity"]))
+        for cow_id, parity in eligible_lactations:
+            if not {(cow_id, parity), (cow_id, parity - 1)} & lactations_with_data:
+                self.send_progress_message(
+                    f"Warning: No data found for Cow {cow_id}, Parity {parity}. Skipping..."
+                )
+
+        if subset.empty:
+            return
+
+        records = pd.DataFrame({
+            "Cow": subset["Cow"],
+            "Parity": subset["Parity"].astype(int),
+            "dim": subset["DIM"].astype(int),
+            "date": subset["Date"].dt.date,
+            "milk_yield": subset["MilkTotal"],
+        }).drop_duplicates(subset=["Cow", "Parity", "dim"])
+
+        with transaction.atomic():
+            lactations = records[["Cow", "Parity"]].drop_duplicates()
+            resolved = self.lactations.resolve(
+                zip(lactations["Cow"], lactations["Parity"])
+            )
+            lactations["lactation_id"] = [
+                resolved[self.lactations.key(cow_id, parity)].id
+                for cow_id, parity in zip(lactations["Cow"], lactations["Parity"])
+            ]
+            records = records.merge(lactations, on=["Cow", "Parity"])
+            insert_lactation_data(records)
+
+        self.update_job(rows_processed=len(records))
+        self.report_lactation(
+            len(eligible_lactations), len(eligible_lactations),
+            f"Stored {len(records)} records for {len(lactations)} lactations"
+        )
+
+    def create_input_features(self, eligible_lactations: list, cleaned_data: pd.DataFrame, user) -> dict:
+        """Construct the scaled input features of all eligible lactations.
+
+        Multiparous and primiparous features are each constructed in one call,
+        so all lactation curves of a parity group are fitted together. The
+        features are kept in memory for make_prediction, which stores them
+        once the lactations are scored.
+
+        Returns:
+            dict: Maps each parity type to a DataFrame of model inputs, indexed
+            by (Cow ID, Parity) with the columns of its feature list.
+        """
+        lactation_index = build_lactation_index(cleaned_data)
+        lactation_keys = pd.MultiIndex.from_frame(cleaned_data[['Cow', 'Parity']])
+        multi_lactations = [(cow_id, parity) for cow_id, parity in eligible_lactations if parity > 1]
+        primi_lactations = [(cow_id, parity) for cow_id, parity in eligible_lactations if parity == 1]
+
+        self.send_progress_message(f"Fitting lactation curves for {len(eligible_lactations)} lactations...")
+        multi_features = pd.DataFrame()
+        if multi_lactations:
+            multi_features = multi_feature_construction(
+                cleaned_data[lactation_keys.isin(multi_lactations)],
+                cleaned_data[lactation_keys.isin([(cow_id, parity - 1) for cow_id, parity in multi_lactations])],
+                lactation_index
+            )
+        primi_features = pd.DataFrame()
+        if primi_lactations:
+            primi_features = primi_feature_construction(
+                cleaned_data[lactation_keys.isin(primi_lactations)], lactation_index
+            )
+
+        input_features = {
+            Lactation.MULTIPAROUS: self.model_inputs(multi_features, MULTIPAROUS_FEATURE_LIST),
+            Lactation.PRIMIPAROUS: self.model_inputs(primi_features, PRIMIPAROUS_FEATURE_LIST),
+        }
+
+        total = len(eligible_lactations)
+        for lactations_processed, (cow_id, parity) in enumerate(eligible_lactations, start=1):
+            features = input_features[Lactation.MULTIPAROUS if parity > 1 else Lactation.PRIMIPAROUS]
+            if (cow_id, parity) not in lactation_index:
+                self.send_progress_message(
+                    f"No data for current lactation of Cow {cow_id}, Parity {parity}. Skipping..."
+                )
+            elif (cow_id, parity) not in features.index:
+                self.send_progress_message(
+                    f"Error creating features for Cow {cow_id} and Parity {parity}. Skipping..."
+                )
+            self.report_lactation(
+                lactations_processed, total,
+                f"Fitted lactation curves for {lactations_processed} of {total} lactations"
+            )
+
+        return input_features
+
+    @staticmethod
+    def model_inputs(features: pd.DataFrame, feature_list: list) -> pd.DataFrame:
+        """Select the model input columns, named as their feature fields.
+
+        Lactations with missing or infinite features can be neither scored nor
+        stored, so they are dropped.
+        """
+        if features.empty:
+            return pd.DataFrame(columns=feature_list, dtype=float)
+        inputs = features.rename(columns=FEATURE_COLUMNS)[feature_list].astype(float)
+        return inputs[np.isfinite(inputs.to_numpy()).all(axis=1)]
+
+    def store_features(self, parity_type, lactations: list, features: pd.DataFrame):
+        """
+        Store the input features of scored lactations, overwriting any stored
+        by an earlier upload.
+
+        Args:
+            parity_type: Lactation.PRIMIPAROUS or Lactation.MULTIPAROUS.
+            lactations (list): The Lactation of each row of features.
+            features (pd.DataFrame): The model inputs returned by
+                create_input_features.
+        """
+        model, feature_list = PREDICTION_FEATURES[parity_type]
+        rows = [
+            model(lactation=lactation, **dict(zip(feature_list, values)))
+            for lactation, values in zip(lactations, features[feature_list].itertuples(index=False))
+        ]
+        upsert(model, rows, unique_fields=["lactation"], update_fields=feature_list)
+        logger.info(f"Stored {model.__name__} for {len(rows)} lactations")
+
+    def load_model(self, parity_type):
+        if parity_type == Lactation.PRIMIPAROUS:
+            return get_artifact("primi_model")
+        elif parity_type == Lactation.MULTIPAROUS:
+            return get_artifact("multi_model")
+        else:
+            raise ValueError(
+                f"load_models got an unexpected parity type: {parity_type}"
+                )
+
+    def build_prediction(self, lactation, prediction, persistency, extend_cycles, days_to_target) -> Prediction:
+        """
+        Build an unsaved Prediction for a lactation.
+
+        Args:
+            lactation: The Lactation object for which the prediction is made.
+            prediction: The predicted value.
+            persistency: The approximate persistency.
+            extend_cycles: Milk yield after extending by 1 to 10 cycles.
+            days_to_target: DIM at which the target yield is reached.
+        """
+        return Prediction(
+            lactation=lactation,
+            prediction_type='regression',
+            prediction_value=float(prediction),
+            approximate_persistency=float(persistency),
+            **{
+                f"extend_{cycles}_cycle": float(milk_yield)
+                for cycles, milk_yield in enumerate(extend_cycles, start=1)
+            },
+            days_to_target=int(days_to_target),
+            plot_path="",
+        )
+
+    def make_prediction(self, eligible_lactations, input_features: dict):
+        """
+        Predict all eligible lactations and store the results.
+
+        The features of each parity type are scored with a single predict call
+        per model and extrapolated for the whole group at once. The
+        predictions are then written in batches, followed by the features
+        themselves.
+
+        Args:
+            eligible_lactations: List of (Cow ID, Parity) tuples for eligible lactations.
+            input_features (dict): The model inputs returned by create_input_features.
+        """
+        total = len(eligible_lactations)
+        lactations = self.lactations.lookup(eligible_lactations)
+        for cow_id, parity in eligible_lactations:
+            if (cow_id, parity) not in lactations:
+                message = f"Lactation for Cow {cow_id}, Parity {parity} not found. Skipping..."
+                logger.warning(message)
+                self.send_progress_message(message)
+
+        scored = {
+            parity_type: features[[key in lactations for key in features.index]]
+            for parity_type, features in input_features.items()
+        }
+        lactations_processed = total - sum(len(features) for features in scored.values())
+        for parity_type, features in scored.items():
+            if features.empty:
+                continue
+
+            group = [lactations[key] for key in features.index]
+            model = self.load_model(parity_type)
+            values = model.predict(features.to_numpy())
+
+            persistency = approximate_persistency(values, self.get_last_milk_yields(group))
+            extrapolations = extrapolate(values, persistency)
+
+            predictions = []
+            for i, lactation in enumerate(group):
+                lactations_processed += 1
+                if np.isnan(persistency[i]):
+                    self.send_progress_message(
+                        f"No lactation data found for Cow {lactation.cow.cow_id}, "
+                        f"Parity {lactation.parity}. Skipping..."
+                    )
+                    continue
+                predictions.append(self.build_prediction(
+                    lactation, values[i], persistency[i],
+                    extrapolations["extend_cycles"][i], extrapolations["days_to_target"][i]
+                ))
+                self.report_lactation(
+                    lactations_processed, total,
+                    f"Made predictions for {lactations_processed} of {total} lactations"
+                )
+            upsert(
+                Prediction, predictions,
+                unique_fields=["lactation", "prediction_type"], update_fields=PREDICTION_UPDATE_FIELDS
+            )
+            self.update_job(lactations_processed=lactations_processed)
+
+            self.store_features(parity_type, group, features)
+
+        self.update_job(lactations_processed=total)
+        self.report_lactation(
+            total, total, f"Made predictions for {total} of {total} lactations"
+        )
+
+    def get_last_milk_yields(self, lactations: list) -> np.ndarray:
+        """Average milk yield of DIM 56-60 of each lactation, NaN where there is none.
+
+        The averages are computed by the database in one grouped query per
+        batch of lactations.
+        """
+        first_dim, last_dim = PERSISTENCY_WINDOW
+        lactation_ids = [lactation.id for lactation in lactations]
+        averages = {}
+        for start in range(0, len(lactation_ids), BATCH_SIZE):
+            averages.update(
+                LactationData.objects
+                .filter(
+                    lactation_id__in=lactation_ids[start:start + BATCH_SIZE],
+                    dim__gte=first_dim, dim__lte=last_dim
+                )
+                .values("lactation_id")
+                .annotate(avg_yield=Avg("milk_yield"))
+                .values_list("lactation_id", "avg_yield")
+            )
+        return np.array([averages.get(lactation_id, np.nan) for lactation_id in lactation_ids], dtype=float)
@@ -0,0 +1,207 @@
+"""Render extrapolation plots on demand and cache them under MEDIA_ROOT.
+
+A plot is drawn the first time it is requested and written to
+extrapolation_plots/user_<id>/. Its file name carries the version of the
+prediction it shows, so re-scoring a lactation makes the next request draw
+a new plot, and the version doubles as the HTTP ETag.
+"""
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from matplotlib.figure import Figure
+
+from .models import LactationData, Prediction
+from .processing.extrapolation import PERSISTENCY_START_DIM, TARGET_YIELD
+
+logger = logging.getLogger(__name__)
+
+# Bump when the drawing changes, so cached plots are drawn again
+PLOT_STYLE = 1
+
+
+def plot_version(prediction: Prediction) -> str:
+    """Version of a prediction's plot, changing whenever the prediction is re-scored."""
+    key = (
+        f"{PLOT_STYLE}:{prediction.lactation_id}:{prediction.created_at.isoformat()}:"
+        f"{prediction.prediction_value!r}:{prediction.approximate_persistency!r}:"
+        f"{prediction.days_to_target}"
+    )
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def plot_directory(user_id: int) -> str:
+    return f"extrapolation_plots/user_{user_id}"
+
+
+def plot_relative_path(prediction: Prediction, user_id: int, version: str = None) -> str:
+    version = version or plot_version(prediction)
+    return os.path.join(plot_directory(user_id), f"lactation_{prediction.lactation_id}_{version}.png")
+
+
+def get_plot(prediction: Prediction, user_id: int, figure: Figure = None) -> str:
+    """Return the absolute path of a prediction's plot, drawing it if it is not cached.
+
+    Args:
+        prediction (Prediction): The prediction, with its lactation and cow.
+        user_id (int): The owner of the prediction.
+        figure (Figure, optional): A figure to draw on, reused between calls.
+
+    Returns:
+        str: Path to the PNG file.
+    """
+    relative_path = plot_relative_path(prediction, user_id)
+    path = os.path.join(settings.MEDIA_ROOT, relative_path)
+    if os.path.exists(path):
+        return path
+
+    records = get_plot_data([prediction.lactation_id])[prediction.lactation_id]
+    dims, milk_yields = zip(*records) if records else ((), ())
+    save_plot(prediction, dims, milk_yields, path, figure)
+    Prediction.objects.filter(pk=prediction.pk).update(plot_path=relative_path)
+    return path
+
+
+def get_plot_data(lactation_ids: list) -> dict:
+    """Milk yield of the first 60 DIM of each lactation, as (dim, milk_yield) pairs."""
+    data = {lactation_id: [] for lactation_id in lactation_ids}
+    rows = (LactationData.objects
+            .filter(lactation_id__in=lactation_ids, dim__lte=PERSISTENCY_START_DIM)
+            .order_by("lactation_id", "dim")
+            .values_list("lactation_id", "dim", "milk_yield"))
+    for lactation_id, dim, milk_yield in rows:
+        data[lactation_id].append((dim, milk_yield))
+    return data
+
+
+def save_plot(prediction: Prediction, dims, milk_yields, path: str, figure: Figure = None):
+    """Draw a prediction's plot and write it to path, replacing older versions."""
+    figure = figure or Figure(figsize=(10, 6))
+    draw_extrapolation(
+        figure, dims, milk_yields,
+        predicted_305_my=prediction.prediction_value,
+        approx_persistency=prediction.approximate_persistency,
+        days_to_target=prediction.days_to_target,
+        cow_id=prediction.lactation.cow.cow_id,
+        parity=prediction.lactation.parity
+    )
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Written to a temporary file first, so a concurrent request never
+    # serves a partly written plot
+    handle, temporary_path = tempfile.mkstemp(suffix=".png", dir=directory)
+    try:
+        with os.fdopen(handle, "wb") as f:
+            figure.savefig(f, format="png")
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+    for stale in glob.glob(os.path.join(directory, f"lactation_{prediction.lactation_id}_*.png")):
+        if stale != path:
+            os.remove(stale)
+
+
+def draw_extrapolation(
+    figure: Figure,
+    dims,
+    milk_yields,
+    predicted_305_my: float,
+    approx_persistency: float,
+    days_to_target: float,
+    cow_id: str,
+    parity: int,
+    last_dim: int = PERSISTENCY_START_DIM,
+    target_yield: float = TARGET_YIELD
+):
+    """
+    Draws Milk Yield vs DIM, along with predictions, on a cleared figure.
+
+    Args:
+        figure (Figure): The figure to draw on.
+        dims (list): DIM of the records of the first 60 DIM.
+        milk_yields (list): Milk yield of the same records.
+        predicted_305_my (float): Predicted milk yield at day 305.
+        approx_persistency (float): The approximate persistency.
+        days_to_target (float): The DIM at which milk yield is expected to reach the target.
+        cow_id (str): The cow ID.
+        parity (int): The lactation parity.
+        last_dim (int): The DIM the persistency line starts from. Default is 60
+        target_yield (float): The target milk yield. Default is 25 kg/d
+    """
+    figure.clear()
+    ax = figure.add_subplot()
+    ax.plot(dims, milk_yields, label="Milk Yield (first 60 DIM)", marker='o')
+
+    # Vertical lines at DIM 60 and 305
+    ax.axvline(x=60, color='blue', linestyle='--', label='DIM 60')
+    ax.axvline(x=305, color='orange', linestyle='--', label='DIM 305')
+
+    # Predicted day 305 MY
+    ax.scatter([305], [predicted_305_my], color='red', label=f"Predicted 305 MY: {predicted_305_my:.2f} kg", zorder=5)
+
+    if milk_yields:
+        # Dashed line for persistency, annotated with its slope
+        ax.plot([last_dim, 305], [milk_yields[-1], predicted_305_my], 'r--', label=f"Persistency (from DIM {last_dim})")
+        mid_dim = (last_dim + 305) / 2
+        mid_milk_yield = (milk_yields[-1] + predicted_305_my) / 2
+        ax.text(mid_dim, mid_milk_yield, f"Slope: {approx_persistency:.2f}", color='red', fontsize=10)
+
+    # Days to target
+    ax.scatter(
+        [days_to_target], [target_yield], color='green',
+        label=f"Days to {target_yield:g} kg/d: {days_to_target:.0f} DIM", zorder=5
+    )
+
+    ax.set_xlabel("DIM (Days In Milk)")
+    ax.set_ylabel("Milk Yield (kg/d)")
+    ax.set_title(f"Milk Yield and Persistency Extrapolation for Cow {cow_id}, Parity {parity}")
+    ax.legend(loc="upper right")
+    figure.tight_layout()
+
+
+def prerender_plots(user, lactation_ids: list = None) -> int:
+    """Draw the plots of a user's predictions that are not cached yet.
+
+    One figure is reused for every plot and the records of each batch of
+    lactations are read in one query.
+
+    Args:
+        user: The owner of the predictions.
+        lactation_ids (list, optional): Only render these lactations.
+
+    Returns:
+        int: The number of plots drawn.
+    """
+    predictions = (Prediction.objects
+                   .filter(lactation__cow__owner=user)
+                   .select_related("lactation__cow")
+                   .order_by("lactation_id"))
+    if lactation_ids is not None:
+        predictions = predictions.filter(lactation_id__in=lactation_ids)
+
+    figure = Figure(figsize=(10, 6))
+    missing = []
+    for prediction in predictions:
+        relative_path = plot_relative_path(prediction, user.id)
+        if not os.path.exists(os.path.join(settings.MEDIA_ROOT, relative_path)):
+            missing.append((prediction, relative_path))
+
+    batch_size = 500
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        plot_data = get_plot_data([prediction.lactation_id for prediction, _ in batch])
+        for prediction, relative_path in batch:
+            records = plot_data[prediction.lactation_id]
+            dims, milk_yields = zip(*records) if records else ((), ())
+            save_plot(prediction, dims, milk_yields, os.path.join(settings.MEDIA_ROOT, relative_path), figure)
+            prediction.plot_path = relative_path
+        Prediction.objects.bulk_update([prediction for prediction, _ in batch], ["plot_path"])
+
+    logger.info(f"Rendered {len(missing)} extrapolation plots for user {user.id}")
+    return len(missing)
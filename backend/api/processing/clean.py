@@ -2,39 +2,40 @@
 import os
 from typing import Union
 
+import joblib
 import numpy as np
 import pandas as pd
 import statsmodels.api as sm
 
 
-def clean(df: pd.DataFrame) -> pd.DataFrame:
+def clean(df: pd.DataFrame, workers: int = 1, smoother: str = "lowess") -> pd.DataFrame:
+    """
+    Args:
+        df (pd.DataFrame): The validated data
+        workers (int): Number of processes used to smooth lactations. 1 runs 
+            in this process, -1 uses every CPU. Default is 1
+        smoother (str): Name of the smoother in SMOOTHERS used to find milk 
+            yield outliers. Default is "lowess"
+
+    Returns:
+        pd.DataFrame: The cleaned data
+        list: Messages describing the cleaning
+    """
     messages = []
     data_grouped = df.groupby(by=["Cow", "Parity"])
     messages.append(f"Detected {data_grouped.ngroups} unique lacations")
 
-    # Correct parity
-    parity_corrected_data = parity_correction(df)
-    
-    # Correct DIM
-    cow_parity_groups = parity_corrected_data.groupby(by=["Cow", "Parity"])
-    corrected_DIM = (cow_parity_groups
-                    .apply(correct_dim, include_groups=False)
-                    .reset_index(level=[0, 1])
-                    .drop(columns='DIM')
-                    .rename(columns={'corrected_DIM': 'DIM'})
-                    )
-    
+    corrected_DIM = correct_lactations(df)
+
     # Outlier Removal (LOESS)
-    lactations = corrected_DIM.groupby(by=["Cow", "Parity"])
-    lactations_smoothed = lactations.apply(
-        lambda group: smooth_impute_plot(
-            group,
-            y_column="MilkTotal",
-            smoothed_column="SmoothedMilkTotal",
-            frac=0.1,
-            output_folder="./milk_loess"
-        ), include_groups=False
-    ).reset_index(level=[0, 1])
+    smooth = get_smoother(smoother)
+    lactations_smoothed = smooth(
+        corrected_DIM,
+        y_column="MilkTotal",
+        smoothed_column="SmoothedMilkTotal",
+        frac=0.1,
+        workers=workers
+    )
 
     lactations_smoothed_outliers = detect_outliers(lactations_smoothed,
                                                     "SmoothedMilkTotal",
@@ -49,128 +50,86 @@ def clean(df: pd.DataFrame) -> pd.DataFrame:
     return lactations_smoothed, messages
 
 
-def find_gaps_and_calving_dates(
-    group: pd.DataFrame, 
-    date_col: str = "Date"
-) -> list:
+def correct_lactations(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Identifies potential calving dates in a DataFrame by examining gaps in 
-    milking data. It calculates the days between consecutive milking records and
-    considers a gap of 15 or more days as an indicator of a new calving event. 
-    The function returns these dates sorted in chronological order.
-
+    Corrects parity, then DIM, for the whole herd.
 
     Args:
-        group (pd.DataFrame): The data for one cow to check, must have a date column
-        date_col (str): The name of the date column. Default is "Date"
+        df (pd.DataFrame): The validated data
 
     Returns:
-        list of datetime.date: A list of dates sorted in chronological order that potentially indicate new calving events.
+        pd.DataFrame: The data grouped by lactation with corrected parity and DIM
     """
-    df = group.copy()
-    df["days_since_last_milking"] = df[date_col].diff().dt.days
-    filtered_rows = df[df["days_since_last_milking"] >= 15]
-    new_calving_dates = filtered_rows[date_col].dt.strftime("%Y-%m-%d")
-    return pd.to_datetime(new_calving_dates).sort_values().to_list()
-
+    # Correct parity
+    parity_corrected_data = parity_correction(df)
+    
+    # Correct DIM
+    cow_parity_groups = parity_corrected_data.groupby(by=["Cow", "Parity"])
+    return (cow_parity_groups
+            .apply(correct_dim, include_groups=False)
+            .reset_index(level=[0, 1])
+            .drop(columns='DIM')
+            .rename(columns={'corrected_DIM': 'DIM'})
+            )
 
-def filter_dataframe_by_dates(
-    group: pd.DataFrame, 
-    list_of_dates: list,
-    date_col: str = "Date"
-) -> dict:
-    """
-    This function creates intervals based on a list of dates to partition the 
-    DataFrame. Each resulting subset contains data falling into one of these 
-    intervals: before the first date, between consecutive dates, and after the 
-    last date.
 
-    Args:
-        group (pd.DataFrame): The data for one cow, must contain date column
-        list_of_dates (list): A list of dates that define the boundaries for filtering the DataFrame. 
-        date_col
-        
-    Returns:
-        dict of pd.DataFrame: A dictionary where each key corresponds to a subset and its value is a DataFrame for that interval.
-    """
-    if not list_of_dates:
-        return {"lactation": group}
-
-    list_of_dates = pd.to_datetime(list_of_dates)
-    list_of_dates = sorted(list_of_dates)
-    # Initialize mask with before the first date
-    masks = [(group[date_col] < list_of_dates[0])]
-    # Update masks for between dates if there is more than one date
-    if len(list_of_dates) > 1:
-        masks.extend(((group[date_col] >= list_of_dates[i]) & 
-                      (group[date_col] < list_of_dates[i + 1])).tolist() 
-                      for i in range(len(list_of_dates) - 1)
-                      )
-    # Update masks for after the last date
-    masks.append((group[date_col] >= list_of_dates[-1]).tolist())
-    result_dict = {}
-    for i, mask in enumerate(masks):
-        result_dict[f"lactation_{i + 1}"] = group[mask]
-    return result_dict
-
-
-def correct_lact_n(filtered_lactations: dict, 
-                   dim_col: str = "DIM",
-                   parity_col: str = "Parity"
-) -> dict:
+def parity_correction(
+    df: pd.DataFrame,
+    cow_col: str = "Cow",
+    date_col: str = "Date",
+    dim_col: str = "DIM",
+    parity_col: str = "Parity"
+) -> pd.DataFrame:
     """
-    Corrects the parity numbers for each subset of lactations in a dictionary of dataframes based on
-    Days in Milk (DIM) criteria. It applies corrections by assigning the most frequent parity number observed
-    within the valid DIM range (10 to 300 days) to all entries in the subset. If no entries fall within this range,
-    the function uses the last corrected parity or increments it if it was the last in sequence.
+    Corrects the parity numbers for the whole herd. Each cow's records are 
+    split into lactations wherever there is a gap of 15 or more days between 
+    consecutive milkings, which indicates a new calving event. Every record in 
+    a lactation is assigned the most frequent parity observed within the valid 
+    DIM range (10 to 300 days). Lactations with no records in this range get 
+    the last corrected parity of the same cow plus one, or keep their own 
+    parity if there is no earlier corrected lactation.
 
     Args:
-        filtered_lactations (dict of pd.DataFrame): A dictionary where each key is a subset identifier and each value is
-        a dataframe containing lactation records, including 'DIM' and 'Parity' columns.
+        df (pd.DataFrame): The herd data, must contain cow, date, DIM and parity columns
+        cow_col (str): The name of the cow column. Default is "Cow"
+        date_col (str): The name of the date column. Default is "Date"
+        dim_col (str): The name of the days in milk column. Default is "DIM"
+        parity_col (str): The name of the parity column. Default is "Parity"
 
     Returns:
-        dict of pd.DataFrame: The modified dictionary with corrected parity numbers in each dataframe.
+        pd.DataFrame: The data sorted by cow and date, with the corrected parity 
+        as the last column.
     """
-    last_corrected_lact_n = None
-
-    for key, subset in filtered_lactations.items():
-        df = subset.copy()
-        if df.empty:
-            continue
-
-        relevant_rows = df[(df[dim_col] > 10) & (df[dim_col] < 300)]
-        
-        if not relevant_rows.empty:
-            mode_lact_n = relevant_rows[parity_col].mode().iloc[0]
-            last_corrected_lact_n = mode_lact_n
-            df['Corrected_Parity'] = mode_lact_n
-        else:
-            if last_corrected_lact_n is not None:
-                df['Corrected_Parity'] = last_corrected_lact_n + 1
-            else:
-                df['Corrected_Parity'] = df[parity_col]
-
-        filtered_lactations[key] = df
-    return filtered_lactations
+    data = df[df[cow_col].notna()].sort_values(by=[cow_col, date_col]).reset_index(drop=True)
+
+    # Number each lactation, starting a new one for each cow and at each gap
+    days_since_last_milking = data.groupby(cow_col)[date_col].diff().dt.days
+    new_cow = data[cow_col].ne(data[cow_col].shift())
+    segment = (new_cow | (days_since_last_milking >= 15)).cumsum()
+
+    # Most frequent parity within 10-300 DIM, ties go to the lowest parity
+    relevant_rows = (data[dim_col] > 10) & (data[dim_col] < 300)
+    parity_counts = (
+        pd.DataFrame({"segment": segment[relevant_rows], "parity": data.loc[relevant_rows, parity_col]})
+        .groupby(["segment", "parity"])
+        .size()
+        .reset_index(name="count")
+        .sort_values(["segment", "count", "parity"], ascending=[True, False, True])
+        .drop_duplicates("segment")
+    )
+    segment_cows = data[cow_col].groupby(segment).first()
+    mode_parity = parity_counts.set_index("segment")["parity"].reindex(segment_cows.index)
 
+    # Fall back to the last corrected parity of the same cow plus one
+    last_corrected_parity = mode_parity.groupby(segment_cows.to_numpy()).ffill()
+    corrected_parity = mode_parity.fillna(last_corrected_parity + 1)
 
-def parity_correction(df: pd.DataFrame) -> pd.DataFrame:
-    cow_groups = df.sort_values(by=["Cow", "Date"]).groupby("Cow")
-    parity_corrected_groups = []
+    corrected = segment.map(corrected_parity).fillna(data[parity_col])
+    if not corrected.isna().any():
+        corrected = corrected.astype(data[parity_col].dtype)
 
-    for cow_id, group in cow_groups:
-        lactation_gaps = find_gaps_and_calving_dates(group)
-        filtered_lactations = filter_dataframe_by_dates(
-            group, lactation_gaps
-            )
-        corrected_lactations = correct_lact_n(filtered_lactations)
-        corrected_group = pd.concat(corrected_lactations.values(),
-                                    ignore_index=True)
-        parity_corrected_groups.append(corrected_group)
-
-    parity_corrected_data = pd.concat(parity_corrected_groups,
-                                    ignore_index=True
-                                    ).drop(columns="Parity").rename(columns={"Corrected_Parity": "Parity"})
+    parity_corrected_data = data.drop(columns=parity_col)
+    parity_corrected_data[parity_col] = corrected
     return parity_corrected_data
 
 
@@ -246,6 +205,151 @@ def smooth_impute_plot(group: pd.DataFrame,
     return group
 
 
+def smooth_lactations(
+    df: pd.DataFrame,
+    y_column: str,
+    smoothed_column: str,
+    frac: float = 0.10,
+    workers: int = 1,
+    min_chunk_rows: int = 20000,
+    group_criteria: list = ["Cow", "Parity"]
+) -> pd.DataFrame:
+    """
+    Applies smooth_impute_plot to every lactation. With more than one worker 
+    the lactations are split into chunks of whole lactations and smoothed in 
+    a process pool. Chunks hold at least min_chunk_rows rows so that short 
+    lactations are not sent to a worker one at a time. The result is the same 
+    as smoothing serially.
+
+    Args:
+        df (pd.DataFrame): Data for all lactations.
+        y_column (str): The name of the column to smooth.
+        smoothed_column (str): The name of the column where smoothed data will be stored.
+        frac (float, optional): The fraction of the data used when estimating each y-value in the LOWESS. Defaults to 0.10.
+        workers (int, optional): Number of processes, -1 uses every CPU. Defaults to 1.
+        min_chunk_rows (int, optional): Smallest number of rows sent to a worker. Defaults to 20000.
+        group_criteria (list): Names of columns that identify a lactation
+
+    Returns:
+        pd.DataFrame: The data with smoothed and imputed values, with the 
+        group columns first.
+    """
+    workers = joblib.effective_n_jobs(workers)
+    if workers == 1 or len(df) <= min_chunk_rows:
+        return _smooth_chunk(df, y_column, smoothed_column, frac, group_criteria)
+
+    # Assign whole lactations to chunks in group order
+    group_ids = df.groupby(by=group_criteria, dropna=False).ngroup()
+    group_sizes = group_ids.value_counts(sort=False).sort_index()
+    rows_per_chunk = max(min_chunk_rows, -(-len(df) // (workers * 4)))
+    chunk_of_group = ((group_sizes.cumsum() - group_sizes) // rows_per_chunk)
+    chunk_ids = group_ids.map(chunk_of_group)
+
+    chunks = [chunk for _, chunk in df.groupby(chunk_ids, sort=True)]
+    smoothed_chunks = joblib.Parallel(n_jobs=workers)(
+        joblib.delayed(_smooth_chunk)(chunk, y_column, smoothed_column, frac, group_criteria)
+        for chunk in chunks
+    )
+    return pd.concat(smoothed_chunks)
+
+
+def _smooth_chunk(df, y_column, smoothed_column, frac, group_criteria):
+    # Rows with a missing group key form their own lactation, as in
+    # rolling_median_lactations
+    return df.groupby(by=group_criteria, dropna=False).apply(
+        lambda group: smooth_impute_plot(
+            group,
+            y_column=y_column,
+            smoothed_column=smoothed_column,
+            frac=frac,
+            output_folder="./milk_loess"
+        ), include_groups=False
+    ).reset_index(level=list(range(len(group_criteria))))
+
+
+def rolling_median_lactations(
+    df: pd.DataFrame,
+    y_column: str,
+    smoothed_column: str,
+    frac: float = 0.10,
+    workers: int = 1,
+    group_criteria: list = ["Cow", "Parity"]
+) -> pd.DataFrame:
+    """
+    A fast alternative to smooth_lactations. Every record is smoothed with the 
+    centred rolling median of its lactation, computed for the whole herd in 
+    one grouped pass. The window covers frac of the records of a typical 
+    lactation, like the LOWESS span. Missing values are imputed from the 
+    smoothed values in the same way as smooth_impute_plot.
+
+    Args:
+        df (pd.DataFrame): Data for all lactations, sorted by DIM within each lactation.
+        y_column (str): The name of the column to smooth.
+        smoothed_column (str): The name of the column where smoothed data will be stored.
+        frac (float, optional): Fraction of a typical lactation covered by the window. Defaults to 0.10.
+        workers (int, optional): Not used, accepted so all smoothers share one signature.
+        group_criteria (list): Names of columns that identify a lactation
+
+    Returns:
+        pd.DataFrame: The data with smoothed and imputed values, with the 
+        group columns first.
+    """
+    sorted_df = df.sort_values(by=group_criteria, kind="stable")
+    other_columns = [col for col in sorted_df.columns if col not in group_criteria]
+    smoothed = sorted_df[group_criteria + other_columns].copy()
+
+    # The medians are assigned by label, on a unique index so that duplicate
+    # labels in df cannot misalign them
+    index = smoothed.index
+    smoothed = smoothed.reset_index(drop=True)
+
+    # Rows with a missing group key form their own lactation instead of
+    # being dropped
+    groups = smoothed.groupby(by=group_criteria, sort=False, dropna=False)[y_column]
+    window = int(frac * groups.size().median())
+    window = max(3, window + (window % 2 == 0))
+
+    rolling_median = (groups
+                      .rolling(window, center=True, min_periods=1)
+                      .median()
+                      .droplevel(list(range(len(group_criteria))))
+                      )
+    smoothed[smoothed_column] = rolling_median.round(1)
+
+    # Like smooth_impute_plot, keep lactations with fewer than 2 values as they are
+    y_missing = smoothed[y_column].isna()
+    too_short = groups.transform("count") <= 1
+    smoothed.loc[too_short, smoothed_column] = smoothed.loc[too_short, y_column]
+    smoothed.loc[y_missing, y_column] = smoothed.loc[y_missing, smoothed_column]
+    smoothed.index = index
+    return smoothed
+
+
+SMOOTHERS = {
+    "lowess": smooth_lactations,
+    "rolling_median": rolling_median_lactations,
+}
+
+
+def get_smoother(name: str):
+    """
+    Looks up a herd smoother by name. Smoothers take the herd data, the column 
+    to smooth, the column to store the result in, frac, workers and 
+    group_criteria and return the data with the smoothed column added. 
+    "lowess" is the reference.
+
+    Args:
+        name (str): A key of SMOOTHERS
+
+    Returns:
+        callable: The smoother
+    """
+    try:
+        return SMOOTHERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown smoother '{name}', expected one of {', '.join(SMOOTHERS)}")
+
+
 def detect_outliers(df: pd.DataFrame, 
                     smoothed_column: str, 
                     original_column: str, 
@@ -0,0 +1,276 @@
+"""Fit the Dijkstra lactation curve to many lactations at once."""
+import lmfit
+import numpy as np
+
+# Starting values and bounds of the Dijkstra parameters
+DIJKSTRA_PARAMS = {
+    'a': {'value': 30, 'min': 0, 'max': 100},
+    'b': {'value': 0.01, 'min': 0.0001, 'max': 0.09},
+    'b0': {'value': 0.01, 'min': 0, 'max': 0.09},
+    'c': {'value': 0.001, 'min': 0, 'max': 0.005}
+}
+
+FIT_METHODS = ["batch", "lmfit"]
+
+
+def dijkstra(t, a, b, b0, c):
+    return a * np.exp((b * (1 - np.exp(-b0 * t)) / b0) - c * t)
+
+
+def dijkstra_jacobian(t, a, b, b0, c) -> np.ndarray:
+    """
+    Partial derivatives of the Dijkstra curve with respect to a, b, b0 and c.
+
+    Returns:
+        np.ndarray: The derivatives stacked along a new last axis
+    """
+    decay = np.exp(-b0 * t)
+    rise = (1 - decay) / b0
+    growth = np.exp(b * rise - c * t)
+    y = a * growth
+    return np.stack([
+        growth,
+        y * rise,
+        y * b * (t * decay - rise) / b0,
+        -y * t
+    ], axis=-1)
+
+
+def fit_dijkstra(
+    curves: list,
+    param_specs: dict = DIJKSTRA_PARAMS,
+    method: str = "batch",
+    batch_size: int = 1024,
+    refit_at_lower_bound: tuple = ()
+) -> np.ndarray:
+    """
+    Fits the Dijkstra curve to each lactation by bounded least squares.
+
+    The "batch" method runs Levenberg-Marquardt on a batch of lactations at a
+    time with NumPy, using the analytic Jacobian. It solves the same problem
+    as lmfit's leastsq, including lmfit's sine transform of bounded
+    parameters, so both converge to the same parameters within the fit
+    tolerance. "lmfit" fits one lactation at a time with lmfit and is kept
+    as the reference.
+
+    Args:
+        curves (list): (DIM, milk yield) array pairs, one per lactation. NaN
+            values are ignored.
+        param_specs (dict): Starting value, min and max of a, b, b0 and c.
+            Defaults to DIJKSTRA_PARAMS
+        method (str): "batch" or "lmfit". Default is "batch"
+        batch_size (int): Lactations fitted together by the batch method.
+            Default is 1024
+        refit_at_lower_bound (tuple): Names of parameters whose batch fit is
+            repeated with lmfit when it ends at the lower bound. Close to a
+            bound both methods stop at an arbitrary distance from it, so
+            features such as log(b / c) / b0 only match lmfit if those fits
+            come from lmfit. Default is ()
+
+    Returns:
+        np.ndarray: One row of a, b, b0 and c per lactation. Rows are NaN for
+        lactations with fewer records than parameters.
+    """
+    if method not in FIT_METHODS:
+        raise ValueError(f"Unknown fit method '{method}', expected one of {', '.join(FIT_METHODS)}")
+
+    results = np.full((len(curves), len(param_specs)), np.nan)
+    curves = [_drop_missing(t, y) for t, y in curves]
+    fittable = [i for i, (t, _) in enumerate(curves) if len(t) >= len(param_specs)]
+
+    if method == "lmfit":
+        for i in fittable:
+            fit = fit_model(dijkstra, param_specs, curves[i][1], curves[i][0])
+            results[i] = [fit[name] for name in param_specs]
+        return results
+
+    for batch in _batches_by_length(fittable, curves, batch_size):
+        t, y, weights = _pad([curves[i] for i in batch])
+        results[batch] = _fit_batch(t, y, weights, param_specs)
+
+    if refit_at_lower_bound:
+        names = list(param_specs)
+        columns = [names.index(name) for name in refit_at_lower_bound]
+        lower = np.array([param_specs[name]['min'] for name in refit_at_lower_bound], dtype=float)
+        upper = np.array([param_specs[name]['max'] for name in refit_at_lower_bound], dtype=float)
+        at_bound = np.any(results[:, columns] - lower < 1e-3 * (upper - lower), axis=1)
+        for i in np.flatnonzero(at_bound):
+            fit = fit_model(dijkstra, param_specs, curves[i][1], curves[i][0])
+            results[i] = [fit[name] for name in param_specs]
+    return results
+
+
+def fit_model(func, param_specs, x, t):
+    model = lmfit.Model(func)
+    params = model.make_params()
+    for param_name, specs in param_specs.items():
+        if 'min' in specs and 'max' in specs:
+            params[param_name].set(value=specs['value'], min=specs['min'], max=specs['max'])
+        else:
+            params[param_name].set(value=specs['value'])
+
+    result = model.fit(x, params, t=t, method='leastsq')
+    best_fit_params = result.params.valuesdict()
+    return best_fit_params
+
+
+def _drop_missing(t, y):
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    present = ~(np.isnan(t) | np.isnan(y))
+    return t[present], y[present]
+
+
+def _batches_by_length(indices, curves, batch_size):
+    """Group lactations of similar length so that little padding is needed."""
+    indices = sorted(indices, key=lambda i: len(curves[i][0]))
+    batch = []
+    for i in indices:
+        if batch and (
+            len(batch) == batch_size
+            or len(curves[i][0]) > 1.25 * len(curves[batch[0]][0]) + 8
+        ):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def _pad(curves):
+    length = max(len(t) for t, _ in curves)
+    t = np.zeros((len(curves), length))
+    y = np.zeros((len(curves), length))
+    weights = np.zeros((len(curves), length), dtype=bool)
+    for row, (curve_t, curve_y) in enumerate(curves):
+        t[row, :len(curve_t)] = curve_t
+        y[row, :len(curve_y)] = curve_y
+        weights[row, :len(curve_t)] = True
+    return t, y, weights
+
+
+def _fit_batch(t, y, weights, param_specs):
+    """
+    Fit a padded batch. The sine transform has no gradient at a bound, so a 
+    fit can stop next to a bound that lmfit's larger first steps would have 
+    left. Those fits are restarted just inside the bound and the better of the 
+    two results is kept.
+    """
+    lower = np.array([specs['min'] for specs in param_specs.values()], dtype=float)
+    upper = np.array([specs['max'] for specs in param_specs.values()], dtype=float)
+    initial = np.array([specs['value'] for specs in param_specs.values()], dtype=float)
+
+    params, cost = _levenberg_marquardt(
+        t, y, weights, lower, upper, np.tile(initial, (len(t), 1))
+    )
+
+    margin = 1e-3 * (upper - lower)
+    at_bound = np.any((params - lower < margin) | (upper - params < margin), axis=1)
+    rows = np.flatnonzero(at_bound)
+    if rows.size:
+        restart = np.clip(params[rows], lower + 10 * margin, upper - 10 * margin)
+        params_restart, cost_restart = _levenberg_marquardt(
+            t[rows], y[rows], weights[rows], lower, upper, restart
+        )
+        better = cost_restart < cost[rows]
+        params[rows[better]] = params_restart[better]
+    return params
+
+
+def _levenberg_marquardt(
+    t, y, weights, lower, upper, initial,
+    ftol=1.5e-8, xtol=1.5e-8, max_iter=2000
+):
+    """
+    Minimise the squared residuals of every row of t and y at once, starting 
+    from one row of initial parameters per curve. Bounded parameters are 
+    fitted as u with p = min + (sin(u) + 1) * (max - min) / 2, the transform 
+    lmfit uses, and the tolerances match lmfit's leastsq.
+    """
+    half_range = (upper - lower) / 2
+
+    def to_params(u):
+        return lower + (np.sin(u) + 1) * half_range
+
+    def residuals(rows, p):
+        model = dijkstra(t[rows], *(p[:, [k]] for k in range(p.shape[1])))
+        return np.where(weights[rows], model - y[rows], 0.0)
+
+    n_curves, n_params = initial.shape
+    all_rows = np.arange(n_curves)
+    u = np.arcsin(2 * (initial - lower) / (upper - lower) - 1)
+    p = to_params(u)
+    r = residuals(all_rows, p)
+    cost = np.einsum("ij,ij->i", r, r)
+    damping = np.full(n_curves, 1e-3)
+    scale = np.zeros((n_curves, n_params))
+    active = np.isfinite(cost) & (cost > 0)
+    identity = np.eye(n_params)
+
+    for _ in range(max_iter):
+        rows = np.flatnonzero(active)
+        if rows.size == 0:
+            break
+
+        # Jacobian with respect to the transformed parameters
+        jacobian = dijkstra_jacobian(
+            t[rows], *(p[rows][:, [k]] for k in range(n_params))
+        ) * (np.cos(u[rows]) * half_range)[:, None, :]
+        jacobian = np.where(weights[rows, :, None], jacobian, 0.0)
+        jacobian_t = jacobian.transpose(0, 2, 1)
+        normal = jacobian_t @ jacobian
+        gradient = (jacobian_t @ r[rows][:, :, None])[:, :, 0]
+
+        scale[rows] = np.maximum(scale[rows], np.diagonal(normal, axis1=1, axis2=2))
+        diag = np.maximum(scale[rows], 1e-12 * scale[rows].max(axis=1, keepdims=True) + 1e-300)
+        system = normal + damping[rows, None, None] * diag[:, None, :] * identity
+        step = -_solve(system, gradient)
+
+        u_trial = u[rows] + step
+        p_trial = to_params(u_trial)
+        r_trial = residuals(rows, p_trial)
+        cost_trial = np.einsum("ij,ij->i", r_trial, r_trial)
+
+        improved = np.isfinite(cost_trial) & (cost_trial < cost[rows])
+        actual = (cost[rows] - cost_trial) / cost[rows]
+        predicted = -(
+            2 * np.einsum("ni,ni->n", step, gradient)
+            + np.einsum("ni,nij,nj->n", step, normal, step)
+        ) / cost[rows]
+        step_norm = np.linalg.norm(step * np.sqrt(diag), axis=1)
+        u_norm = np.linalg.norm(u[rows] * np.sqrt(diag), axis=1)
+
+        accepted = rows[improved]
+        u[accepted] = u_trial[improved]
+        p[accepted] = p_trial[improved]
+        r[accepted] = r_trial[improved]
+        cost[accepted] = cost_trial[improved]
+
+        # Shrink the step when the linear model predicts the reduction badly
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(improved, actual / predicted, 0.0)
+        damping[rows] = np.select(
+            [~improved, ratio < 0.25, ratio > 0.75],
+            [damping[rows] * 10, damping[rows] * 2, np.maximum(damping[rows] / 3, 1e-15)],
+            damping[rows]
+        )
+
+        converged = (
+            (improved & (actual <= ftol) & (np.abs(predicted) <= ftol))
+            | (improved & (step_norm <= xtol * u_norm))
+            | (damping[rows] > 1e16)
+            | (cost[rows] == 0)
+        )
+        active[rows[converged]] = False
+
+    return p, cost
+
+
+def _solve(system, gradient):
+    try:
+        return np.linalg.solve(system, gradient[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.stack([
+            np.linalg.lstsq(matrix, vector, rcond=None)[0]
+            for matrix, vector in zip(system, gradient)
+        ])
@@ -0,0 +1,124 @@
+"""Downsample many lactation curves at once with Largest-Triangle-Three-Buckets."""
+import numpy as np
+
+# Rows of a stream buffered before its complete series are downsampled
+ROWS_PER_BATCH = 20000
+
+
+def series_offsets(keys) -> np.ndarray:
+    """
+    Offsets of the series in an array of series keys, sorted so that the
+    points of each series are contiguous.
+
+    Returns:
+        np.ndarray: The index of the first point of each series, followed by
+        the total number of points.
+    """
+    keys = np.asarray(keys)
+    starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    return np.concatenate(([0], starts, [len(keys)])) if len(keys) else np.zeros(1, dtype=int)
+
+
+def lttb(offsets, x, y, max_points: int) -> np.ndarray:
+    """
+    Downsample series with Largest-Triangle-Three-Buckets.
+
+    The first and last point of a series are kept. The points between them
+    are split into max_points - 2 buckets, and from each bucket the point
+    forming the largest triangle with the point kept from the previous bucket
+    and the average of the next bucket is kept, which preserves peaks and
+    troughs. Each bucket is processed for every series at once, so the
+    Python loop runs max_points times however many series there are.
+
+    Args:
+        offsets (array-like): Start of each series in x and y, followed by
+            their length, as returned by series_offsets.
+        x (array-like): X values of all series, ascending within a series.
+        y (array-like): Y values of all series.
+        max_points (int): Points kept per series, at least 3. Series with no
+            more points are kept whole.
+
+    Returns:
+        np.ndarray: Ascending indices into x and y of the points kept.
+    """
+    if max_points < 3:
+        raise ValueError("max_points must be at least 3")
+    offsets = np.asarray(offsets, dtype=np.int64)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    lengths = np.diff(offsets)
+    long = lengths > max_points
+    # Series that are too long keep their ends and one point per bucket
+    keep = ~np.repeat(long, lengths)
+    if not long.any():
+        return np.flatnonzero(keep)
+
+    starts = offsets[:-1][long]
+    lengths = lengths[long]
+    keep[starts] = True
+    keep[starts + lengths - 1] = True
+
+    # Running sums give the average of any bucket in constant time
+    x_sums = np.concatenate(([0.0], np.cumsum(x)))
+    y_sums = np.concatenate(([0.0], np.cumsum(y)))
+
+    every = (lengths - 2) / (max_points - 2)
+    previous = starts.copy()
+    rows = np.arange(len(starts))
+    for bucket in range(max_points - 2):
+        low = starts + np.floor(bucket * every).astype(np.int64) + 1
+        high = starts + np.floor((bucket + 1) * every).astype(np.int64) + 1
+        next_high = np.minimum(starts + np.floor((bucket + 2) * every).astype(np.int64) + 1, starts + lengths)
+        next_count = next_high - high
+        next_x = (x_sums[next_high] - x_sums[high]) / next_count
+        next_y = (y_sums[next_high] - y_sums[high]) / next_count
+
+        width = int((high - low).max())
+        candidates = low[:, None] + np.arange(width)
+        valid = candidates < high[:, None]
+        candidates = np.where(valid, candidates, low[:, None])
+
+        previous_x = x[previous][:, None]
+        previous_y = y[previous][:, None]
+        areas = np.abs(
+            (previous_x - next_x[:, None]) * (y[candidates] - previous_y)
+            - (previous_x - x[candidates]) * (next_y[:, None] - previous_y)
+        )
+        areas[~valid] = -1
+        previous = candidates[rows, areas.argmax(axis=1)]
+        keep[previous] = True
+
+    return np.flatnonzero(keep)
+
+
+def downsample_rows(rows, max_points: int, x_index: int, y_index: int):
+    """
+    Downsample a stream of rows grouped into series.
+
+    Args:
+        rows: Tuples whose first item is the series key, ordered by key and
+            then by x.
+        max_points (int): Points kept per series, see lttb.
+        x_index (int): Position of the x value in a row.
+        y_index (int): Position of the y value in a row.
+
+    Yields:
+        tuple: The rows kept, without the series key.
+    """
+    batch = []
+    for row in rows:
+        # Only complete series are downsampled, so a batch is cut where a
+        # new series starts
+        if len(batch) >= ROWS_PER_BATCH and row[0] != batch[-1][0]:
+            yield from _downsample_batch(batch, max_points, x_index, y_index)
+            batch = []
+        batch.append(row)
+    if batch:
+        yield from _downsample_batch(batch, max_points, x_index, y_index)
+
+
+def _downsample_batch(batch: list, max_points: int, x_index: int, y_index: int):
+    keys, x, y = zip(*((row[0], row[x_index], row[y_index]) for row in batch))
+    for index in lttb(series_offsets(keys), x, y, max_points):
+        yield batch[index][1:]
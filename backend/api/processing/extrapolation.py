@@ -0,0 +1,92 @@
+"""Extrapolate predicted 305-day milk yields beyond DIM 305 for a whole herd."""
+import numpy as np
+
+# Days in a breeding cycle, added per extension
+CYCLE_LENGTH = 21
+# Number of cycle extensions stored with each prediction
+NUM_CYCLES = 10
+# Milk yield (kg/d) at which a cow is dried off
+TARGET_YIELD = 25
+# The persistency line runs from the average yield of DIM 56-60 to DIM 305
+PERSISTENCY_START_DIM = 60
+PERSISTENCY_WINDOW = (56, 60)
+
+
+def approximate_persistency(predicted_305_my, last_milk_yield) -> np.ndarray:
+    """
+    Slope of the straight line from the yield at DIM 60 to the predicted yield
+    at DIM 305.
+
+    Args:
+        predicted_305_my (array-like): Predicted milk yield at DIM 305.
+        last_milk_yield (array-like): Average milk yield of DIM 56-60.
+
+    Returns:
+        np.ndarray: Change in milk yield per day.
+    """
+    predicted_305_my = np.asarray(predicted_305_my, dtype=float)
+    last_milk_yield = np.asarray(last_milk_yield, dtype=float)
+    return (predicted_305_my - last_milk_yield) / (305 - PERSISTENCY_START_DIM)
+
+
+def extend_cycles(
+    predicted_305_my,
+    persistency,
+    cycle_length: int = CYCLE_LENGTH,
+    num_cycles: int = NUM_CYCLES
+) -> np.ndarray:
+    """
+    Milk yield after extending each lactation by 1 to num_cycles cycles.
+
+    Returns:
+        np.ndarray: One row per lactation and one column per number of cycles.
+    """
+    predicted_305_my = np.asarray(predicted_305_my, dtype=float)
+    persistency = np.asarray(persistency, dtype=float)
+    cycles = np.arange(1, num_cycles + 1)
+    return predicted_305_my[:, None] + persistency[:, None] * (cycle_length * cycles)
+
+
+def days_to_target(predicted_305_my, persistency, target_yield: float = TARGET_YIELD) -> np.ndarray:
+    """
+    DIM at which the persistency line reaches the target yield.
+
+    Lactations predicted at or below the target at DIM 305, and those whose
+    yield never reaches it, get 0.
+
+    Returns:
+        np.ndarray: Integer DIM per lactation.
+    """
+    predicted_305_my = np.asarray(predicted_305_my, dtype=float)
+    persistency = np.asarray(persistency, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        extra_days = np.trunc((target_yield - predicted_305_my) / persistency)
+    reaches_target = (predicted_305_my > target_yield) & np.isfinite(extra_days)
+    return np.where(reaches_target, 305 + extra_days, 0).astype(int)
+
+
+def extrapolate(
+    predicted_305_my,
+    persistency,
+    target_yield: float = TARGET_YIELD,
+    cycle_length: int = CYCLE_LENGTH,
+    num_cycles: int = NUM_CYCLES
+) -> dict:
+    """
+    Cycle extensions and days to target for many lactations at once.
+
+    Args:
+        predicted_305_my (array-like): Predicted milk yield at DIM 305.
+        persistency (array-like): Approximate persistency of each lactation.
+        target_yield (float): Milk yield (kg/d) to reach. Default is TARGET_YIELD
+        cycle_length (int): Days per cycle. Default is CYCLE_LENGTH
+        num_cycles (int): Number of cycle extensions. Default is NUM_CYCLES
+
+    Returns:
+        dict: "extend_cycles", an array with one column per number of cycles,
+        and "days_to_target", an integer array.
+    """
+    return {
+        "extend_cycles": extend_cycles(predicted_305_my, persistency, cycle_length, num_cycles),
+        "days_to_target": days_to_target(predicted_305_my, persistency, target_yield),
+    }
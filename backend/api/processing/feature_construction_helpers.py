@@ -39,3 +39,103 @@ def cyclic_encode(df: pd.DataFrame, col_name: str, n: int) -> pd.DataFrame:
     df[f"{col_name}_cos"] = np.cos(2 * np.pi * column / n) 
     return df
 
+
+
+def build_lactation_index(
+    df: pd.DataFrame,
+    cow_col: str = "Cow",
+    parity_col: str = "Parity",
+    dim_col: str = "DIM",
+    y_col: str = "MilkTotal"
+) -> dict:
+    """
+    Map each lactation to its DIM and milk yield as NumPy arrays sorted by DIM.
+    The data is sorted once and every lactation gets a view of the sorted 
+    arrays, so looking up a lactation does not scan the whole herd.
+
+    Args:
+        df (pd.DataFrame): Data for one or more lactations
+        cow_col (str): The name of the cow column. Default is "Cow"
+        parity_col (str): The name of the parity column. Default is "Parity"
+        dim_col (str): The name of the days in milk column. Default is "DIM"
+        y_col (str): The name of the milk yield column. Default is "MilkTotal"
+
+    Returns:
+        dict: (cow, parity) -> (DIM array, milk yield array)
+    """
+    ordered = df.sort_values(by=[cow_col, parity_col, dim_col], kind="stable")
+    dims = ordered[dim_col].to_numpy(dtype=float)
+    milk = ordered[y_col].to_numpy(dtype=float)
+
+    index = {}
+    groups = ordered.groupby(by=[cow_col, parity_col], sort=False).indices
+    for key, positions in groups.items():
+        start, stop = positions[0], positions[-1] + 1
+        index[key] = (dims[start:stop], milk[start:stop])
+    return index
+
+
+def get_lactation(lactation_index: dict, cow, parity, max_dim: float = None):
+    """
+    Look up a lactation in an index built by build_lactation_index.
+
+    Args:
+        lactation_index (dict): The index
+        cow: The cow ID
+        parity: The parity of the lactation
+        max_dim (float, optional): Only return records up to this DIM
+
+    Returns:
+        tuple: DIM and milk yield arrays, empty if the lactation is not indexed
+    """
+    dims, milk = lactation_index.get((cow, parity), (np.empty(0), np.empty(0)))
+    if max_dim is not None:
+        stop = np.searchsorted(dims, max_dim, side="right")
+        dims, milk = dims[:stop], milk[:stop]
+    return dims, milk
+
+
+def nan_mean(values: np.ndarray) -> float:
+    """Mean of the values that are not NaN, NaN if there are none."""
+    values = values[~np.isnan(values)]
+    return values.mean() if values.size else np.nan
+
+
+def get_milk_total_variance(current_lactation: pd.DataFrame) -> pd.Series:
+    """
+    Calculate the variance of MilkTotal over the first 60 DIM of each 
+    lactation, used as the feature 'my_variance'.
+
+    Returns:
+        pd.Series: The variance indexed by Cow and Parity
+    """
+    variance_data = current_lactation[current_lactation['DIM'] <= 60]
+    return variance_data.groupby(['Cow', 'Parity'])['MilkTotal'].var()
+
+
+def get_rate_of_milk_change(current_lactation: pd.DataFrame) -> pd.Series:
+    """
+    Fit a line to MilkTotal over the first 60 DIM of each lactation and return
+    the slope, used as the feature 'rate_of_my_change'. The slope is the same 
+    as scipy's linregress, and NaN for lactations with fewer than two distinct 
+    DIM or any missing values.
+
+    Returns:
+        pd.Series: The slope indexed by Cow and Parity
+    """
+    change_data = current_lactation.loc[
+        current_lactation['DIM'] <= 60, ['Cow', 'Parity', 'DIM', 'MilkTotal']
+    ]
+    grouped = change_data.groupby(['Cow', 'Parity'])
+    dim_deviation = change_data['DIM'] - grouped['DIM'].transform('mean')
+    my_deviation = change_data['MilkTotal'] - grouped['MilkTotal'].transform('mean')
+
+    sums = pd.DataFrame({
+        'sxy': dim_deviation * my_deviation,
+        'sxx': dim_deviation ** 2,
+        'missing': change_data[['DIM', 'MilkTotal']].isna().any(axis=1),
+    }).groupby([change_data['Cow'], change_data['Parity']]).sum()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sums['sxy'] / sums['sxx']
+    return slope.where((grouped.size() > 1) & (sums['missing'] == 0) & (sums['sxx'] > 0))
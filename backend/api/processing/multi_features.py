@@ -1,23 +1,38 @@
 """Feature construction for multiparous cows."""
-import os
+import logging
 import sys
 
-import lmfit
 import numpy as np
 import pandas as pd
-from scipy.stats import linregress
 import sklearn.preprocessing
-import joblib
 
 from django.conf import settings
 
+from ..artifacts import get_artifact
+from .dijkstra import dijkstra, fit_dijkstra
+from .feature_construction_helpers import (
+    build_lactation_index, get_lactation, get_milk_total_variance, 
+    get_rate_of_milk_change, nan_mean
+)
+
 pd.options.mode.chained_assignment = None
 
+logger = logging.getLogger(__name__)
+
+# Days to peak is log(b / c) / b0, which depends on how close b0 and c get to 0
+DAYS_TO_PEAK_PARAMS = ("b0", "c")
+
 
 def multi_feature_construction(
     current_lactation: pd.DataFrame, 
-    previous_lactation: pd.DataFrame
+    previous_lactation: pd.DataFrame,
+    lactation_index: dict = None
 ) -> pd.DataFrame:
+    if lactation_index is None:
+        lactation_index = build_lactation_index(
+            pd.concat([current_lactation, previous_lactation])
+        )
+
     # 10d milk bins
     features = transform_10d_averages(current_lactation, 60)
 
@@ -29,9 +44,7 @@ def multi_feature_construction(
     features = features.merge(min_dim, on=["Cow", "Parity"], how="left")
 
     # Fit Dijkstra
-    persistency_features = features.apply(
-        calculate_previous_persistency, axis=1, args=(previous_lactation,)
-        )
+    persistency_features = calculate_previous_persistency(features, lactation_index)
     features = pd.concat([features, persistency_features], axis=1)
     features.replace([np.inf, -np.inf], np.nan, inplace=True)
     features = features.dropna()
@@ -54,9 +67,7 @@ def multi_feature_construction(
     )
 
     # Fit Dijkstra (60 DIM + Previous d305 MY)
-    current_persistency = features.apply(
-        calculate_current_persistency, axis=1, args=(current_lactation,)
-        )
+    current_persistency = calculate_current_persistency(features, lactation_index)
     features = pd.concat([features, current_persistency], axis=1) 
     features.replace([np.inf, -np.inf], np.nan, inplace=True)
     features = features.dropna()
@@ -95,8 +106,13 @@ def multi_feature_construction(
         305, features["current_days_to_peak"]
     )
 
-    features["my_variance"] = get_milk_total_variance(current_lactation)
-    features["rate_of_my_change"] = get_rate_of_milk_change(current_lactation)
+    lactation_keys = pd.MultiIndex.from_frame(features[["Cow", "Parity"]])
+    features["my_variance"] = (
+        get_milk_total_variance(current_lactation).reindex(lactation_keys).to_numpy()
+    )
+    features["rate_of_my_change"] = (
+        get_rate_of_milk_change(current_lactation).reindex(lactation_keys).to_numpy()
+    )
 
     # Previous Dijkstra parameters adjusted to equation
     features["prev_dijkstra_b_eqn"] = get_dijkstra_b_eqn(
@@ -135,11 +151,9 @@ def multi_feature_construction(
     features = features[required_columns]
 
     # MinMax Scaling
-    scalers_dir = os.path.join(settings.BASE_DIR, "api/scalers")
-    scaler_path = os.path.join(scalers_dir, "multiparous_scaler.joblib")
-    scaler = joblib.load(scaler_path)
+    scaler = get_artifact("multi_scaler")
     scaled_data = scaler.transform(features)
-    scaled_data = pd.DataFrame(scaled_data, columns=required_columns)
+    scaled_data = pd.DataFrame(scaled_data, columns=required_columns, index=lactation_keys)
     return scaled_data
 
 
@@ -182,43 +196,39 @@ def cyclic_encode(df: pd.DataFrame, col_name: str, n: int) -> pd.DataFrame:
     return df
 
 
-def calculate_previous_persistency(row, previous_lactation):
-    cow = row['Cow']
-    parity = row['Parity'] - 1
-
-    data = previous_lactation[(previous_lactation['Cow'] == cow) &
-                             (previous_lactation['Parity'] == parity)]
-    if data.empty or len(data) <= 60:
-        return pd.Series({
-                          'prev_persistency': np.nan, 
-                          "prev_lact_length": np.nan, 
-                          "prev_days_to_peak": np.nan, 
-                          "prev_305_my": np.nan
-                          })
-
-    x = data['MilkTotal']
-    t = data['DIM']
-    param_specs = {
-        'a': {'value': 30, 'min': 0, 'max': 100},
-        'b': {'value': 0.01, 'min': 0.0001, 'max': 0.09},
-        'b0': {'value': 0.01, 'min': 0, 'max': 0.09},
-        'c': {'value': 0.001, 'min': 0, 'max': 0.005}
-        }
-    dijkstra_fit = fit_model(dijkstra, param_specs, x, t)
-    a = dijkstra_fit['a']
-    b = dijkstra_fit['b']
-    b0 = dijkstra_fit['b0']
-    c = dijkstra_fit['c']
-
-    t_end = data['DIM'].max()
+def calculate_previous_persistency(features, lactation_index):
+    """
+    Fit the Dijkstra curve to the previous lactation of every row of features 
+    and derive its persistency, length, days to peak and 305 day milk yield. 
+    Previous lactations with 60 or fewer records are not fitted and get NaN.
+    """
+    curves = [
+        get_lactation(lactation_index, cow, parity - 1)
+        for cow, parity in zip(features["Cow"], features["Parity"])
+    ]
+    fitted = np.array([len(t) > 60 for t, _ in curves], dtype=bool)
+
+    params = np.full((len(curves), 4), np.nan)
+    if fitted.any():
+        params[fitted] = fit_dijkstra(
+            [curve for curve, fit in zip(curves, fitted) if fit], 
+            method=settings.DIJKSTRA_FIT_METHOD,
+            refit_at_lower_bound=DAYS_TO_PEAK_PARAMS
+        )
+    a, b, b0, c = params.T
+
+    t_end = np.array([np.nanmax(t) if fit else np.nan for (t, _), fit in zip(curves, fitted)])
     my_end = dijkstra(t_end, a, b, b0, c)
-    pt = round(np.log(b / c) / b0)
+    pt = get_dijkstra_days_to_peak(b, b0, c)
     py = dijkstra(pt, a, b, b0, c)
 
-    prev_305_my = calculate_previous_305_my(row, previous_lactation)
+    prev_305_my = np.array([
+        calculate_previous_305_my(row, lactation_index) if fit else np.nan
+        for (_, row), fit in zip(features.iterrows(), fitted)
+    ], dtype=float)
 
     persistency = calculate_persistency(my_end, py, t_end, pt)
-    return pd.Series({
+    return pd.DataFrame({
         'prev_a': a,
         'prev_b': b,
         'prev_b0': b0,
@@ -226,50 +236,27 @@ def calculate_previous_persistency(row, previous_lactation):
         'prev_persistency': persistency, 
         'prev_lact_length': t_end,
         'prev_days_to_peak': pt,
-        "prev_305_my": prev_305_my}
-        )
+        "prev_305_my": prev_305_my
+        }, index=features.index)
 
 
-def dijkstra(t, a, b, b0, c):
-    return a * np.exp((b * (1 - np.exp(-b0 * t)) / b0) - c * t)
-
-
-def fit_model(func, param_specs, x, t):
-    model = lmfit.Model(func)
-    params = model.make_params()
-    for param_name, specs in param_specs.items():
-        if 'min' in specs and 'max' in specs:
-            params[param_name].set(value=specs['value'], min=specs['min'], max=specs['max'])
-        else:
-            params[param_name].set(value=specs['value'])
-
-    result = model.fit(x, params, t=t, method='leastsq')
-    best_fit_params = result.params.valuesdict()
-    return best_fit_params
-
-
-def calculate_previous_305_my(row, previous_lactation):
+def calculate_previous_305_my(row, lactation_index):
     cow = row['Cow']
     parity = row['Parity'] - 1  
 
     if parity > 0:
-        filtered = previous_lactation[(previous_lactation['Cow'] == cow) &
-                                      (previous_lactation['Parity'] == parity) &
-                                      (previous_lactation['DIM'].between(303, 307))]
-        if not filtered.empty:
-            return filtered['MilkTotal'].mean()
-
-        elif filtered.empty:
-            # Handle cases where there is no DIM 303-307 records for the previous lactation
-            cow_prev_lac = previous_lactation[(previous_lactation['Cow'] == cow) &
-                                            (previous_lactation['Parity'] == parity) &
-                                            (previous_lactation['DIM'] < 305)]
-            closest_dim = cow_prev_lac["DIM"].max()
-            closest_records = previous_lactation[(previous_lactation['Cow'] == cow) &
-                                                (previous_lactation['Parity'] == parity) &
-                                                (previous_lactation['DIM'].between(closest_dim - 5, closest_dim))]
-            if not closest_records.empty:
-                return closest_records["MilkTotal"].mean()
+        dims, milk = get_lactation(lactation_index, cow, parity)
+        start = np.searchsorted(dims, 303, side="left")
+        stop = np.searchsorted(dims, 307, side="right")
+        if stop > start:
+            return nan_mean(milk[start:stop])
+
+        # Handle cases where there is no DIM 303-307 records for the previous lactation
+        before_305 = np.searchsorted(dims, 305, side="left")
+        if before_305 > 0:
+            closest_dim = dims[before_305 - 1]
+            start = np.searchsorted(dims, closest_dim - 5, side="left")
+            return nan_mean(milk[start:before_305])
 
     return np.nan  
 
@@ -284,51 +271,33 @@ def calculate_persistency(my_end, py, t_end, pt):
     return (my_end - py) / (t_end - pt)
 
 
-def calculate_current_persistency(row, current_lactation):
-    cow = row["Cow"]
-    parity = row["Parity"]    
-    data = current_lactation[(current_lactation["Cow"] == cow) &
-                             (current_lactation["Parity"] == parity) & 
-                             (current_lactation["DIM"] <= 60)]
-    
-    if data.empty or len(data) < 50:
-        print(f"Cow: {cow} Parity: {parity} had < 50 DIM for current lactation. {len(data)}")
-        return pd.Series({'persistency': np.nan,
-                          "days_to_peak": np.nan, 
-                          "predicted_305_my": np.nan,
-                        #   "a": np.nan,
-                        #   "b": np.nan,
-                        #   "b0": np.nan,
-                        #   "c": np.nan
-                          }
-                          )
-
-    x = data['MilkTotal']
-    x = pd.concat([x, pd.Series([row['prev_305_my']])], ignore_index=True)
-
-    t = data['DIM']
-    t = pd.concat([t, pd.Series([305])], ignore_index=True)
-
-    param_specs = {
-        'a': {'value': 30, 'min': 0, 'max': 100},
-        'b': {'value': 0.01, 'min': 0.0001, 'max': 0.09},
-        'b0': {'value': 0.01, 'min': 0, 'max': 0.09},
-        'c': {'value': 0.001, 'min': 0, 'max': 0.005}
-        }
-    
-    dijkstra_fit = fit_model(dijkstra, param_specs, x, t)
-    a = dijkstra_fit['a']
-    b = dijkstra_fit['b']
-    b0 = dijkstra_fit['b0']
-    c = dijkstra_fit['c']
+def calculate_current_persistency(features, lactation_index):
+    """
+    Fit the Dijkstra curve to the first 60 DIM of every current lactation plus 
+    the previous 305 day milk yield at DIM 305. Lactations with fewer than 50 
+    records in the first 60 DIM are not fitted and get NaN.
+    """
+    curves = []
+    for cow, parity, prev_305_my in zip(features["Cow"], features["Parity"], features["prev_305_my"]):
+        t, x = get_lactation(lactation_index, cow, parity, max_dim=60)
+        if len(t) < 50:
+            logger.warning(f"Cow {cow}, Parity {parity} has {len(t)} records in the first 60 DIM of the current lactation, fewer than 50.")
+            curves.append((np.empty(0), np.empty(0)))
+            continue
+        curves.append((np.append(t, 305), np.append(x, prev_305_my)))
+
+    params = fit_dijkstra(
+        curves, method=settings.DIJKSTRA_FIT_METHOD, refit_at_lower_bound=DAYS_TO_PEAK_PARAMS
+    )
+    a, b, b0, c = params.T
 
     t_end = 305
     my_end = dijkstra(t_end, a, b, b0, c)
-    pt = round(np.log(b / c) / b0)
+    pt = get_dijkstra_days_to_peak(b, b0, c)
     py = dijkstra(pt, a, b, b0, c)
 
     persistency = calculate_persistency(my_end, py, t_end, pt)
-    return pd.Series({
+    return pd.DataFrame({
         "persistency": persistency,
         "days_to_peak": pt,
         "predicted_305_my": my_end,
@@ -336,7 +305,7 @@ def calculate_current_persistency(row, current_lactation):
         "current_b": b,
         "current_b0": b0,
         "current_c": c
-    })
+    }, index=features.index)
 
 
 def get_persistency(my_end, py, t_end, pt):
@@ -350,32 +319,8 @@ def get_persistency(my_end, py, t_end, pt):
 
 
 def get_dijkstra_days_to_peak(b, b0, c):
-    return round(np.log(b / c) / b0) 
-
-
-def get_milk_total_variance(current_lactation):
-    """
-    Calculate the variance of MilkTotal over the first 60 DIM using data_import
-    and add it to transformed_data as the column 'my_variance'.
-    """
-    variance_data = current_lactation[current_lactation['DIM'] <= 60]['MilkTotal'].copy()
-    my_variance = variance_data.var()
-    return my_variance
-
-
-def get_rate_of_milk_change(current_lactation):
-    """
-    Fit a line to MilkTotal over the first 60 DIM using data_import, 
-    calculate the slope, and add it to transformed_data as 'rate_of_my_change'.
-    """
-    change_data = current_lactation[current_lactation['DIM'] <= 60].copy()
-    
-    if len(change_data) > 1:
-        slope, _, _, _, _ = linregress(change_data['DIM'], change_data['MilkTotal'])
-    else:
-        slope = np.nan 
-    
-    return slope
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.round(np.log(b / c) / b0)
 
 
 def get_dijkstra_b_eqn(b):
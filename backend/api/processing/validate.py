@@ -58,32 +58,45 @@ def validate_and_clean_columns(df: pd.DataFrame, messages: list) -> pd.DataFrame
 
 def get_eligible_lactations(df: pd.DataFrame) -> list:
     """Generates a list of Cow-Parity pairs eligible for ML based on the conditions.
+
+    Record counts for every lactation are computed with one groupby, and the
+    previous parity counts are looked up from the same table.
     
     Args:
         df (pd.DataFrame): The validated DataFrame.
         
     Returns:
         eligible_pairs (list): A list of tuples (Cow, Parity) eligible for ML.
+        ineligible_pairs (list): A list of tuples (Cow, Parity, reason) for the
+            lactations that are not eligible.
     """
+    counts = (df
+              .assign(early_dim=df['DIM'].between(0, 60))
+              .groupby(['Cow', 'Parity'])
+              .agg(records=('early_dim', 'size'), early_records=('early_dim', 'sum'))
+              )
+    cows = counts.index.get_level_values('Cow')
+    parities = counts.index.get_level_values('Parity')
+    previous_records = (counts['records']
+                        .reindex(pd.MultiIndex.from_arrays([cows, parities - 1]))
+                        .fillna(0)
+                        .to_numpy()
+                        )
+
+    # Condition 1: At least 50 records between 0 and 60 DIM
+    too_few_early = counts['early_records'].to_numpy() < 50
+    # Condition 2: Check the previous parity exists (Multiparous)
+    too_few_previous = ~too_few_early & (parities > 1) & (previous_records < 100)
+
     eligible_pairs = []
     ineligible_pairs = []
-
-    grouped = df.groupby(['Cow', 'Parity'])
-
-    for (cow, parity), group in grouped:       
-        # Condition 1: At least 50 records between 0 and 60 DIM
-        if len(group[(group['DIM'] >= 0) & (group['DIM'] <= 60)]) < 50:
+    for (cow, parity), no_early, no_previous in zip(counts.index, too_few_early, too_few_previous):
+        if no_early:
             ineligible_pairs.append((cow, parity, "Less than 50 records between 0 and 60 DIM"))
-            continue
-        
-        # Condition 2: Check the previous parity exists (Multiparous)
-        if parity > 1:
-            previous_parity_group = df[(df['Cow'] == cow) & (df['Parity'] == parity - 1)]
-            if len(previous_parity_group) < 100:
-                ineligible_pairs.append((cow, parity, "Less than 100 records for previous parity"))
-                continue
-
-        eligible_pairs.append((cow, parity))
+        elif no_previous:
+            ineligible_pairs.append((cow, parity, "Less than 100 records for previous parity"))
+        else:
+            eligible_pairs.append((cow, parity))
     
     return eligible_pairs, ineligible_pairs
 
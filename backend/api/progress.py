@@ -0,0 +1,94 @@
+"""Send upload progress to the user's ProgressConsumer group."""
+import asyncio
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressReporter:
+    """Publishes progress events for one upload to `user_<id>_progress`.
+
+    Stage changes are sent straight away. Per-lactation updates and messages
+    are coalesced so at most one event is sent every `min_interval` seconds,
+    carrying the latest count and every queued message. The final lactation
+    update of a stage is always sent.
+
+    Args:
+        user_id (int): The user to send progress to.
+        job_id (int, optional): The upload job the events belong to.
+        loop (asyncio.AbstractEventLoop, optional): The event loop of the ASGI
+            server. The in-memory channel layer only delivers messages sent
+            from this loop, so jobs running on a thread of the web process
+            pass it here. Redis works from any thread or process.
+        min_interval (float, optional): Seconds between lactation updates.
+            Defaults to settings.PROGRESS_MIN_INTERVAL.
+    """
+    def __init__(self, user_id, job_id=None, loop=None, min_interval=None):
+        self.group_name = f"user_{user_id}_progress"
+        self.job_id = job_id
+        self.loop = loop
+        self.min_interval = (
+            settings.PROGRESS_MIN_INTERVAL if min_interval is None else min_interval
+        )
+        self.channel_layer = get_channel_layer()
+        self.stage_name = None
+        self._last_sent = 0.0
+        self._latest = None
+        self._messages = []
+
+    def stage(self, stage, message):
+        """Announce the start of a pipeline stage."""
+        self.flush()
+        self.stage_name = stage
+        self._send({"progress": message})
+
+    def message(self, message):
+        """Queue an informational message, sent with the next update."""
+        self._messages.append(message)
+        self._maybe_flush()
+
+    def lactation(self, processed, total, message):
+        """Report that `processed` of `total` lactations are done."""
+        self._latest = {"progress": message, "processed": processed, "total": total}
+        self._maybe_flush(force=processed >= total)
+
+    def flush(self):
+        """Send the coalesced lactation update and queued messages, if any."""
+        if self._latest is None and not self._messages:
+            return
+
+        payload = dict(self._latest or {"progress": self._messages[-1]})
+        if self._messages:
+            payload["messages"] = self._messages
+        self._latest = None
+        self._messages = []
+        self._send(payload)
+
+    def _maybe_flush(self, force=False):
+        if force or time.monotonic() - self._last_sent >= self.min_interval:
+            self.flush()
+
+    def _send(self, payload):
+        if self.channel_layer is None:
+            return
+
+        message = {"job_id": self.job_id, "stage": self.stage_name, **payload}
+        event = {
+            "type": "progress.message",  # This must match a method name in the consumer
+            "message": message
+        }
+        try:
+            if self.loop is not None and self.loop.is_running():
+                asyncio.run_coroutine_threadsafe(
+                    self.channel_layer.group_send(self.group_name, event), self.loop
+                ).result(timeout=5)
+            else:
+                async_to_sync(self.channel_layer.group_send)(self.group_name, event)
+        except Exception as e:
+            logger.warning(f"Error sending progress message: {str(e)}")
+        self._last_sent = time.monotonic()
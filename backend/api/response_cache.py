@@ -0,0 +1,99 @@
+"""Server-side cache of the read endpoints, namespaced per user.
+
+Cached responses are keyed by the user, their cache generation, their data
+version and the full request path. invalidate_user_cache moves a user to a
+new generation, which drops all their entries at once. The data version in
+the key keeps entries correct even where an invalidation cannot reach the
+cache, such as a local-memory cache in the web process after an upload
+finished in a separate worker.
+"""
+import hashlib
+import logging
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+from .versions import request_data_version
+
+logger = logging.getLogger(__name__)
+
+HITS_KEY = "response_cache:hits"
+MISSES_KEY = "response_cache:misses"
+
+
+def _generation_key(user_id: int) -> str:
+    return f"response_cache:user_{user_id}:generation"
+
+
+def invalidate_user_cache(user_id: int):
+    """Drop every cached response of a user."""
+    key = _generation_key(user_id)
+    try:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+    except Exception as e:
+        logger.warning(f"Could not invalidate the response cache of user {user_id}: {e}")
+
+
+def _response_key(request) -> str:
+    generation = cache.get(_generation_key(request.user.id), 0)
+    version = request_data_version(request).version
+    path = hashlib.sha256(request.get_full_path().encode()).hexdigest()
+    return f"response_cache:user_{request.user.id}:{generation}:{version}:{path}"
+
+
+def _count(key: str):
+    try:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+    except Exception:
+        pass
+
+
+def cache_stats() -> dict:
+    """Hits and misses counted by the cache, with the hit rate."""
+    hits, misses = (cache.get(key, 0) for key in (HITS_KEY, MISSES_KEY))
+    requests = hits + misses
+    return {
+        "backend": settings.RESPONSE_CACHE,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / requests if requests else None,
+    }
+
+
+def cached_response(view_func):
+    """Serve a GET from the cache when the user's data has not changed.
+
+    Only successful responses are stored. The cached data is rendered again
+    on a hit, but the queries and serialization of the view are skipped.
+    Responses carry X-Cache: HIT or MISS.
+    """
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        try:
+            key = _response_key(request)
+            cached = cache.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache unavailable: {e}")
+            return view_func(request, *args, **kwargs)
+
+        if cached is not None:
+            _count(HITS_KEY)
+            response = Response(cached)
+            response["X-Cache"] = "HIT"
+            return response
+
+        _count(MISSES_KEY)
+        response = view_func(request, *args, **kwargs)
+        if response.status_code == 200 and isinstance(response, Response):
+            try:
+                cache.set(key, response.data, timeout=settings.RESPONSE_CACHE_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Could not cache response: {e}")
+        response["X-Cache"] = "MISS"
+        return response
+
+    return wrapped_view
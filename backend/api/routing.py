@@ -2,5 +2,5 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    # re_path(r'ws/data-upload/(?P<user_id>\d+)/$', consumers.DataUploadConsumer.as_asgi()),
+    re_path(r'ws/data-upload/(?P<user_id>\d+)/$', consumers.ProgressConsumer.as_asgi()),
 ]
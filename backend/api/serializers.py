@@ -1,8 +1,12 @@
+import os
+
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password
 from rest_framework import serializers
 from django.core.exceptions import ValidationError
-from .models import LactationData, MultiparousFeatures, PrimiparousFeatures
+from .models import Lactation, LactationData, MultiparousFeatures, PrimiparousFeatures, UploadJob
+from .processing.extrapolation import CYCLE_LENGTH, NUM_CYCLES, TARGET_YIELD
+from .summary import HISTOGRAM_BINS
 
 class UserSerializer(serializers.ModelSerializer):
     confirmPassword = serializers.CharField(write_only=True)
@@ -89,15 +93,6 @@ class DeleteUserSerializer(serializers.Serializer):
     confirm = serializers.BooleanField()
 
 
-class LactationDataSerializer(serializers.ModelSerializer):
-    cow_id = serializers.CharField(source='lactation.cow.cow_id')
-    parity = serializers.IntegerField(source='lactation.parity')
-
-    class Meta:
-        model = LactationData
-        fields = ['cow_id', 'parity', 'dim', 'date', 'milk_yield']
-
-
 class MultiparousFeaturesSerializer(serializers.ModelSerializer):
     cow_id = serializers.CharField(source='lactation.cow.cow_id')
     parity = serializers.IntegerField(source='lactation.parity')
@@ -114,4 +109,123 @@ class PrimiparousFeaturesSerializer(serializers.ModelSerializer):
     class Meta:
         model = PrimiparousFeatures
         fields = '__all__'
-        
\ No newline at end of file
+
+
+class UploadJobSerializer(serializers.ModelSerializer):
+    file = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadJob
+        fields = [
+            'id', 'file', 'status', 'stage', 'rows_total', 'rows_processed',
+            'lactations_total', 'lactations_processed', 'messages', 'errors',
+            'created_at', 'started_at', 'finished_at'
+        ]
+
+    def get_file(self, obj):
+        return os.path.basename(obj.upload_file.file.name)
+
+
+class ExtensionScenarioSerializer(serializers.Serializer):
+    target_yield = serializers.FloatField(default=TARGET_YIELD, min_value=0)
+    cycle_length = serializers.IntegerField(default=CYCLE_LENGTH, min_value=1, max_value=365)
+    num_cycles = serializers.IntegerField(default=NUM_CYCLES, min_value=1, max_value=50)
+
+
+class PredictionListQuerySerializer(serializers.Serializer):
+    # Output fields and the lookups they are read from
+    FIELDS = {
+        "cow_id": "lactation__cow__cow_id",
+        "parity": "lactation__parity",
+        "predicted_value": "prediction_value",
+        "lactation_id": "lactation_id",
+        "treatment_group": "lactation__treatment_group",
+        "plot_path": "lactation_id",
+        **{f"extend_{cycles}_cycle": f"extend_{cycles}_cycle" for cycles in range(1, 11)},
+        "days_to_target": "days_to_target",
+        "created_at": "created_at",
+    }
+    ORDERINGS = ["created_at", "cow_id", "parity", "treatment_group", "predicted_value"]
+
+    cow_id = serializers.CharField(required=False)
+    parity = serializers.IntegerField(required=False, min_value=1)
+    treatment_group = serializers.ChoiceField(choices=Lactation.TREATMENT_GROUP_CHOICES, required=False)
+    min_predicted_value = serializers.FloatField(required=False)
+    max_predicted_value = serializers.FloatField(required=False)
+    ordering = serializers.ChoiceField(
+        choices=ORDERINGS + [f"-{name}" for name in ORDERINGS], default="created_at"
+    )
+    fields = serializers.CharField(required=False)
+    page_size = serializers.IntegerField(default=100, min_value=1, max_value=1000)
+
+    def validate_fields(self, value):
+        fields = [name.strip() for name in value.split(",") if name.strip()]
+        unknown = [name for name in fields if name not in self.FIELDS]
+        if unknown:
+            raise serializers.ValidationError(
+                f"Unknown fields: {', '.join(unknown)}. Expected any of {', '.join(self.FIELDS)}."
+            )
+        return fields
+
+
+class LactationDataQuerySerializer(serializers.Serializer):
+    # Points per lactation after LTTB downsampling, all of them when omitted
+    max_points = serializers.IntegerField(required=False, min_value=3)
+
+
+class LactationCurveQuerySerializer(LactationDataQuerySerializer):
+    cow_id = serializers.CharField(required=False)
+    parity = serializers.IntegerField(required=False, min_value=1)
+    treatment_group = serializers.ChoiceField(choices=Lactation.TREATMENT_GROUP_CHOICES, required=False)
+
+
+class HerdSummaryQuerySerializer(serializers.Serializer):
+    bins = serializers.IntegerField(default=HISTOGRAM_BINS, min_value=1, max_value=100)
+
+
+class TreatmentAssignmentSerializer(serializers.Serializer):
+    lactation_id = serializers.IntegerField(min_value=1)
+    treatment_group = serializers.ChoiceField(choices=Lactation.TREATMENT_GROUP_CHOICES)
+
+
+class TreatmentGroupFilterSerializer(serializers.Serializer):
+    # Same filters as the predictions list, selecting lactations to reassign
+    lactation_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, allow_empty=False)
+    cow_id = serializers.CharField(required=False)
+    parity = serializers.IntegerField(required=False, min_value=1)
+    parity_type = serializers.ChoiceField(choices=Lactation.PARITY_TYPE_CHOICES, required=False)
+    treatment_group = serializers.ChoiceField(choices=Lactation.TREATMENT_GROUP_CHOICES, required=False)
+    min_predicted_value = serializers.FloatField(required=False)
+    max_predicted_value = serializers.FloatField(required=False)
+
+    def validate(self, data):
+        """Reject a filter without criteria, which would select the whole herd."""
+        if not data:
+            raise serializers.ValidationError(
+                f"Give at least one of {', '.join(self.fields)}."
+            )
+        return data
+
+
+class BulkTreatmentGroupSerializer(serializers.Serializer):
+    """Either a list of assignments, or a filter and the group to assign to every lactation it selects."""
+    assignments = TreatmentAssignmentSerializer(many=True, required=False, allow_empty=False, max_length=10000)
+    filter = TreatmentGroupFilterSerializer(required=False)
+    treatment_group = serializers.ChoiceField(choices=Lactation.TREATMENT_GROUP_CHOICES, required=False)
+
+    def validate(self, data):
+        """
+        Check that exactly one kind of update is requested, and that no
+        lactation is assigned twice.
+        """
+        if ("assignments" in data) == ("filter" in data):
+            raise serializers.ValidationError("Send either assignments or a filter with a treatment_group.")
+        if "filter" in data and "treatment_group" not in data:
+            raise serializers.ValidationError({"treatment_group": "Required with a filter."})
+        if "assignments" in data:
+            if "treatment_group" in data:
+                raise serializers.ValidationError({"treatment_group": "Not allowed with assignments."})
+            lactation_ids = [assignment["lactation_id"] for assignment in data["assignments"]]
+            if len(set(lactation_ids)) != len(lactation_ids):
+                raise serializers.ValidationError({"assignments": "Each lactation can only be assigned once."})
+        return data
@@ -0,0 +1,164 @@
+"""Herd-level statistics of predictions, aggregated in the database.
+
+Counts, means, percentiles and histograms are computed by SQL over the
+user's predictions, for the whole herd and per parity type and treatment
+group, so only the summary leaves the database. Percentiles interpolate
+linearly between the two nearest ranks, like PostgreSQL's percentile_cont,
+and are found with window functions so SQLite answers them too.
+"""
+import math
+
+from django.db.models import Avg, Count, F, FloatField, IntegerField, Max, Min, Q, Value, Window
+from django.db.models.functions import Cast, Floor, Least, RowNumber
+
+# Prediction fields summarised
+SUMMARY_METRICS = ["prediction_value", "approximate_persistency", "days_to_target"]
+# Groups of the per-group summaries, and the keys they are returned under
+SUMMARY_GROUPS = {"parity_type": "lactation__parity_type", "treatment_group": "lactation__treatment_group"}
+PERCENTILES = [5, 25, 50, 75, 95]
+HISTOGRAM_BINS = 10
+
+
+def herd_summary(predictions, bins: int = HISTOGRAM_BINS) -> dict:
+    """Summarise predictions for the herd and per parity type and treatment group.
+
+    Histograms of a metric share the bin edges of the whole herd, so the
+    groups can be compared bin by bin.
+
+    Args:
+        predictions: A Prediction queryset.
+        bins (int): Number of histogram bins.
+
+    Returns:
+        dict: The percentiles reported, the summary of the herd and a list
+        of summaries per group, each with the count of predictions and the
+        count, mean, min, max, percentiles and histogram of every metric.
+    """
+    herd = _summaries(predictions, [], bins, edges=None)[()]
+    edges = {metric: herd["metrics"][metric]["histogram"]["edges"] for metric in SUMMARY_METRICS}
+    groups = _summaries(predictions, list(SUMMARY_GROUPS.values()), bins, edges)
+    return {
+        "percentiles": PERCENTILES,
+        "herd": herd,
+        "groups": [
+            {**dict(zip(SUMMARY_GROUPS, key)), **summary}
+            for key, summary in sorted(groups.items())
+        ],
+    }
+
+
+def _summaries(predictions, group_by: list, bins: int, edges: dict) -> dict:
+    aggregates = {"count": Count("pk")}
+    for metric in SUMMARY_METRICS:
+        aggregates.update({
+            f"{metric}__count": Count(metric),
+            f"{metric}__mean": Avg(metric),
+            f"{metric}__min": Min(metric),
+            f"{metric}__max": Max(metric),
+        })
+    if group_by:
+        rows = predictions.values(*group_by).annotate(**aggregates).order_by(*group_by)
+    else:
+        rows = [predictions.aggregate(**aggregates)]
+
+    summaries = {}
+    for row in rows:
+        key = tuple(row[field] for field in group_by)
+        summaries[key] = {
+            "count": row["count"],
+            "metrics": {
+                metric: {
+                    statistic: row[f"{metric}__{statistic}"] for statistic in ("count", "mean", "min", "max")
+                }
+                for metric in SUMMARY_METRICS
+            },
+        }
+
+    for metric in SUMMARY_METRICS:
+        counts = {key: summary["metrics"][metric]["count"] for key, summary in summaries.items()}
+        percentiles = _percentiles(predictions, metric, group_by, counts)
+        if edges is None:
+            summary = summaries[()]["metrics"][metric]
+            metric_edges = _histogram_edges(summary["min"], summary["max"], bins)
+        else:
+            metric_edges = edges[metric]
+        histograms = _histograms(predictions, metric, group_by, metric_edges)
+        for key, summary in summaries.items():
+            summary["metrics"][metric]["percentiles"] = percentiles.get(key, {f"p{p}": None for p in PERCENTILES})
+            summary["metrics"][metric]["histogram"] = {
+                "edges": metric_edges,
+                "counts": histograms.get(key, [0] * max(len(metric_edges) - 1, 0)),
+            }
+    return summaries
+
+
+def _ranks(count: int) -> dict:
+    # 1-based ranks of the two values each percentile lies between
+    ranks = {}
+    for percentile in PERCENTILES:
+        position = percentile / 100 * (count - 1)
+        ranks[percentile] = (math.floor(position) + 1, math.ceil(position) + 1, position - math.floor(position))
+    return ranks
+
+
+def _percentiles(predictions, metric: str, group_by: list, counts: dict) -> dict:
+    """Percentiles of a metric per group, reading only the rows at the ranks needed."""
+    ranks = {key: _ranks(count) for key, count in counts.items() if count}
+    if not ranks:
+        return {}
+
+    partition = [F(field) for field in group_by] or None
+    rows = (predictions
+            .filter(**{f"{metric}__isnull": False})
+            .annotate(value=Cast(metric, FloatField()),
+                      rank=Window(RowNumber(), partition_by=partition, order_by=[F(metric).asc(), F("pk").asc()])))
+    wanted = Q()
+    for key, key_ranks in ranks.items():
+        needed = {rank for low, high, _ in key_ranks.values() for rank in (low, high)}
+        wanted |= Q(**dict(zip(group_by, key)), rank__in=sorted(needed))
+    values = {}
+    for row in rows.filter(wanted).values(*group_by, "rank", "value"):
+        values[tuple(row[field] for field in group_by), row["rank"]] = row["value"]
+
+    percentiles = {}
+    for key, key_ranks in ranks.items():
+        percentiles[key] = {}
+        for percentile, (low, high, fraction) in key_ranks.items():
+            low_value, high_value = values[key, low], values[key, high]
+            percentiles[key][f"p{percentile}"] = low_value + (high_value - low_value) * fraction
+    return percentiles
+
+
+def _histogram_edges(minimum, maximum, bins: int) -> list:
+    if minimum is None:
+        return []
+    if minimum == maximum:
+        # One bin around a single value
+        return [minimum - 0.5, maximum + 0.5]
+    width = (maximum - minimum) / bins
+    return [minimum + width * i for i in range(bins)] + [maximum]
+
+
+def _histograms(predictions, metric: str, group_by: list, edges: list) -> dict:
+    """Counts per histogram bin of a metric per group, binned with a GROUP BY."""
+    if not edges:
+        return {}
+    bins = len(edges) - 1
+    width = (edges[-1] - edges[0]) / bins
+    # Values on the upper edge belong to the last bin, as in numpy.histogram
+    bin_number = Least(
+        Cast(Floor((Cast(metric, FloatField()) - Value(edges[0])) / Value(width)), IntegerField()),
+        Value(bins - 1)
+    )
+    rows = (predictions
+            .filter(**{f"{metric}__gte": edges[0], f"{metric}__lte": edges[-1]})
+            .annotate(bin=bin_number)
+            .values(*group_by, "bin")
+            .annotate(count=Count("pk"))
+            .order_by())
+
+    histograms = {}
+    for row in rows:
+        key = tuple(row[field] for field in group_by)
+        histograms.setdefault(key, [0] * bins)[row["bin"]] += row["count"]
+    return histograms
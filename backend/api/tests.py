@@ -1,3 +1,1318 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import json
+import os
+import struct
+import tempfile
+import warnings
+from unittest import mock, skipIf
 
-# Create your tests here.
+import joblib
+import numpy as np
+import pandas as pd
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .artifacts import ArtifactRegistry
+from .bulk import insert_lactation_data, upsert
+from .curves import CURVES_MAGIC, pyarrow
+from .identity_map import LactationIdentityMap
+from .jobs import claim_next_job, enqueue_upload, run_job
+from .models import Cow, Lactation, LactationData, Prediction, UploadFile, UploadJob
+from .pipeline import PREDICTION_UPDATE_FIELDS, UploadPipeline
+from .processing.clean import parity_correction, rolling_median_lactations, smooth_lactations
+from .processing.dijkstra import dijkstra, fit_dijkstra
+from .processing.downsampling import lttb, series_offsets
+from .processing.extrapolation import approximate_persistency, extrapolate
+from .processing.validate import get_eligible_lactations
+from .response_cache import cache_stats
+from .summary import PERCENTILES, SUMMARY_METRICS, herd_summary
+
+
+def herd_frame(lactation_lengths: dict, seed: int = 0) -> pd.DataFrame:
+    """Daily records from DIM 1 for each (Cow, Parity) with the given number of days."""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for (cow, parity), days in lactation_lengths.items():
+        frames.append(pd.DataFrame({
+            "Cow": cow,
+            "Parity": parity,
+            "DIM": np.arange(1, days + 1),
+            "MilkTotal": rng.normal(30, 4, days).round(1),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+class EligibleLactationsTests(SimpleTestCase):
+    @staticmethod
+    def reference_eligible_lactations(df):
+        # validate.py before the counts were grouped: one pass over each lactation
+        eligible_pairs = []
+        ineligible_pairs = []
+        for (cow, parity), group in df.groupby(["Cow", "Parity"]):
+            if len(group[(group["DIM"] >= 0) & (group["DIM"] <= 60)]) < 50:
+                ineligible_pairs.append((cow, parity, "Less than 50 records between 0 and 60 DIM"))
+                continue
+            if parity > 1:
+                previous_parity_group = df[(df["Cow"] == cow) & (df["Parity"] == parity - 1)]
+                if len(previous_parity_group) < 100:
+                    ineligible_pairs.append((cow, parity, "Less than 100 records for previous parity"))
+                    continue
+            eligible_pairs.append((cow, parity))
+        return eligible_pairs, ineligible_pairs
+
+    def test_matches_reference(self):
+        df = herd_frame({
+            (1, 1): 305,  # Eligible primiparous
+            (1, 2): 60,   # Eligible, previous parity long enough
+            (2, 1): 99,   # Eligible primiparous
+            (2, 2): 80,   # Previous parity one record short
+            (3, 2): 70,   # No previous parity
+            (4, 1): 49,   # Too few early records
+            (4, 2): 200,  # Previous parity too short
+            (5, 1): 50,   # Exactly 50 early records
+            (5, 3): 120,  # Previous parity missing, only parity 1 exists
+        })
+
+        eligible, ineligible = get_eligible_lactations(df)
+
+        expected_eligible, expected_ineligible = self.reference_eligible_lactations(df)
+        self.assertEqual(eligible, expected_eligible)
+        self.assertEqual(ineligible, expected_ineligible)
+        self.assertEqual(eligible, [(1, 1), (1, 2), (2, 1), (5, 1)])
+
+
+class ParityCorrectionTests(SimpleTestCase):
+    @staticmethod
+    def reference_parity_correction(df):
+        # Each cow's records split at gaps of 15 days or more, one cow at a time
+        corrected_groups = []
+        for _, group in df.sort_values(by=["Cow", "Date"]).groupby("Cow"):
+            gaps = group.loc[group["Date"].diff().dt.days >= 15, "Date"].sort_values().to_list()
+            bounds = [pd.Timestamp.min] + gaps + [pd.Timestamp.max]
+            last_corrected = None
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                lactation = group[(group["Date"] >= start) & (group["Date"] < end)].copy()
+                if lactation.empty:
+                    continue
+                relevant_rows = lactation[(lactation["DIM"] > 10) & (lactation["DIM"] < 300)]
+                if not relevant_rows.empty:
+                    last_corrected = relevant_rows["Parity"].mode().iloc[0]
+                    lactation["Corrected_Parity"] = last_corrected
+                elif last_corrected is not None:
+                    lactation["Corrected_Parity"] = last_corrected + 1
+                else:
+                    lactation["Corrected_Parity"] = lactation["Parity"]
+                corrected_groups.append(lactation)
+        return (pd.concat(corrected_groups, ignore_index=True)
+                .drop(columns="Parity")
+                .rename(columns={"Corrected_Parity": "Parity"}))
+
+    @staticmethod
+    def lactation(cow, parity, calving, dims, mislabelled=0):
+        dims = np.asarray(dims)
+        parities = np.full(len(dims), parity)
+        # Mislabel the first records, the mode still holds the right parity
+        parities[:mislabelled] = parity + 1
+        return pd.DataFrame({
+            "Cow": cow,
+            "Date": pd.Timestamp(calving) + pd.to_timedelta(dims, unit="D"),
+            "DIM": dims,
+            "Parity": parities,
+            "MilkTotal": 30.0,
+        })
+
+    def test_matches_reference(self):
+        df = pd.concat([
+            # Two lactations split by a calving gap, the first partly mislabelled
+            self.lactation(1, 1, "2022-01-01", range(1, 305), mislabelled=20),
+            self.lactation(1, 2, "2022-12-01", range(1, 200)),
+            # A lactation with no records between 10 and 300 DIM after a valid one
+            self.lactation(2, 2, "2022-01-01", range(1, 100)),
+            self.lactation(2, 2, "2022-06-01", range(1, 10)),
+            # Only records outside 10-300 DIM, keeping the recorded parity
+            self.lactation(3, 4, "2022-03-01", range(300, 320)),
+            # A tie between two parities goes to the lower one
+            self.lactation(4, 3, "2022-02-01", range(11, 31), mislabelled=10),
+        ], ignore_index=True).sample(frac=1, random_state=0)
+
+        corrected = parity_correction(df)
+
+        expected = self.reference_parity_correction(df)
+        pd.testing.assert_frame_equal(corrected, expected, check_dtype=False)
+        self.assertEqual(
+            corrected.groupby("Cow")["Parity"].unique().map(lambda parities: parities.tolist()).to_dict(),
+            {1: [1, 2], 2: [2, 3], 3: [4], 4: [3]}
+        )
+
+
+class RollingMedianTests(SimpleTestCase):
+    @staticmethod
+    def reference_rolling_median(values, window):
+        # The centred median of each record, computed one lactation at a time
+        half = window // 2
+        return [
+            float(np.round(np.nanmedian(values[max(0, i - half):i + half + 1]), 1))
+            for i in range(len(values))
+        ]
+
+    def test_matches_reference_with_missing_keys_and_duplicate_labels(self):
+        df = herd_frame({(1, 1): 40, (2, 1): 30, (3, 2): 20})
+        df.loc[df["Cow"] == 3, "Parity"] = np.nan
+        df.loc[[5, 45], "MilkTotal"] = np.nan
+        # Every lactation reuses the labels 0..n-1
+        df.index = df.groupby(["Cow"]).cumcount().to_numpy()
+
+        smoothed = rolling_median_lactations(df, "MilkTotal", "Smoothed")
+
+        window = 3
+        for (cow, parity), lactation in smoothed.groupby(["Cow", "Parity"], dropna=False):
+            original = df[df["Cow"] == cow]["MilkTotal"].to_numpy()
+            self.assertEqual(lactation["Smoothed"].tolist(), self.reference_rolling_median(original, window))
+        self.assertEqual(len(smoothed), len(df))
+        self.assertEqual(smoothed.index.tolist(), df.index.tolist())
+        self.assertFalse(smoothed["MilkTotal"].isna().any())
+
+    def test_lowess_keeps_the_same_rows(self):
+        df = herd_frame({(1, 1): 40, (2, 1): 30, (3, 2): 20})
+        df.loc[df["Cow"] == 3, "Parity"] = np.nan
+
+        lowess = smooth_lactations(df, "MilkTotal", "Smoothed")
+        rolling_median = rolling_median_lactations(df, "MilkTotal", "Smoothed")
+
+        self.assertEqual(sorted(lowess.index), sorted(rolling_median.index))
+        self.assertEqual(int(lowess["Parity"].isna().sum()), 20)
+        self.assertFalse(lowess["Smoothed"].isna().any())
+
+
+class FitDijkstraTests(SimpleTestCase):
+    @staticmethod
+    def synthetic_curves(count, seed=0):
+        """Noisy Dijkstra curves of different lengths, with missed days and missing yields."""
+        rng = np.random.default_rng(seed)
+        curves = []
+        for _ in range(count):
+            a, b, b0, c = rng.uniform(15, 40), rng.uniform(0.02, 0.08), rng.uniform(0.02, 0.08), rng.uniform(0, 0.005)
+            t = np.arange(1, rng.integers(30, 306), dtype=float)
+            t = t[rng.random(len(t)) > 0.05]
+            y = dijkstra(t, a, b, b0, c) + rng.normal(0, 2, len(t))
+            y[rng.random(len(t)) < 0.02] = np.nan
+            curves.append((t, y))
+        return curves
+
+    def test_batch_matches_lmfit(self):
+        curves = self.synthetic_curves(40)
+        # Fewer records than parameters cannot be fitted
+        curves.append((np.array([1.0, 2.0, 3.0]), np.array([20.0, 21.0, 22.0])))
+
+        batch = fit_dijkstra(curves, batch_size=16)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            reference = fit_dijkstra(curves, method="lmfit")
+
+        self.assertEqual(batch.shape, (41, 4))
+        self.assertTrue(np.isnan(batch[-1]).all())
+        self.assertTrue(np.isnan(reference[-1]).all())
+        np.testing.assert_allclose(
+            dijkstra(305, *batch[:-1].T), dijkstra(305, *reference[:-1].T), rtol=0, atol=1e-2
+        )
+        np.testing.assert_allclose(
+            dijkstra(np.arange(1, 306)[:, None], *batch[:-1].T).sum(axis=0),
+            dijkstra(np.arange(1, 306)[:, None], *reference[:-1].T).sum(axis=0),
+            rtol=1e-4
+        )
+
+
+class UpsertTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="farmer", password="password")
+        cow = Cow.objects.create(cow_id="1", owner=user)
+        self.lactation = Lactation.objects.create(cow=cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+
+    def prediction(self, value):
+        return Prediction(
+            lactation=self.lactation, prediction_value=value, approximate_persistency=-0.05,
+            days_to_target=0, plot_path=""
+        )
+
+    def upsert_twice(self, **kwargs):
+        upsert(Prediction, [self.prediction(9000.0)], unique_fields=["lactation", "prediction_type"], **kwargs)
+        created_at = timezone.now() - datetime.timedelta(days=30)
+        Prediction.objects.update(created_at=created_at)
+
+        upsert(Prediction, [self.prediction(9500.0)], unique_fields=["lactation", "prediction_type"], **kwargs)
+
+        prediction = Prediction.objects.get()
+        self.assertEqual(prediction.prediction_value, 9500.0)
+        self.assertEqual(prediction.created_at, created_at)
+
+    def test_default_update_fields_keep_created_at(self):
+        self.upsert_twice()
+
+    def test_prediction_update_fields_keep_created_at(self):
+        self.upsert_twice(update_fields=PREDICTION_UPDATE_FIELDS)
+
+    def test_prediction_update_fields_cover_the_results(self):
+        results = {
+            field.name for field in Prediction._meta.concrete_fields
+            if not field.primary_key and field.name not in ("lactation", "prediction_type", "created_at")
+        }
+        self.assertEqual(set(PREDICTION_UPDATE_FIELDS), results)
+
+
+class ExtrapolationTests(SimpleTestCase):
+    @staticmethod
+    def reference_extrapolation(predicted_305_my, last_milk_yield):
+        # Scalar formulas for a single lactation, with the 21-day cycle and 25 kg/d target written out
+        approx_persistency = (predicted_305_my - last_milk_yield) / (305 - 60)
+        extend_cycles = [predicted_305_my + (approx_persistency * (21 * n)) for n in range(1, 11)]
+        if predicted_305_my > 25:
+            days_to_target = 305 + int((25 - predicted_305_my) / approx_persistency)
+        else:
+            days_to_target = 0
+        return approx_persistency, extend_cycles, days_to_target
+
+    def test_matches_reference(self):
+        rng = np.random.default_rng(0)
+        predicted_305_my = np.concatenate([rng.uniform(15, 45, 50), [25.0, 24.9, 40.0]])
+        last_milk_yield = np.concatenate([rng.uniform(20, 50, 50), [30.0, 30.0, 35.0]])
+
+        persistency = approximate_persistency(predicted_305_my, last_milk_yield)
+        extrapolations = extrapolate(predicted_305_my, persistency)
+
+        for i, (y, last) in enumerate(zip(predicted_305_my, last_milk_yield)):
+            expected_persistency, expected_cycles, expected_days = self.reference_extrapolation(y, last)
+            self.assertAlmostEqual(persistency[i], expected_persistency)
+            np.testing.assert_allclose(extrapolations["extend_cycles"][i], expected_cycles)
+            self.assertEqual(extrapolations["days_to_target"][i], expected_days)
+
+    def test_flat_persistency(self):
+        # The per-lactation formula divided by zero here
+        with self.assertRaises(ZeroDivisionError):
+            self.reference_extrapolation(30.0, 30.0)
+
+        persistency = approximate_persistency([30.0, 20.0], [30.0, 20.0])
+        extrapolations = extrapolate([30.0, 20.0], persistency)
+
+        self.assertEqual(persistency.tolist(), [0.0, 0.0])
+        self.assertEqual(extrapolations["extend_cycles"].tolist(), [[30.0] * 10, [20.0] * 10])
+        self.assertEqual(extrapolations["days_to_target"].tolist(), [0, 0])
+
+
+class LTTBTests(SimpleTestCase):
+    @staticmethod
+    def reference_lttb(x, y, max_points):
+        # Largest-Triangle-Three-Buckets on one series at a time
+        if len(x) <= max_points:
+            return list(range(len(x)))
+        every = (len(x) - 2) / (max_points - 2)
+        kept = [0]
+        for bucket in range(max_points - 2):
+            low = int(np.floor(bucket * every)) + 1
+            high = int(np.floor((bucket + 1) * every)) + 1
+            next_high = min(int(np.floor((bucket + 2) * every)) + 1, len(x))
+            next_x, next_y = np.mean(x[high:next_high]), np.mean(y[high:next_high])
+            previous = kept[-1]
+            areas = [
+                abs((x[previous] - next_x) * (y[i] - y[previous]) - (x[previous] - x[i]) * (next_y - y[previous]))
+                for i in range(low, high)
+            ]
+            kept.append(low + int(np.argmax(areas)))
+        kept.append(len(x) - 1)
+        return kept
+
+    def test_matches_reference(self):
+        rng = np.random.default_rng(0)
+        # Series longer and shorter than max_points, with missed days
+        lengths = [305, 20, 150, 3, 1000, 21]
+        offsets = series_offsets(np.repeat(np.arange(len(lengths)), lengths))
+        x = np.concatenate([np.sort(rng.choice(2 * length, length, replace=False)) + 1 for length in lengths])
+        y = rng.normal(30, 5, len(x))
+
+        kept = lttb(offsets, x, y, max_points=20)
+
+        expected = []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            expected += [start + i for i in self.reference_lttb(x[start:end], y[start:end], 20)]
+        self.assertEqual(kept.tolist(), expected)
+
+    def test_keeps_ends_peaks_and_troughs(self):
+        x = np.arange(1, 306)
+        y = np.full(len(x), 30.0)
+        y[[40, 200]] = [55.0, 5.0]
+
+        kept = lttb(series_offsets(np.zeros(len(x))), x, y, max_points=10)
+
+        self.assertEqual(len(kept), 10)
+        self.assertEqual(kept[0], 0)
+        self.assertEqual(kept[-1], len(x) - 1)
+        self.assertIn(40, kept)
+        self.assertIn(200, kept)
+
+    def test_short_series_are_kept_whole(self):
+        keys = np.repeat([0, 1], [5, 12])
+        kept = lttb(series_offsets(keys), np.arange(17), np.arange(17), max_points=5)
+        self.assertEqual(kept[:5].tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(len(kept), 10)
+
+    def test_rejects_fewer_than_three_points(self):
+        with self.assertRaises(ValueError):
+            lttb([0, 10], np.arange(10), np.arange(10), max_points=2)
+
+
+class DownsampledCurveViewTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="farmer", password="password")
+        cow = Cow.objects.create(cow_id="1", owner=user)
+        lactation = Lactation.objects.create(cow=cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+        milk_yields = np.full(305, 30.0)
+        milk_yields[[40, 200]] = [55.0, 5.0]
+        LactationData.objects.bulk_create([
+            LactationData(lactation=lactation, dim=dim, date=datetime.date(2023, 1, 1) + datetime.timedelta(days=dim),
+                          milk_yield=milk_yield)
+            for dim, milk_yield in enumerate(milk_yields, start=1)
+        ])
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def assert_downsampled(self, dims):
+        self.assertEqual(len(dims), 10)
+        self.assertEqual(dims[0], 1)
+        self.assertEqual(dims[-1], 305)
+        self.assertIn(41, dims)
+        self.assertIn(201, dims)
+
+    def test_lactation_curves(self):
+        response = self.client.get("/api/lactation-curves/", {"max_points": 10})
+        self.assertEqual(response.status_code, 200)
+        self.assert_downsampled(list(response.json()[0]["dim"]))
+
+    def test_lactation_data(self):
+        response = self.client.get("/api/lactation-data/", {"max_points": 10})
+        self.assertEqual(response.status_code, 200)
+        records = json.loads(b"".join(response.streaming_content))
+        self.assert_downsampled([record["dim"] for record in records])
+
+    def test_rejects_fewer_than_three_points(self):
+        response = self.client.get("/api/lactation-curves/", {"max_points": 2})
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkUpdateTreatmentGroupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="farmer", password="password")
+        other_user = User.objects.create_user(username="neighbour", password="password")
+        cow = Cow.objects.create(cow_id="1", owner=self.user)
+        other_cow = Cow.objects.create(cow_id="1", owner=other_user)
+        self.lactations = [
+            Lactation.objects.create(cow=cow, parity=parity, parity_type=parity_type)
+            for parity, parity_type in [(1, Lactation.PRIMIPAROUS), (2, Lactation.MULTIPAROUS)]
+        ]
+        self.other_lactation = Lactation.objects.create(cow=other_cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, data):
+        return self.client.post("/api/update-treatment-groups/", data, format="json")
+
+    def treatment_groups(self):
+        return list(Lactation.objects.order_by("id").values_list("treatment_group", flat=True))
+
+    def test_assignments(self):
+        response = self.post({"assignments": [
+            {"lactation_id": self.lactations[0].id, "treatment_group": "Extend 2 cycles"},
+            {"lactation_id": self.lactations[1].id, "treatment_group": "Do not extend"},
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["updated"], 2)
+        self.assertEqual(self.treatment_groups(), ["Extend 2 cycles", "Do not extend", "No group"])
+
+    def test_assignment_to_another_users_lactation_changes_nothing(self):
+        response = self.post({"assignments": [
+            {"lactation_id": self.lactations[0].id, "treatment_group": "Extend 2 cycles"},
+            {"lactation_id": self.other_lactation.id, "treatment_group": "Extend 2 cycles"},
+        ]})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["lactation_ids"], [self.other_lactation.id])
+        self.assertEqual(self.treatment_groups(), ["No group"] * 3)
+
+    def test_filter_selects_only_own_lactations(self):
+        response = self.post({"filter": {"cow_id": "1", "parity": 1}, "treatment_group": "Extend 1 cycle"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["updated"], 1)
+        self.assertEqual(self.treatment_groups(), ["Extend 1 cycle", "No group", "No group"])
+
+    def test_empty_filter_is_rejected(self):
+        for filters in [{}, {"lactation_ids": []}]:
+            response = self.post({"filter": filters, "treatment_group": "Do not extend"})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.treatment_groups(), ["No group"] * 3)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class UploadJobTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username="farmer", password="password")
+        os.makedirs(os.path.join(media_root.name, "uploads"))
+        with open(os.path.join(media_root.name, "uploads", "herd.csv"), "w") as f:
+            f.write("Cow,Parity,Date,DIM,MilkTotal\n")
+        self.upload_file = UploadFile.objects.create(user=self.user, file="uploads/herd.csv")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @override_settings(UPLOAD_JOB_RUNNER="worker")
+    def test_enqueue_leaves_the_job_for_the_worker(self):
+        with mock.patch("api.jobs.start_in_process_runner") as start_runner:
+            with self.captureOnCommitCallbacks(execute=True):
+                job = enqueue_upload(self.upload_file)
+
+        self.assertEqual(job.status, UploadJob.QUEUED)
+        self.assertEqual(job.upload_file, self.upload_file)
+        start_runner.assert_not_called()
+
+    @override_settings(UPLOAD_JOB_RUNNER="thread")
+    def test_enqueue_starts_the_runner_after_commit(self):
+        with mock.patch("api.jobs.start_in_process_runner") as start_runner:
+            with self.captureOnCommitCallbacks() as callbacks:
+                enqueue_upload(self.upload_file)
+            start_runner.assert_not_called()
+            for callback in callbacks:
+                callback()
+
+        # Outside an ASGI server there is no event loop to hand over
+        start_runner.assert_called_once_with(None)
+
+    def test_claim_takes_the_oldest_job_once(self):
+        first = UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+        second = UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+
+        self.assertEqual(claim_next_job().id, first.id)
+        self.assertEqual(claim_next_job().id, second.id)
+        self.assertIsNone(claim_next_job())
+        self.assertEqual(
+            set(UploadJob.objects.values_list("status", flat=True)), {UploadJob.RUNNING}
+        )
+
+    def test_only_one_of_two_racing_claimers_wins(self):
+        first = UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+        second = UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rival_claims = []
+
+        def claim_in_between():
+            # Another claimer takes the job between our read and our update
+            if not rival_claims:
+                rival_claims.append(None)
+                rival_claims[0] = claim_next_job()
+            return now
+
+        with mock.patch("api.jobs.timezone.now", side_effect=claim_in_between):
+            claimed = claim_next_job()
+
+        self.assertEqual(rival_claims[0].id, first.id)
+        self.assertEqual(claimed.id, second.id)
+
+    def test_failed_run_records_the_error(self):
+        UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+        job = claim_next_job()
+
+        with mock.patch("api.jobs.UploadPipeline.run", side_effect=ValueError("Missing column Date")), \
+                self.assertLogs("api.jobs", level="ERROR"):
+            run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, UploadJob.FAILED)
+        self.assertEqual(job.errors, ["Error processing file: Missing column Date"])
+        self.assertIsNotNone(job.finished_at)
+
+    def test_unexpected_error_fails_the_job(self):
+        UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+        job = claim_next_job()
+
+        with mock.patch("api.jobs.UploadPipeline.run", side_effect=KeyError("Cow")), \
+                self.assertLogs("api.jobs", level="ERROR"):
+            run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, UploadJob.FAILED)
+        self.assertEqual(job.errors, ["Unexpected error: 'Cow'"])
+
+    def test_job_status_of_another_user_is_not_found(self):
+        other_user = User.objects.create_user(username="neighbour", password="password")
+        job = UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+        client = APIClient()
+        client.force_authenticate(other_user)
+
+        self.assertEqual(client.get(f"/api/jobs/{job.id}/").status_code, 404)
+        self.assertEqual(self.client.get(f"/api/jobs/{job.id}/").status_code, 200)
+
+    def test_job_left_running_by_a_stopped_runner_is_failed(self):
+        UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+        UploadJob.objects.create(user=self.user, upload_file=self.upload_file)
+        stale, alive = claim_next_job(), claim_next_job()
+        UploadJob.objects.filter(id=stale.id).update(heartbeat_at=timezone.now() - datetime.timedelta(hours=1))
+
+        with self.assertLogs("api.jobs", level="WARNING"):
+            stale_status = self.client.get(f"/api/jobs/{stale.id}/").json()
+        alive_status = self.client.get(f"/api/jobs/{alive.id}/").json()
+
+        self.assertEqual(stale_status["status"], UploadJob.FAILED)
+        self.assertEqual(len(stale_status["errors"]), 1)
+        self.assertEqual(alive_status["status"], UploadJob.RUNNING)
+
+
+class StoreLactationDataTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="farmer", password="password")
+        # Cow 3 parity 1 is neither eligible nor the previous lactation of an eligible one
+        self.cleaned = herd_frame({(1, 1): 305, (1, 2): 60, (2, 1): 80, (3, 1): 70})
+        self.cleaned["Date"] = pd.Timestamp("2023-01-01") + pd.to_timedelta(self.cleaned["DIM"], unit="D")
+        self.eligible = [(1, 2), (2, 1)]
+
+    def test_stores_eligible_and_previous_lactations(self):
+        with CaptureQueriesContext(connection) as queries:
+            UploadPipeline(self.user).store_lactation_data(self.cleaned, self.eligible, self.user)
+
+        stored = LactationData.objects.values_list("lactation__cow__cow_id", "lactation__parity")
+        self.assertEqual(
+            {key: count for key, count in pd.Series(list(stored)).value_counts().items()},
+            {("1", 1): 305, ("1", 2): 60, ("2", 1): 80}
+        )
+        # Every write happens inside one atomic block
+        statements = [query["sql"].split()[0] for query in queries.captured_queries]
+        self.assertEqual(statements.count("SAVEPOINT"), 1)
+        self.assertEqual(statements[0], "SAVEPOINT")
+        self.assertEqual(statements[-1], "RELEASE")
+
+    def test_failed_insert_stores_nothing(self):
+        def insert_then_fail(records):
+            insert_lactation_data(records)
+            raise RuntimeError("Connection lost")
+
+        with mock.patch("api.pipeline.insert_lactation_data", side_effect=insert_then_fail), \
+                self.assertRaises(RuntimeError):
+            UploadPipeline(self.user).store_lactation_data(self.cleaned, self.eligible, self.user)
+
+        self.assertFalse(Cow.objects.exists())
+        self.assertFalse(Lactation.objects.exists())
+        self.assertFalse(LactationData.objects.exists())
+
+    def test_reupload_keeps_stored_records(self):
+        UploadPipeline(self.user).store_lactation_data(self.cleaned, self.eligible, self.user)
+        first_yield = LactationData.objects.get(lactation__cow__cow_id="2", dim=1).milk_yield
+
+        longer = herd_frame({(1, 1): 305, (1, 2): 90, (2, 1): 80}, seed=1)
+        longer["Date"] = pd.Timestamp("2023-01-01") + pd.to_timedelta(longer["DIM"], unit="D")
+        UploadPipeline(self.user).store_lactation_data(longer, self.eligible, self.user)
+
+        self.assertEqual(LactationData.objects.get(lactation__cow__cow_id="2", dim=1).milk_yield, first_yield)
+        self.assertEqual(LactationData.objects.filter(lactation__cow__cow_id="1", lactation__parity=2).count(), 90)
+        self.assertEqual(Lactation.objects.count(), 3)
+
+
+class SmoothingWorkersTests(SimpleTestCase):
+    def test_process_pool_matches_one_worker(self):
+        df = herd_frame({(cow, parity): 60 + (37 * cow) % 250 for cow in range(1, 13) for parity in (1, 2)})
+        # Missing yields are imputed, and a lactation of one record is kept as it is
+        df.loc[df.sample(frac=0.05, random_state=0).index, "MilkTotal"] = np.nan
+        df = pd.concat([df, pd.DataFrame({"Cow": [20], "Parity": [1], "DIM": [5], "MilkTotal": [25.0]})],
+                       ignore_index=True)
+
+        serial = smooth_lactations(df, "MilkTotal", "SmoothedMilkTotal", workers=1)
+        with mock.patch("api.processing.clean.joblib.Parallel", wraps=joblib.Parallel) as parallel:
+            pooled = smooth_lactations(df, "MilkTotal", "SmoothedMilkTotal", workers=2, min_chunk_rows=300)
+
+        parallel.assert_called_once_with(n_jobs=2)
+        pd.testing.assert_frame_equal(pooled, serial)
+
+
+class ArtifactRegistryTests(SimpleTestCase):
+    def setUp(self):
+        base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(base_dir.cleanup)
+        settings_override = override_settings(BASE_DIR=base_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.path = os.path.join(base_dir.name, "model.joblib")
+        self.registry = ArtifactRegistry({"model": "model.joblib"})
+
+    def write(self, artifact, mtime_ns):
+        joblib.dump(artifact, self.path)
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_loads_once_while_the_file_is_unchanged(self):
+        self.write({"weights": [1, 2]}, mtime_ns=1_000_000_000)
+
+        with mock.patch("api.artifacts.joblib.load", wraps=joblib.load) as load:
+            first = self.registry.get("model")
+            second = self.registry.get("model")
+
+        self.assertIs(first, second)
+        self.assertEqual(load.call_count, 1)
+
+    def test_reloads_a_changed_file(self):
+        self.write({"weights": [1, 2]}, mtime_ns=1_000_000_000)
+        old_version = self.registry.get_entry("model").version
+
+        self.write({"weights": [3, 4]}, mtime_ns=2_000_000_000)
+        entry = self.registry.get_entry("model")
+
+        self.assertEqual(entry.artifact, {"weights": [3, 4]})
+        self.assertNotEqual(entry.version, old_version)
+
+    def test_keeps_a_touched_file_with_the_same_content(self):
+        self.write({"weights": [1, 2]}, mtime_ns=1_000_000_000)
+        first = self.registry.get_entry("model")
+
+        os.utime(self.path, ns=(2_000_000_000, 2_000_000_000))
+        with mock.patch("api.artifacts.joblib.load") as load:
+            touched = self.registry.get_entry("model")
+
+        load.assert_not_called()
+        self.assertIs(touched.artifact, first.artifact)
+        self.assertEqual(touched.loaded_at, first.loaded_at)
+        self.assertEqual(touched.mtime_ns, 2_000_000_000)
+
+    def test_unknown_artifact(self):
+        with self.assertRaises(KeyError):
+            self.registry.get("forest")
+
+
+class LactationIdentityMapTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="farmer", password="password")
+
+    def test_resolving_again_creates_no_duplicates(self):
+        first = LactationIdentityMap(self.user).resolve([(1, 1), (1, 2), ("2", 1)])
+        # A later upload reads cow ids as integers or strings and adds one new lactation
+        second = LactationIdentityMap(self.user).resolve([("1", 1), (1, 2), (2, 1), (2, 2)])
+
+        self.assertEqual(Cow.objects.count(), 2)
+        self.assertEqual(Lactation.objects.count(), 4)
+        for key, lactation in first.items():
+            self.assertEqual(second[key].id, lactation.id)
+        self.assertEqual(second[("2", 2)].parity_type, Lactation.MULTIPAROUS)
+
+    def test_resolved_lactations_are_shared(self):
+        lactations = LactationIdentityMap(self.user)
+        resolved = lactations.resolve([(1, 1), (1, 2)])
+
+        with self.assertNumQueries(0):
+            self.assertIs(lactations.get(1, 2), resolved[("1", 2)])
+            self.assertIs(lactations.resolve([(1, 1)])[("1", 1)], resolved[("1", 1)])
+            self.assertEqual(lactations.lookup([(1, 1), (1, 3)]), {(1, 1): resolved[("1", 1)]})
+
+    def test_cows_are_kept_per_owner(self):
+        neighbour = User.objects.create_user(username="neighbour", password="password")
+        LactationIdentityMap(neighbour).resolve([(1, 1)])
+
+        LactationIdentityMap(self.user).resolve([(1, 1)])
+
+        self.assertEqual(Cow.objects.filter(cow_id="1").count(), 2)
+        self.assertEqual(Lactation.objects.filter(cow__owner=self.user).count(), 1)
+        self.assertIsNone(LactationIdentityMap(self.user).get(2, 1))
+
+
+class ExtensionScenarioViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="farmer", password="password")
+        neighbour = User.objects.create_user(username="neighbour", password="password")
+        for owner, cow_id, prediction_value, persistency in [
+            (self.user, "1", 30.0, -0.05), (self.user, "2", 22.0, -0.04), (neighbour, "3", 40.0, -0.1)
+        ]:
+            cow = Cow.objects.create(cow_id=cow_id, owner=owner)
+            lactation = Lactation.objects.create(cow=cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+            Prediction.objects.create(lactation=lactation, prediction_value=prediction_value,
+                                      approximate_persistency=persistency, days_to_target=0, plot_path="")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_defaults(self):
+        response = self.client.get("/api/predictions/scenario/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["scenario"], {"target_yield": 25.0, "cycle_length": 21, "num_cycles": 10})
+        predictions = response.json()["predictions"]
+        self.assertEqual([prediction["cow_id"] for prediction in predictions], ["1", "2"])
+        self.assertEqual(len(predictions[0]["extend_cycles"]), 10)
+        self.assertEqual(predictions[0]["days_to_target"], 405)
+
+    def test_scenario_recomputes_the_stored_predictions(self):
+        response = self.client.get("/api/predictions/scenario/",
+                                   {"target_yield": 20, "cycle_length": 18, "num_cycles": 3})
+
+        self.assertEqual(response.status_code, 200)
+        expected = extrapolate([30.0, 22.0], [-0.05, -0.04], target_yield=20, cycle_length=18, num_cycles=3)
+        predictions = response.json()["predictions"]
+        np.testing.assert_allclose([prediction["extend_cycles"] for prediction in predictions],
+                                   expected["extend_cycles"])
+        self.assertEqual([prediction["days_to_target"] for prediction in predictions],
+                         expected["days_to_target"].tolist())
+
+    def test_bounds(self):
+        for params in [
+            {"target_yield": 0}, {"cycle_length": 1}, {"cycle_length": 365}, {"num_cycles": 1}, {"num_cycles": 50}
+        ]:
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get("/api/predictions/scenario/", params).status_code, 200)
+
+        for params in [
+            {"target_yield": -1}, {"target_yield": "high"}, {"cycle_length": 0}, {"cycle_length": 366},
+            {"num_cycles": 0}, {"num_cycles": 51}
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get("/api/predictions/scenario/", params)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(list(response.json()), list(params))
+
+    def test_empty_herd(self):
+        Prediction.objects.filter(lactation__cow__owner=self.user).delete()
+
+        response = self.client.get("/api/predictions/scenario/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["predictions"], [])
+
+
+class PredictionPlotViewTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.media_root = media_root.name
+
+        self.user = User.objects.create_user(username="farmer", password="password")
+        cow = Cow.objects.create(cow_id="1", owner=self.user)
+        self.lactation = Lactation.objects.create(cow=cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+        LactationData.objects.bulk_create([
+            LactationData(lactation=self.lactation, dim=dim, date=datetime.date(2023, 1, 1) + datetime.timedelta(days=dim),
+                          milk_yield=35.0)
+            for dim in range(1, 61)
+        ])
+        self.score(32.0)
+        self.url = f"/api/predictions/{self.lactation.id}/plot/"
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def score(self, prediction_value):
+        prediction = Prediction(lactation=self.lactation, prediction_value=prediction_value,
+                                approximate_persistency=-0.05, days_to_target=445, plot_path="")
+        upsert(Prediction, [prediction], unique_fields=["lactation", "prediction_type"],
+               update_fields=PREDICTION_UPDATE_FIELDS)
+
+    def get_plot(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        if response.status_code == 200:
+            self.assertEqual(response["Content-Type"], "image/png")
+            self.assertTrue(b"".join(response.streaming_content).startswith(b"\x89PNG"))
+            response.close()
+        return response
+
+    def plot_files(self):
+        return os.listdir(os.path.join(self.media_root, f"extrapolation_plots/user_{self.user.id}"))
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.get_plot()["ETag"]
+
+        with mock.patch("api.views.get_plot") as get_plot:
+            response = self.get_plot(if_none_match=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        get_plot.assert_not_called()
+
+    def test_rescoring_changes_the_etag(self):
+        old_etag = self.get_plot()["ETag"]
+        old_files = self.plot_files()
+
+        self.score(30.0)
+        response = self.get_plot(if_none_match=old_etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], old_etag)
+        self.assertEqual(self.get_plot(if_none_match=response["ETag"]).status_code, 304)
+        # The plot of the old prediction is replaced
+        self.assertEqual(len(self.plot_files()), 1)
+        self.assertNotEqual(self.plot_files(), old_files)
+
+    def test_another_users_plot(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username="neighbour", password="password"))
+
+        self.assertEqual(client.get(self.url).status_code, 404)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class DataVersionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="farmer", password="password")
+        cow = Cow.objects.create(cow_id="1", owner=self.user)
+        self.lactation = Lactation.objects.create(cow=cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_treatments(self, client=None, etag=None):
+        headers = {"if_none_match": etag} if etag else {}
+        return (client or self.client).get("/api/treatments/", headers=headers)
+
+    def test_unchanged_data_is_not_modified(self):
+        response = self.get_treatments()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Last-Modified", response)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_treatments(etag=response["ETag"])
+
+        self.assertEqual(response.status_code, 304)
+        # Answered from the data version alone
+        self.assertFalse([query for query in queries.captured_queries if "api_lactation" in query["sql"]])
+
+    def test_treatment_update_changes_the_version(self):
+        etag = self.get_treatments()["ETag"]
+
+        response = self.client.post(f"/api/update-treatment-group/{self.lactation.id}/",
+                                    {"treatment_group": "Extend 2 cycles"}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+        response = self.get_treatments(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["treatment_group"], "Extend 2 cycles")
+
+    def test_finished_upload_changes_the_version(self):
+        etag = self.get_treatments()["ETag"]
+        upload_file = UploadFile.objects.create(user=self.user, file="uploads/herd.csv")
+        UploadJob.objects.create(user=self.user, upload_file=upload_file)
+
+        def store_a_cow(path):
+            cow = Cow.objects.create(cow_id="2", owner=self.user)
+            Lactation.objects.create(cow=cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+
+        with mock.patch("api.jobs.UploadPipeline.run", side_effect=store_a_cow):
+            run_job(claim_next_job())
+
+        response = self.get_treatments(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([treatment["cow_id"] for treatment in response.json()], ["1", "2"])
+
+    def test_versions_are_per_user(self):
+        etag = self.get_treatments()["ETag"]
+        neighbour = APIClient()
+        neighbour.force_authenticate(User.objects.create_user(username="neighbour", password="password"))
+
+        response = self.get_treatments(client=neighbour, etag=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+    def test_deleted_account_versions_are_not_reused(self):
+        etag = self.get_treatments()["ETag"]
+        user_id = self.user.id
+
+        response = self.client.delete("/api/profile/delete/", {"confirm": True}, format="json")
+        self.assertEqual(response.status_code, 200)
+        # A new account that gets the same id
+        self.client.force_authenticate(User.objects.create_user(id=user_id, username="heir", password="password"))
+
+        response = self.get_treatments(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "responses-test"}},
+    UPLOAD_JOB_RUNNER="worker"
+)
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="farmer", password="password")
+        self.lactation = self.create_lactation(self.user, "1")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        neighbour = User.objects.create_user(username="neighbour", password="password")
+        self.create_lactation(neighbour, "2")
+        self.neighbour = APIClient()
+        self.neighbour.force_authenticate(neighbour)
+
+    @staticmethod
+    def create_lactation(owner, cow_id):
+        cow = Cow.objects.create(cow_id=cow_id, owner=owner)
+        return Lactation.objects.create(cow=cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+
+    def get_treatments(self, client=None):
+        response = (client or self.client).get("/api/treatments/")
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_repeated_request_is_served_from_the_cache(self):
+        self.assertEqual(self.get_treatments()["X-Cache"], "MISS")
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_treatments()
+
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertEqual(response.json()[0]["cow_id"], "1")
+        self.assertFalse([query for query in queries.captured_queries if "api_lactation" in query["sql"]])
+        self.assertEqual(
+            {key: cache_stats()[key] for key in ("hits", "misses", "hit_rate")},
+            {"hits": 1, "misses": 1, "hit_rate": 0.5}
+        )
+
+    def test_cached_pages_are_never_served_to_another_user(self):
+        self.get_treatments()
+        self.get_treatments()
+
+        response = self.get_treatments(self.neighbour)
+
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual([treatment["cow_id"] for treatment in response.json()], ["2"])
+        self.assertEqual(cache_stats()["misses"], 2)
+
+    def test_treatment_update_invalidates_only_that_user(self):
+        self.get_treatments()
+        self.get_treatments(self.neighbour)
+
+        self.client.post(f"/api/update-treatment-group/{self.lactation.id}/",
+                         {"treatment_group": "Extend 1 cycle"}, format="json")
+
+        response = self.get_treatments()
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response.json()[0]["treatment_group"], "Extend 1 cycle")
+        self.assertEqual(self.get_treatments(self.neighbour)["X-Cache"], "HIT")
+
+    def test_upload_invalidates_the_cache(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.get_treatments()
+
+        upload = SimpleUploadedFile("herd.csv", b"Cow,Parity,Date,DIM,MilkTotal\n", content_type="text/csv")
+        with override_settings(MEDIA_ROOT=media_root.name):
+            response = self.client.post("/api/data/upload/", {"file": upload}, format="multipart")
+        self.assertEqual(response.status_code, 202)
+
+        self.assertEqual(self.get_treatments()["X-Cache"], "MISS")
+
+    def test_deleted_account_pages_are_dropped(self):
+        self.get_treatments()
+        user_id = self.user.id
+
+        self.client.delete("/api/profile/delete/", {"confirm": True}, format="json")
+        self.client.force_authenticate(User.objects.create_user(id=user_id, username="heir", password="password"))
+
+        response = self.get_treatments()
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response.json(), [])
+
+    def test_stats_are_for_staff(self):
+        self.get_treatments()
+        self.assertEqual(self.client.get("/api/cache/stats/").status_code, 403)
+
+        staff = APIClient()
+        staff.force_authenticate(User.objects.create_user(username="staff", password="password", is_staff=True))
+        response = staff.get("/api/cache/stats/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["misses"], 1)
+
+
+class LactationDataStreamingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="farmer", password="password")
+        neighbour = User.objects.create_user(username="neighbour", password="password")
+        # More records than one chunk of the response
+        records = []
+        for owner, cow_id, parity in [(self.user, str(cow), parity) for cow in range(1, 5) for parity in (1, 2)] \
+                + [(neighbour, "1", 1)]:
+            cow, _ = Cow.objects.get_or_create(cow_id=cow_id, owner=owner)
+            lactation = Lactation.objects.create(
+                cow=cow, parity=parity,
+                parity_type=Lactation.PRIMIPAROUS if parity == 1 else Lactation.MULTIPAROUS
+            )
+            records += [
+                LactationData(lactation=lactation, dim=dim, milk_yield=20.0 + dim / 8,
+                              date=datetime.date(2023, 1, 1) + datetime.timedelta(days=dim))
+                for dim in range(1, 306)
+            ]
+        LactationData.objects.bulk_create(records)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def expected_rows(self, **filters):
+        return list(
+            LactationData.objects.filter(lactation__cow__owner=self.user, **filters)
+            .order_by("lactation_id", "dim")
+            .values_list("lactation__cow__cow_id", "lactation__parity", "dim", "date", "milk_yield")
+        )
+
+    def stream(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        chunks = list(response.streaming_content)
+        return chunks, b"".join(chunks).decode()
+
+    def test_json(self):
+        chunks, content = self.stream(self.client.get("/api/lactation-data/"))
+
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(
+            [tuple(record.values()) for record in json.loads(content)],
+            [(cow_id, parity, dim, date.isoformat(), milk_yield)
+             for cow_id, parity, dim, date, milk_yield in self.expected_rows()]
+        )
+        self.assertEqual(list(json.loads(content)[0]), ["cow_id", "parity", "dim", "date", "milk_yield"])
+
+    def test_csv(self):
+        response = self.client.get("/api/lactation-data/", {"format": "csv"})
+        _, content = self.stream(response)
+
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="lactation_data.csv"')
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], ["cow_id", "parity", "dim", "date", "milk_yield"])
+        self.assertEqual(rows[1:], [
+            [cow_id, str(parity), str(dim), date.isoformat(), repr(milk_yield)]
+            for cow_id, parity, dim, date, milk_yield in self.expected_rows()
+        ])
+
+    def test_filters(self):
+        _, content = self.stream(self.client.get("/api/lactation-data/", {"cow_id": "1", "parity": 2}))
+
+        records = json.loads(content)
+        self.assertEqual(len(records), 305)
+        self.assertEqual({(record["cow_id"], record["parity"]) for record in records}, {("1", 2)})
+
+    def test_no_records(self):
+        LactationData.objects.filter(lactation__cow__owner=self.user).delete()
+
+        self.assertEqual(self.stream(self.client.get("/api/lactation-data/"))[1], "[]")
+        self.assertEqual(
+            self.stream(self.client.get("/api/lactation-data/", {"format": "csv"}))[1],
+            "cow_id,parity,dim,date,milk_yield\r\n"
+        )
+
+    async def test_streams_under_asgi(self):
+        headers = {"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+
+        response = await self.async_client.get("/api/lactation-data/", {"format": "csv"}, headers=headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(len(content.splitlines()), 1 + 8 * 305)
+
+
+class LactationCurveEncodingTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="farmer", password="password")
+        self.milk_yields = {}
+        for cow_id, parity, days in [("1", 1, 305), ("1", 2, 0), ("7", 3, 42)]:
+            cow, _ = Cow.objects.get_or_create(cow_id=cow_id, owner=user)
+            lactation = Lactation.objects.create(cow=cow, parity=parity, parity_type=Lactation.MULTIPAROUS)
+            self.milk_yields[lactation.id] = 20.1 + np.sin(np.arange(days)) * 3.3
+            LactationData.objects.bulk_create([
+                LactationData(lactation=lactation, dim=dim, milk_yield=milk_yield,
+                              date=datetime.date(2023, 1, 1) + datetime.timedelta(days=dim))
+                for dim, milk_yield in enumerate(self.milk_yields[lactation.id], start=1)
+            ])
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def decode_binary(self, content: bytes) -> list:
+        # Read back as a client would, following the layout of encode_curves_binary
+        self.assertEqual(content[:4], CURVES_MAGIC)
+        (header_length,) = struct.unpack_from("<I", content, 4)
+        header = json.loads(content[8:8 + header_length])
+        position = 8 + header_length
+        offsets = np.frombuffer(content, "<u4", len(header["lactation_id"]) + 1, position)
+        position += offsets.nbytes
+        dims = np.frombuffer(content, "<i4", offsets[-1], position)
+        milk_yields = np.frombuffer(content, "<f4", offsets[-1], position + dims.nbytes)
+        self.assertEqual(position + dims.nbytes + milk_yields.nbytes, len(content))
+        return [
+            {
+                "lactation_id": lactation_id, "cow_id": cow_id, "parity": parity,
+                "dim": dims[start:end].tolist(), "milk_yield": milk_yields[start:end],
+            }
+            for lactation_id, cow_id, parity, start, end in zip(
+                header["lactation_id"], header["cow_id"], header["parity"], offsets[:-1], offsets[1:]
+            )
+        ]
+
+    def assert_round_trip(self, curves):
+        self.assertEqual(
+            [(curve["lactation_id"], curve["cow_id"], curve["parity"]) for curve in curves],
+            [(lactation_id, cow_id, parity) for lactation_id, (cow_id, parity)
+             in zip(self.milk_yields, [("1", 1), ("1", 2), ("7", 3)])]
+        )
+        for curve, milk_yields in zip(curves, self.milk_yields.values()):
+            self.assertEqual(curve["dim"], list(range(1, len(milk_yields) + 1)))
+            # Yields are sent as float32
+            np.testing.assert_array_equal(curve["milk_yield"], milk_yields.astype(np.float32))
+
+    def test_binary(self):
+        response = self.client.get("/api/lactation-curves/", {"format": "bin"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+        (header_length,) = struct.unpack_from("<I", response.content, 4)
+        self.assertEqual(header_length % 4, 0)
+        self.assert_round_trip(self.decode_binary(response.content))
+
+    @skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_arrow(self):
+        response = self.client.get("/api/lactation-curves/", {"format": "arrow"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/vnd.apache.arrow.stream")
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        self.assertEqual(table.schema.field("milk_yield").type, pyarrow.list_(pyarrow.float32()))
+        self.assert_round_trip(table.to_pylist())
+
+    def test_binary_matches_json(self):
+        curves = self.client.get("/api/lactation-curves/", {"max_points": 20}).json()
+        response = self.client.get("/api/lactation-curves/", {"max_points": 20, "format": "bin"})
+
+        decoded = self.decode_binary(response.content)
+        self.assertEqual([curve["dim"] for curve in decoded], [curve["dim"] for curve in curves])
+        for binary_curve, json_curve in zip(decoded, curves):
+            np.testing.assert_allclose(binary_curve["milk_yield"], json_curve["milk_yield"], rtol=1e-6)
+
+    def test_errors_are_json(self):
+        response = self.client.get("/api/lactation-curves/", {"max_points": 2, "format": "bin"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertIn("max_points", response.json())
+
+
+class HerdSummaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="farmer", password="password")
+        rng = np.random.default_rng(0)
+        # One lactation alone in its treatment group, and repeated days to target
+        groups = ["No group"] * 24 + ["Extend 2 cycles"] * 15 + ["Extend 5 cycles"]
+        for number, treatment_group in enumerate(groups):
+            parity = 1 + number % 3
+            cow = Cow.objects.create(cow_id=str(number), owner=self.user)
+            lactation = Lactation.objects.create(
+                cow=cow, parity=parity, treatment_group=treatment_group,
+                parity_type=Lactation.PRIMIPAROUS if parity == 1 else Lactation.MULTIPAROUS
+            )
+            Prediction.objects.create(
+                lactation=lactation, prediction_value=rng.normal(30, 5),
+                approximate_persistency=rng.normal(-0.05, 0.02), days_to_target=int(rng.integers(300, 330)),
+                plot_path=""
+            )
+        self.predictions = Prediction.objects.filter(lactation__cow__owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def values(self, metric, **filters):
+        return np.array(self.predictions.filter(**filters).values_list(metric, flat=True), dtype=float)
+
+    def group_filters(self, group):
+        return {"lactation__parity_type": group["parity_type"], "lactation__treatment_group": group["treatment_group"]}
+
+    def test_percentiles_match_numpy(self):
+        summary = herd_summary(self.predictions)
+
+        for metric in SUMMARY_METRICS:
+            with self.subTest(metric=metric):
+                np.testing.assert_allclose(
+                    list(summary["herd"]["metrics"][metric]["percentiles"].values()),
+                    np.percentile(self.values(metric), PERCENTILES)
+                )
+                for group in summary["groups"]:
+                    np.testing.assert_allclose(
+                        list(group["metrics"][metric]["percentiles"].values()),
+                        np.percentile(self.values(metric, **self.group_filters(group)), PERCENTILES)
+                    )
+
+    def test_histograms_match_numpy(self):
+        summary = herd_summary(self.predictions, bins=7)
+
+        for metric in SUMMARY_METRICS:
+            with self.subTest(metric=metric):
+                histogram = summary["herd"]["metrics"][metric]["histogram"]
+                values = self.values(metric)
+                self.assertEqual(len(histogram["counts"]), 7)
+                self.assertEqual(histogram["counts"], np.histogram(values, bins=histogram["edges"])[0].tolist())
+                # The largest value is counted in the last bin
+                self.assertEqual(histogram["edges"][-1], values.max())
+                self.assertGreater(histogram["counts"][-1], 0)
+                # Groups are binned on the herd's edges, with zeros for the bins they have no values in
+                for group in summary["groups"]:
+                    self.assertEqual(group["metrics"][metric]["histogram"]["edges"], histogram["edges"])
+                    group_values = self.values(metric, **self.group_filters(group))
+                    self.assertEqual(
+                        group["metrics"][metric]["histogram"]["counts"],
+                        np.histogram(group_values, bins=histogram["edges"])[0].tolist()
+                    )
+
+    def test_groups(self):
+        groups = herd_summary(self.predictions)["groups"]
+
+        self.assertEqual(sum(group["count"] for group in groups), 40)
+        single = [group for group in groups if group["treatment_group"] == "Extend 5 cycles"]
+        self.assertEqual(len(single), 1)
+        metric = single[0]["metrics"]["prediction_value"]
+        self.assertEqual(set(metric["percentiles"].values()), {metric["min"]})
+        self.assertEqual(sum(metric["histogram"]["counts"]), 1)
+
+    def test_single_value_gets_one_bin(self):
+        summary = herd_summary(self.predictions.filter(lactation__treatment_group="Extend 5 cycles"))
+
+        histogram = summary["herd"]["metrics"]["days_to_target"]["histogram"]
+        value = summary["herd"]["metrics"]["days_to_target"]["min"]
+        self.assertEqual(histogram, {"edges": [value - 0.5, value + 0.5], "counts": [1]})
+
+    def test_metrics_without_values(self):
+        # No metric field of a prediction is nullable, so the metrics of an
+        # empty herd are the only ones aggregated over NULL alone
+        summary = herd_summary(Prediction.objects.none())
+
+        self.assertEqual(summary["herd"]["count"], 0)
+        self.assertEqual(summary["groups"], [])
+        for metric in SUMMARY_METRICS:
+            self.assertEqual(summary["herd"]["metrics"][metric], {
+                "count": 0, "mean": None, "min": None, "max": None,
+                "percentiles": {f"p{percentile}": None for percentile in PERCENTILES},
+                "histogram": {"edges": [], "counts": []},
+            })
+
+    def test_endpoint(self):
+        neighbour = User.objects.create_user(username="neighbour", password="password")
+        cow = Cow.objects.create(cow_id="0", owner=neighbour)
+        lactation = Lactation.objects.create(cow=cow, parity=1, parity_type=Lactation.PRIMIPAROUS)
+        Prediction.objects.create(lactation=lactation, prediction_value=90.0, approximate_persistency=0.0,
+                                  days_to_target=500, plot_path="")
+
+        response = self.client.get("/api/predictions/summary/", {"bins": 4})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["percentiles"], PERCENTILES)
+        self.assertEqual(response.json()["herd"]["count"], 40)
+        self.assertEqual(len(response.json()["herd"]["metrics"]["prediction_value"]["histogram"]["counts"]), 4)
+        self.assertLess(response.json()["herd"]["metrics"]["prediction_value"]["max"], 90.0)
+        self.assertEqual(self.client.get("/api/predictions/summary/", {"bins": 0}).status_code, 400)
@@ -5,10 +5,18 @@ urlpatterns = [
     path("data/upload/", views.DataUploadView.as_view(), name="data-upload"),
     path("data/files/", views.ListUserFilesView.as_view(), name="list-user-files"),
     path("data/file/<str:filename>/", views.GetUserFileView.as_view(), name="get-user-file"),
+    path("jobs/<int:job_id>/", views.UploadJobDetailView.as_view(), name="job-detail"),
+    path("models/", views.ModelVersionsView.as_view(), name="model-versions"),
+    path("cache/stats/", views.ResponseCacheStatsView.as_view(), name="response-cache-stats"),
     path('predictions/', views.PredictionsListView.as_view(), name='predictions-list'),
+    path('predictions/<int:lactation_id>/plot/', views.PredictionPlotView.as_view(), name='prediction-plot'),
+    path('predictions/scenario/', views.ExtensionScenarioView.as_view(), name='predictions-scenario'),
+    path('predictions/summary/', views.HerdSummaryView.as_view(), name='predictions-summary'),
     path('treatments/', views.TreatmentListView.as_view(), name='treatments-list'),
     path('update-treatment-group/<int:lactation_id>/', views.UpdateTreatmentGroupView.as_view(), name='update_treatment_group'),
+    path('update-treatment-groups/', views.BulkUpdateTreatmentGroupView.as_view(), name='bulk_update_treatment_groups'),
     path('lactation-data/', views.LactationDataListView.as_view(), name="lactation-data"),
+    path('lactation-curves/', views.LactationCurveListView.as_view(), name="lactation-curves"),
     path('multiparous-features/', views.MultiparousFeaturesListView.as_view(), name="multiparous-features"),
     path('primiparous-features/', views.PrimiparousFeaturesListView.as_view(), name="primiparous-features"),
     path('profile/info/', views.CurrentUserView.as_view(), name='user-info'),
@@ -0,0 +1,81 @@
+"""Per-user data versions and conditional GET for the read endpoints.
+
+Every change to a user's herd bumps their DataVersion. Read views tag their
+responses with it as ETag and Last-Modified, and a request whose
+If-None-Match still matches is answered with 304 Not Modified without
+querying the herd.
+"""
+import time
+from functools import wraps
+
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .models import DataVersion
+
+
+def _clock_version() -> int:
+    # Versions start from the clock so that a user id reused after an account
+    # is deleted never repeats an ETag of the deleted account
+    return time.time_ns() // 1_000_000
+
+
+def get_data_version(user_id: int) -> DataVersion:
+    """Return a user's data version, creating it on first use."""
+    data_version = DataVersion.objects.filter(user_id=user_id).first()
+    if data_version is None:
+        data_version, _ = DataVersion.objects.get_or_create(
+            user_id=user_id,
+            defaults={"version": _clock_version(), "updated_at": timezone.now()}
+        )
+    return data_version
+
+
+def bump_data_version(user_id: int):
+    """Record that a user's data changed, invalidating their ETags."""
+    now = timezone.now()
+    updated = DataVersion.objects.filter(user_id=user_id).update(
+        version=Greatest(F("version") + 1, Value(_clock_version())),
+        updated_at=now
+    )
+    if not updated:
+        DataVersion.objects.get_or_create(
+            user_id=user_id, defaults={"version": _clock_version(), "updated_at": now}
+        )
+
+
+def request_data_version(request) -> DataVersion:
+    # Looked up once per request for both the ETag and Last-Modified
+    if not hasattr(request, "_data_version"):
+        request._data_version = get_data_version(request.user.id)
+    return request._data_version
+
+
+def _data_version_etag(request, *args, **kwargs) -> str:
+    return f'"{request.user.id}.{request_data_version(request).version}"'
+
+
+def _data_version_last_modified(request, *args, **kwargs):
+    return request_data_version(request).updated_at
+
+
+def conditional_on_data_version(view_func):
+    """Answer a GET with 304 when the user's data has not changed since the
+    version in If-None-Match or If-Modified-Since, and tag fresh responses
+    with the current version. Responses are marked for revalidation so a
+    browser never shows data from before an upload.
+    """
+    conditional_view = condition(
+        etag_func=_data_version_etag, last_modified_func=_data_version_last_modified
+    )(view_func)
+
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    return wrapped_view
@@ -2,39 +2,42 @@ import logging
 import os
 import traceback
 
+import numpy as np
+
 from django.conf import settings
 from django.http import FileResponse
 from django.shortcuts import render
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import HttpResponseNotModified, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import get_object_or_404
-from django.db.models import Avg
 from django.contrib.auth import update_session_auth_hash
+from django.db import transaction
+from django.db.models import Case, CharField, Exists, OuterRef, Value, When
+from django.utils.decorators import method_decorator
 
 from rest_framework import generics, status
 from api.serializers import UserSerializer
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, AllowAny
 from rest_framework.views import APIView
 from rest_framework.parsers import MultiPartParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
-import joblib
-import sklearn
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-
-from .models import UploadFile, Cow, Lactation, LactationData, MultiparousFeatures, Prediction, PrimiparousFeatures
-from .serializers import LactationDataSerializer, MultiparousFeaturesSerializer, PrimiparousFeaturesSerializer, CurrentUserSerializer, ChangePasswordSerializer, ChangeEmailSerializer
-from .processing.validate import validate
-from .processing.clean import clean
-from .processing.multi_features import multi_feature_construction
-from .processing.primi_features import primi_feature_construction
-
-matplotlib.use('Agg')
+
+from .models import UploadFile, UploadJob, Cow, Lactation, LactationData, MultiparousFeatures, Prediction, PrimiparousFeatures
+from .serializers import MultiparousFeaturesSerializer, PrimiparousFeaturesSerializer, CurrentUserSerializer, ChangePasswordSerializer, ChangeEmailSerializer, UploadJobSerializer, ExtensionScenarioSerializer, PredictionListQuerySerializer, LactationDataQuerySerializer, LactationCurveQuerySerializer, HerdSummaryQuerySerializer, BulkTreatmentGroupSerializer
+from .jobs import enqueue_upload, fail_stale_jobs
+from .artifacts import registry
+from .curves import curve_renderers, get_curves
+from .pagination import KeysetPagination
+from .plots import get_plot, plot_version
+from .processing.downsampling import downsample_rows
+from .processing.extrapolation import extrapolate
+from .response_cache import cache_stats, cached_response, invalidate_user_cache
+from .streaming import ROWS_PER_CHUNK, CSVRenderer, csv_chunks, json_array_chunks, streaming_response
+from .summary import herd_summary
+from .versions import bump_data_version, conditional_on_data_version
+
 logger = logging.getLogger(__name__)
 
 class CreateUserView(generics.CreateAPIView):
@@ -103,32 +106,15 @@ class DeleteUserView(generics.DestroyAPIView):
         if not confirm:
             return Response({'detail': 'Account deletion not confirmed.'}, status=status.HTTP_400_BAD_REQUEST)
 
+        user_id = user.id
         user.delete()
+        invalidate_user_cache(user_id)
         return Response({'message': 'Account deleted successfully.'}, status=status.HTTP_200_OK)
 
 
 class DataUploadView(APIView):
     parser_classes = [MultiPartParser]  # To handle file uploads
     permission_classes = [IsAuthenticated]  # Ensure user is authenticated
-
-    # def send_progress_message(self, user_id, message):
-    #     try:
-    #         channel_layer = get_channel_layer()
-    #         # Create a unique group name for this user
-    #         group_name = f"user_{user_id}_progress"
-            
-    #         # Send the message
-    #         async_to_sync(channel_layer.group_send)(
-    #             group_name,
-    #             {
-    #                 "type": "progress.message",  # This must match a method name in your consumer
-    #                 "message": {
-    #                     "progress": message
-    #                 }
-    #             }
-    #         )
-    #     except Exception as e:
-    #         print(f"Error sending progress message: {str(e)}")
     
     def post(self, request, *args, **kwargs):
         logger.info("=== Starting File Upload ===")
@@ -137,9 +123,6 @@ class DataUploadView(APIView):
         logger.info(f"POST data: {request.POST}")
         
         try:
-            # Send initial progress
-            # self.send_progress_message(request.user.id, "Starting upload...")
-            
             file_obj = request.FILES.get("file")
             if not file_obj:
                 logger.error("No file provided in request")
@@ -158,75 +141,29 @@ class DataUploadView(APIView):
                     "message": "File already exists. Please rename the file."
                 }, status=status.HTTP_409_CONFLICT)  
 
-            # Save and load uploaded file
+            # Save uploaded file and queue it for processing
             try:
                 logger.info("Saving uploaded file...")
                 uploaded_file = UploadFile(user=request.user, file=file_obj)
                 uploaded_file.save()
-                file_path = uploaded_file.file.path
-                logger.info(f"File saved to: {file_path}")
-                
-                logger.info("Reading CSV file...")
-                data = pd.read_csv(file_path)
-                logger.info(f"CSV loaded successfully. Shape: {data.shape}")
+                logger.info(f"File saved to: {uploaded_file.file.path}")
+                job = enqueue_upload(uploaded_file)
+                # Also invalidated when the job finishes, in the process that runs it
+                invalidate_user_cache(request.user.id)
+                logger.info(f"Queued upload job {job.id}")
 
             except Exception as e:
-                # self.send_progress_message(request.user.id, f"Error loading file: {str(e)}")
-                logger.error(f"Error processing uploaded file: {str(e)}")
+                logger.error(f"Error saving uploaded file: {str(e)}")
                 logger.error(traceback.format_exc())
                 return Response(
-                    {"message": f"Error processing file: {str(e)}"}, 
+                    {"message": f"Error saving file: {str(e)}"}, 
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
 
-            # Process uploaded file
-            try:
-                # self.send_progress_message(request.user.id, "Validating data...")
-                logger.info("Starting data validation...")
-
-                validated_data, eligible_lactations, validation_messages = validate(data)
-                # for msg in validation_messages:
-                #     self.send_progress_message(request.user.id, msg)
-                logger.info(f"Validation complete. Messages: {validation_messages}")
-
-                # self.send_progress_message(request.user.id, "Cleaning data...")
-                logger.info("Starting data cleaning...")
-
-                cleaned_data, cleaning_messages = clean(validated_data)
-                # for msg in cleaning_messages:
-                #     self.send_progress_message(request.user.id, msg)
-
-                # self.send_progress_message(request.user.id, "Storing lactation data...")
-                logger.info("Storing lactation data...")
-                self.store_lactation_data(
-                    cleaned_data, eligible_lactations, request.user
-                )
-
-                # self.send_progress_message(request.user.id, "Creating input features...")
-                logger.info("Creating input features...")
-                self.create_input_features(
-                    eligible_lactations, cleaned_data, request.user
-                )
-
-                # self.send_progress_message(request.user.id, "Making predictions...")
-                logger.info("Making predictions...")
-                self.make_prediction(eligible_lactations, request)
-
-                # self.send_progress_message(request.user.id, "Processing complete!")
-
-            except ValueError as e:
-                error_traceback = traceback.format_exc()
-                logger.error(f"Error in data processing: {str(e)}")
-                logger.error(error_traceback)
-                return Response(
-                    {"message": f"Error processing file: {str(e)}"}, 
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-            
-            logger.info("=== File Processing Complete ===")
             return Response({
-                "message": "File processed and data stored successfully! Predictions have been made!",
-            }, status=status.HTTP_200_OK)
+                "message": "File uploaded successfully! Processing has started.",
+                "job_id": job.id,
+            }, status=status.HTTP_202_ACCEPTED)
             
         except Exception as e:
             logger.error("=== Unexpected Error ===")
@@ -236,455 +173,20 @@ class DataUploadView(APIView):
                 {"message": f"Unexpected error: {str(e)}"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-    
-    def store_lactation_data(
-        self, 
-        cleaned_data: pd.DataFrame, 
-        eligible_lactations: list, 
-        user
-    ):
-        """Store lactation data for eligible cows and their current and previous lactations.
-        
-        Args:
-            cleaned_data (pd.DataFrame): The full cleaned dataset.
-            eligible_lactations (list): List of tuples containing (Cow ID, Parity) for eligible lactations.
-            user: The user uploading the data.
-        """
-        for cow_id, parity in eligible_lactations:
-            subset = cleaned_data[(cleaned_data['Cow'] == cow_id) & 
-                                (cleaned_data['Parity'].isin([parity, parity - 1]))]
-            
-            if subset.empty:
-                # self.send_progress_message(
-                #     user.id, 
-                #     f"Warning: No data found for Cow {cow_id}, Parity {parity}. Skipping..."
-                # )
-                continue
-
-            # Process and store each row in the subset
-            for _, row in subset.iterrows():
-                cow, _ = Cow.objects.get_or_create(cow_id=row['Cow'], owner=user)
-
-                lactation, _ = Lactation.objects.get_or_create(
-                    cow=cow, parity=row['Parity'], 
-                    parity_type=Lactation.PRIMIPAROUS if row['Parity'] == 1 else Lactation.MULTIPAROUS
-                )
-                
-                try:
-                    LactationData.objects.get_or_create(
-                        lactation=lactation,
-                        dim=row['DIM'],
-                        defaults={
-                            'date': row['Date'],
-                            'milk_yield': row['MilkTotal']
-                        }
-                    )
-
-                except LactationData.DoesNotExist:
-                    print(f"LactationData not found for Lactation {lactation} and DIM {row['DIM']}")
-                    continue
-
-    def create_input_features(self, eligible_lactations: list, cleaned_data: pd.DataFrame, user):
-        for cow_id, parity in eligible_lactations:
-            if parity > 1:
-                current_lactation = cleaned_data[
-                    (cleaned_data['Cow'] == cow_id) & (cleaned_data['Parity'] == parity)
-                    ]
-        
-                previous_lactation = cleaned_data[
-                    (cleaned_data['Cow'] == cow_id) & (cleaned_data['Parity'] == parity - 1)
-                    ]
-        
-                # Skip if no current lactation data exists
-                if current_lactation.empty:
-                    # self.send_progress_message(
-                    #     user_id=user.id,
-                    #     message=f"No data for current lactation of Cow {cow_id}, Parity {parity}. Skipping..."
-                    # )
-                    continue
-
-                features = multi_feature_construction(
-                    current_lactation, previous_lactation
-                    )
-            
-            elif parity == 1:
-                current_lactation = cleaned_data[
-                    (cleaned_data['Cow'] == cow_id) & (cleaned_data['Parity'] == parity)
-                    ]
-                
-                # Skip if no current lactation data exists
-                if current_lactation.empty:
-                    # self.send_progress_message(
-                    #     user_id=user.id,
-                    #     message=f"No data for current lactation of Cow {cow_id}, Parity {parity}. Skipping..."
-                    # )
-                    continue
-
-                features = primi_feature_construction(current_lactation)
-
-
-            if features.empty:
-                # self.send_progress_message(
-                #     user_id=user.id,
-                #     message=f"Error creating features for Cow {cow_id} and Parity {parity}. Skipping..."
-                # )
-                continue
 
-            try:
-                lactation = Lactation.objects.filter(
-                    cow__cow_id=cow_id, parity=parity, cow__owner=user
-                    ).first()
-                
-            except Lactation.DoesNotExist:
-                # self.send_progress_message(
-                #     user_id=user.id,
-                #     message=f"Lactation for Cow {cow_id} and Parity {parity} not found. Skipping..."
-                # )
-                continue
-            
-            self.store_features(lactation, parity, features)
-            
-    def store_features(self, lactation, parity, features_df: pd.DataFrame):
-        """
-        Store the multiparous features for a given lactation.
-
-        Args:
-            lactation: The Lactation object.
-            features_df: A DataFrame containing the calculated features.
-        """
-        if parity > 1:
-            features, created = MultiparousFeatures.objects.update_or_create(
-                lactation=lactation,
-        defaults={
-            'parity': features_df['Parity'].iloc[0],
-            'milk_total_1_10': features_df['MilkTotal_1-10'].iloc[0],
-            'milk_total_11_20': features_df['MilkTotal_11-20'].iloc[0],
-            'milk_total_21_30': features_df['MilkTotal_21-30'].iloc[0],
-            'milk_total_31_40': features_df['MilkTotal_31-40'].iloc[0],
-            'milk_total_41_50': features_df['MilkTotal_41-50'].iloc[0],
-            'milk_total_51_60': features_df['MilkTotal_51-60'].iloc[0],
-            'month_sin': features_df['month_sin'].iloc[0],
-            'month_cos': features_df['month_cos'].iloc[0],
-            'prev_a': features_df['prev_a'].iloc[0],  # Added
-            'prev_305_my': features_df['prev_305_my'].iloc[0],
-            'prev_lact_length': features_df['prev_lact_length'].iloc[0],  # Updated to match model
-            'prev_my_end': features_df['prev_my_end'].iloc[0],  # Added
-            'prev_days_to_peak': features_df['prev_days_to_peak'].iloc[0],
-            'prev_peak_my': features_df['prev_peak_my'].iloc[0],  # Added
-            'prev_persistency': features_df['prev_persistency'].iloc[0],
-            'current_a': features_df['current_a'].iloc[0],  # Added
-            'predicted_305_my': features_df['predicted_305_my'].iloc[0],
-            'current_days_to_peak': features_df['current_days_to_peak'].iloc[0],  # Added
-            'current_peak_my': features_df['current_peak_my'].iloc[0],  # Added
-            'predicted_persistency': features_df['predicted_persistency'].iloc[0],  # Added
-            'my_variance': features_df['my_variance'].iloc[0],  # Added
-            'rate_of_my_change': features_df['rate_of_my_change'].iloc[0],  # Added
-            'prev_dijkstra_b_eqn': features_df['prev_dijkstra_b_eqn'].iloc[0],  # Added
-            'prev_dijkstra_b0_eqn': features_df['prev_dijkstra_b0_eqn'].iloc[0],  # Added
-            'prev_dijkstra_c_eqn': features_df['prev_dijkstra_c_eqn'].iloc[0],  # Added
-            'current_dijkstra_b_eqn': features_df['current_dijkstra_b_eqn'].iloc[0],  # Added
-            'current_dijkstra_b0_eqn': features_df['current_dijkstra_b0_eqn'].iloc[0],  # Added
-            'current_dijkstra_c_eqn': features_df['current_dijkstra_c_eqn'].iloc[0],  # Added
-            }
-        )
 
-        elif parity == 1:
-            features, created = PrimiparousFeatures.objects.update_or_create(
-                lactation=lactation,
-                defaults={
-                    'milk_total_1_10': features_df['MilkTotal_1-10'].iloc[0],
-                    'milk_total_11_20': features_df['MilkTotal_11-20'].iloc[0],
-                    'milk_total_21_30': features_df['MilkTotal_21-30'].iloc[0],
-                    'milk_total_31_40': features_df['MilkTotal_31-40'].iloc[0],
-                    'milk_total_41_50': features_df['MilkTotal_41-50'].iloc[0],
-                    'milk_total_51_60': features_df['MilkTotal_51-60'].iloc[0],
-                    'month_sin': features_df['month_sin'].iloc[0],
-                    'month_cos': features_df['month_cos'].iloc[0],
-                    'a' : features_df['a'].iloc[0],
-                    'my_variance': features_df['my_variance'].iloc[0],  # Added
-                    'rate_of_my_change': features_df['rate_of_my_change'].iloc[0],  # Added
-                    'predicted_305_my': features_df['predicted_305_my'].iloc[0],
-                    'current_dijkstra_b_eqn': features_df['current_dijkstra_b_eqn'].iloc[0],  # Added
-                    'current_dijkstra_b_b0_eqn': features_df['current_dijkstra_b_b0_eqn'].iloc[0],  # Added
-                    'current_dijkstra_b0_eqn': features_df['current_dijkstra_b0_eqn'].iloc[0],  # Added
-                    'current_dijkstra_c_eqn': features_df['current_dijkstra_c_eqn'].iloc[0],  # Added
-                }
-            )
-
-        if created:
-            print(f"Created new features for lactation {lactation}")
-        else:
-            print(f"Updated features for lactation {lactation}")
-
-    def load_model(self, parity_type):
-        models_dir = os.path.join(settings.BASE_DIR, "api/ml_models")
-        if parity_type == Lactation.PRIMIPAROUS:
-            model_path = os.path.join(models_dir, "primi_svr.pkl")
-        elif parity_type == Lactation.MULTIPAROUS:
-            model_path = os.path.join(models_dir, "multi_voting_ensemble.pkl")
-        else:
-            raise ValueError(
-                f"load_models got an unexpected parity type: {parity_type}"
-                )
-        return joblib.load(model_path)
-
-    def get_input_features(self, lactation, parity):
-        """Gets the input features for a given lactation and parity."""
-        
-        def fetch_features(model, lactation, feature_list):
-            """Helper function to fetch features and handle exceptions."""
-            try:
-                features = model.objects.get(lactation=lactation)
-                feature_values = [
-                    getattr(features, feature) for feature in feature_list
-                    ]
-                return np.array(feature_values).reshape(1, -1)
-                       
-            except model.DoesNotExist:
-                print(f"No features found for Lactation {lactation}. Skipping...")
-                return None
-        
-        if parity > 1:
-            # Multiparous feature list
-            multiparous_feature_list = [
-                'parity', 'milk_total_1_10', 'milk_total_11_20', 'milk_total_21_30', 
-                'milk_total_31_40', 'milk_total_41_50', 'milk_total_51_60', 'month_sin', 
-                'month_cos', 'prev_a', 'prev_305_my', 'prev_lact_length', 'prev_my_end', 
-                'prev_days_to_peak', 'prev_peak_my', 'prev_persistency', 'current_a', 
-                'predicted_305_my', 'current_days_to_peak', 'current_peak_my', 
-                'predicted_persistency', 'my_variance', 'rate_of_my_change', 
-                'prev_dijkstra_b_eqn', 'prev_dijkstra_b0_eqn', 'prev_dijkstra_c_eqn', 
-                'current_dijkstra_b_eqn', 'current_dijkstra_b0_eqn', 'current_dijkstra_c_eqn'
-            ]
-            return fetch_features(MultiparousFeatures, lactation, multiparous_feature_list)
-
-        elif parity == 1:
-            # Primiparous feature list
-            primiparous_feature_list = [
-                'milk_total_1_10',
-                'milk_total_11_20',
-                'milk_total_21_30',
-                'milk_total_31_40',
-                'milk_total_41_50',
-                'milk_total_51_60',
-                'month_sin',
-                'month_cos',
-                'a',
-                'my_variance',
-                'rate_of_my_change',
-                'predicted_305_my',
-                'current_dijkstra_b_eqn',
-                'current_dijkstra_b_b0_eqn',
-                'current_dijkstra_b0_eqn',
-                'current_dijkstra_c_eqn',
-            ]
-            return fetch_features(PrimiparousFeatures, lactation, primiparous_feature_list)
-        
-        return None
-
-    def store_prediction(self, lactation, prediction, extrapolations):
-        """
-        Store the prediction in the database.
-
-        Args:
-            lactation: The Lactation object for which the prediction is made.
-            prediction: The predicted value.
-        """
-        Prediction.objects.create(
-            lactation=lactation,
-            prediction_type='regression',
-            prediction_value=prediction,
-            approximate_persistency=extrapolations["approx_persistency"],
-            extend_1_cycle=extrapolations["extend_1_cycle"],
-            extend_2_cycle=extrapolations["extend_2_cycle"],
-            extend_3_cycle=extrapolations["extend_3_cycle"],
-            extend_4_cycle=extrapolations["extend_4_cycle"],
-            extend_5_cycle=extrapolations["extend_5_cycle"],
-            extend_6_cycle=extrapolations["extend_6_cycle"],
-            extend_7_cycle=extrapolations["extend_7_cycle"],
-            extend_8_cycle=extrapolations["extend_8_cycle"],
-            extend_9_cycle=extrapolations["extend_9_cycle"],
-            extend_10_cycle=extrapolations["extend_10_cycle"],
-            days_to_target=extrapolations["days_to_target"],
-            plot_path=extrapolations["plot_path"],
-        )
-
-    def make_prediction(self, eligible_lactations, request):
-        """
-        Iterate over eligible lactations, load the correct model, retrieve the input features, 
-        make the prediction, and store the result.
-
-        Args:
-            eligible_lactations: List of (Cow ID, Parity) tuples for eligible lactations.
-        """
-        for cow_id, parity in eligible_lactations:
-            try:
-                lactation = Lactation.objects.filter(
-                    cow__cow_id=cow_id, parity=parity, cow__owner=request.user
-                    ).first()
-                model = self.load_model(lactation.parity_type)
-                input_features = self.get_input_features(lactation, parity)
-
-                if input_features is None:
-                    continue
-                
-                prediction = model.predict(input_features)[0]
-                extrapolations = self.make_extrapolation(
-                    prediction, lactation, request
-                    )
-                self.store_prediction(lactation, prediction, extrapolations)
-
-            except Lactation.DoesNotExist:
-                print(f"Lactation for Cow {cow_id}, Parity {parity} not found.")
-                continue
-
-    def make_extrapolation(self, predicted_305_my, lactation, request):
-        
-        def predict_cycle_my(day_305_my, persistency, num_cycles):
-            return day_305_my + (persistency * (21 * num_cycles))
+class UploadJobDetailView(generics.RetrieveAPIView):
+    serializer_class = UploadJobSerializer
+    permission_classes = [IsAuthenticated]
+    lookup_url_kwarg = "job_id"
 
-        def predict_days_to_target(day_305_my, persistency):
-            if day_305_my > 25:
-                return 305 + int((25 - day_305_my) / persistency)
-            else:
-                return 0
+    def get_queryset(self):
+        return UploadJob.objects.filter(user=self.request.user).select_related("upload_file")
 
-        def plot_days_to_target(lactation_data, predicted_305_my, approx_persistency, last_dim, days_to_target, cow_id, parity, request):
-            """
-            Creates and saves a plot showing Milk Yield vs DIM, along with predictions.
-            
-            Args:
-                lactation_data (QuerySet): Lactation data for the first 60 DIM.
-                predicted_305_my (float): Predicted milk yield at day 305.
-                approx_persistency (float): The approximate persistency.
-                last_dim (int): The last DIM recorded for the lactation.
-                days_to_target (float): The DIM at which milk yield is expected to reach 25 kg/d.
-                cow_id (str): The cow ID.
-                parity (int): The lactation parity.
-            
-            Returns:
-                str: The path to the saved plot image.
-            """
-            dims = [entry.dim for entry in lactation_data]
-            milk_yields = [entry.milk_yield for entry in lactation_data]
-
-            # Create the plot
-            plt.figure(figsize=(10, 6))
-            plt.plot(dims, milk_yields, label="Milk Yield (first 60 DIM)", marker='o')
-
-            # Vertical lines at DIM 60 and 305
-            plt.axvline(x=60, color='blue', linestyle='--', label='DIM 60')
-            plt.axvline(x=305, color='orange', linestyle='--', label='DIM 305')
-
-            # Predicted day 305 MY
-            plt.scatter([305], [predicted_305_my], color='red', label=f"Predicted 305 MY: {predicted_305_my:.2f} kg", zorder=5)
-
-            # Dashed line for persistency
-            plt.plot([last_dim, 305], [milk_yields[-1], predicted_305_my], 'r--', label=f"Persistency (from DIM {last_dim})")
-
-            # Annotate the slope of the persistency line
-            slope = approx_persistency
-            mid_dim = (last_dim + 305) / 2
-            mid_milk_yield = (milk_yields[-1] + predicted_305_my) / 2
-            plt.text(mid_dim, mid_milk_yield, f"Slope: {slope:.2f}", color='red', fontsize=10)
-
-            # Plot days to 20kg/d target
-            plt.scatter([days_to_target], [25], color='green', label=f"Days to 25 kg/d: {days_to_target:.0f} DIM", zorder=5)
-
-            # Labels and legend
-            plt.xlabel("DIM (Days In Milk)")
-            plt.ylabel("Milk Yield (kg/d)")
-            plt.title(f"Milk Yield and Persistency Extrapolation for Cow {cow_id}, Parity {parity}")
-            plt.legend(loc="upper right")
-
-            # Save the plot to a file
-            plot_filename = f"lactation_plot_cow_{cow_id}_parity_{parity}.png"
-            plot_dir = os.path.join(settings.MEDIA_ROOT, f"extrapolation_plots/user_{request.user.id}")
-            os.makedirs(plot_dir, exist_ok=True)
-            plot_path = os.path.join(plot_dir, plot_filename)
-            plt.tight_layout()
-            plt.savefig(plot_path)
-            plt.close()
-
-            return os.path.join(f"extrapolation_plots/user_{request.user.id}", plot_filename)
-
-        lactation_data = LactationData.objects.filter(lactation=lactation, dim__lte=60).order_by("dim")
-        
-        if lactation_data.exists():
-            # Approximate persistency
-            dim_56_to_60 = lactation_data.filter(dim__gte=56, dim__lte=60)
-            last_milk_yield = dim_56_to_60.aggregate(avg_yield=Avg('milk_yield'))['avg_yield']
-            # last_milk_yield = lactation_data.last().milk_yield
-            # last_dim = lactation_data.last().dim
-            approx_persistency = (predicted_305_my - last_milk_yield) / (305 - 60)
-           
-            # Predict MY after extending by n cycles
-            extend_1_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 1
-                )
-            extend_2_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 2
-                )
-            extend_3_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 3
-                )
-            extend_4_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 4
-                )
-            extend_5_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 5
-                )
-            extend_6_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 6
-                )
-            extend_7_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 7
-                )
-            extend_8_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 8
-                )
-            extend_9_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 9
-                )
-            extend_10_cycle = predict_cycle_my(
-                predicted_305_my, approx_persistency, 10
-                )
-            
-            # Predict days to 20kg/d target
-            days_to_target = predict_days_to_target(
-                predicted_305_my, approx_persistency
-                )
-            
-            # plot_path = plot_days_to_target(
-            #     lactation_data=lactation_data,
-            #     predicted_305_my=predicted_305_my,
-            #     approx_persistency=approx_persistency,
-            #     last_dim=60,
-            #     days_to_target=days_to_target,
-            #     cow_id=lactation.cow.cow_id,
-            #     parity=lactation.parity,
-            #     request=request
-            # )
-
-            return {
-                "approx_persistency": approx_persistency,
-                "extend_1_cycle": extend_1_cycle,
-                "extend_2_cycle": extend_2_cycle,
-                "extend_3_cycle": extend_3_cycle,
-                "extend_4_cycle": extend_4_cycle,
-                "extend_5_cycle": extend_5_cycle,
-                "extend_6_cycle": extend_6_cycle,
-                "extend_7_cycle": extend_7_cycle,
-                "extend_8_cycle": extend_8_cycle,
-                "extend_9_cycle": extend_9_cycle,
-                "extend_10_cycle": extend_10_cycle,
-                "days_to_target": days_to_target,
-                "plot_path": "no/plot/path"
-            }
-        
-        else:
-            print(f"No lactation data found for Cow {lactation.cow.cow_id}, Parity {lactation.parity}.")
-            return None, None
+    def get_object(self):
+        # A job whose runner stopped would otherwise be reported running forever
+        fail_stale_jobs(UploadJob.objects.filter(user=self.request.user, id=self.kwargs["job_id"]))
+        return super().get_object()
         
 
 class ListUserFilesView(APIView):
@@ -712,49 +214,179 @@ class GetUserFileView(APIView):
             return Response({"message": "File not found"}, status=status.HTTP_404_NOT_FOUND)
         
 
+class ModelVersionsView(APIView):
+    """Lists the models and scalers used for predictions and the version of each that is loaded."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response({"artifacts": registry.versions()})
+
+
+class ResponseCacheStatsView(APIView):
+    """Hit and miss counts of the response cache, for staff."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(cache_stats())
+
+
+@method_decorator(conditional_on_data_version, name="get")
+@method_decorator(cached_response, name="get")
 class PredictionsListView(APIView):
+    """List the user's predictions a page at a time.
+
+    Pages follow a cursor on (ordering field, id). Query parameters filter by
+    cow_id (substring), parity, treatment_group and min/max_predicted_value,
+    order by any of PredictionListQuerySerializer.ORDERINGS, and select the
+    returned columns with a comma separated fields list.
+    """
+    permission_classes = [IsAuthenticated]
+
+    ORDERING_LOOKUPS = {
+        "created_at": ("created_at", Prediction),
+        "cow_id": ("lactation__cow__cow_id", Cow),
+        "parity": ("lactation__parity", Lactation),
+        "treatment_group": ("lactation__treatment_group", Lactation),
+        "predicted_value": ("prediction_value", Prediction),
+    }
+
     def get(self, request):
-        logging.info("Predictions API called")
-        predictions = Prediction.objects.filter(lactation__cow__owner=request.user).select_related("lactation__cow")
-        base_url = os.getenv('BACKEND_URL')
-        if not base_url.startswith(('http://', 'https://')):
-            base_url = f"https://{base_url}"
-        
-        if not predictions.exists():
-            logging.info("No predictions found")
+        serializer = PredictionListQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        query = serializer.validated_data
+
+        predictions = Prediction.objects.filter(lactation__cow__owner=request.user)
+        if "cow_id" in query:
+            predictions = predictions.filter(lactation__cow__cow_id__icontains=query["cow_id"])
+        if "parity" in query:
+            predictions = predictions.filter(lactation__parity=query["parity"])
+        if "treatment_group" in query:
+            predictions = predictions.filter(lactation__treatment_group=query["treatment_group"])
+        if "min_predicted_value" in query:
+            predictions = predictions.filter(prediction_value__gte=query["min_predicted_value"])
+        if "max_predicted_value" in query:
+            predictions = predictions.filter(prediction_value__lte=query["max_predicted_value"])
+
+        fields = query.get("fields") or list(PredictionListQuerySerializer.FIELDS)
+        descending = query["ordering"].startswith("-")
+        ordering_lookup, ordering_model = self.ORDERING_LOOKUPS[query["ordering"].lstrip("-")]
+        lookups = {PredictionListQuerySerializer.FIELDS[name] for name in fields}
+        predictions = predictions.values(*lookups | {ordering_lookup, "pk"})
+
+        rows, next_url = KeysetPagination(query["page_size"]).paginate(
+            predictions, request,
+            ordering=f"-{ordering_lookup}" if descending else ordering_lookup,
+            field=ordering_model._meta.get_field(ordering_lookup.split("__")[-1])
+        )
+
+        plot_url = None
+        if "plot_path" in fields:
+            base_url = os.getenv('BACKEND_URL')
+            if not base_url.startswith(('http://', 'https://')):
+                base_url = f"https://{base_url}"
+            plot_url = f"{base_url}/api/predictions/{{}}/plot/"
 
         data = []
-        for prediction in predictions:
-
-            plot_url = None
-            if prediction.plot_path:
-                clean_path = prediction.plot_path.lstrip('/')
-                plot_url = f"{base_url}/media/{clean_path}"
-                logging.info(f"Generated plot URL: {plot_url}")
-
-            data.append({
-                "cow_id": prediction.lactation.cow.cow_id,
-                "parity": prediction.lactation.parity,
-                "predicted_value": prediction.prediction_value,
-                "lactation_id": prediction.lactation.id,
-                "treatment_group": prediction.lactation.treatment_group,
-                "plot_path": plot_url,
-                "extend_1_cycle": prediction.extend_1_cycle,
-                "extend_2_cycle": prediction.extend_2_cycle,
-                "extend_3_cycle": prediction.extend_3_cycle,
-                "extend_4_cycle": prediction.extend_4_cycle,
-                "extend_5_cycle": prediction.extend_5_cycle,
-                "extend_6_cycle": prediction.extend_6_cycle,
-                "extend_7_cycle": prediction.extend_7_cycle,
-                "extend_8_cycle": prediction.extend_8_cycle,
-                "extend_9_cycle": prediction.extend_9_cycle,
-                "extend_10_cycle": prediction.extend_10_cycle,
-                "days_to_target": prediction.days_to_target,
-            })
-        logging.info(f"Returning {len(data)} predictions")
-        return Response(data, status=status.HTTP_200_OK)
+        for row in rows:
+            item = {}
+            for name in fields:
+                if name == "plot_path":
+                    item[name] = plot_url.format(row["lactation_id"])
+                else:
+                    item[name] = row[PredictionListQuerySerializer.FIELDS[name]]
+            data.append(item)
+        return Response({"next": next_url, "results": data}, status=status.HTTP_200_OK)
     
 
+class PredictionPlotView(APIView):
+    """Serve a lactation's extrapolation plot, drawing it on the first request."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, lactation_id):
+        prediction = get_object_or_404(
+            Prediction.objects.select_related("lactation__cow"),
+            lactation_id=lactation_id,
+            lactation__cow__owner=request.user,
+            prediction_type="regression"
+        )
+        etag = f'"{plot_version(prediction)}"'
+        if etag in request.headers.get("If-None-Match", ""):
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(open(get_plot(prediction, request.user.id), "rb"), content_type="image/png")
+        response["ETag"] = etag
+        # Plots change when a lactation is re-scored, so they are always revalidated
+        response["Cache-Control"] = "private, no-cache"
+        return response
+
+
+@method_decorator(conditional_on_data_version, name="get")
+@method_decorator(cached_response, name="get")
+class HerdSummaryView(APIView):
+    """Counts, means, percentiles and histograms of the user's predictions.
+
+    Computed in the database for the whole herd and per parity type and
+    treatment group. ?bins sets the number of histogram bins.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        serializer = HerdSummaryQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        predictions = Prediction.objects.filter(lactation__cow__owner=request.user)
+        return Response(herd_summary(predictions, serializer.validated_data["bins"]), status=status.HTTP_200_OK)
+
+
+@method_decorator(conditional_on_data_version, name="get")
+@method_decorator(cached_response, name="get")
+class ExtensionScenarioView(APIView):
+    """Extrapolate the user's stored predictions under another target yield and cycle length."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        serializer = ExtensionScenarioSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        scenario = serializer.validated_data
+
+        rows = list(
+            Prediction.objects
+            .filter(lactation__cow__owner=request.user)
+            .order_by("lactation_id")
+            .values_list(
+                "lactation_id", "lactation__cow__cow_id", "lactation__parity",
+                "lactation__treatment_group", "prediction_value", "approximate_persistency"
+            )
+        )
+        columns = list(zip(*rows)) or [()] * 6
+        predicted_305_my = np.array(columns[4], dtype=float)
+        persistency = np.array(columns[5], dtype=float)
+        extrapolations = extrapolate(predicted_305_my, persistency, **scenario)
+
+        data = [
+            {
+                "lactation_id": lactation_id,
+                "cow_id": cow_id,
+                "parity": parity,
+                "treatment_group": treatment_group,
+                "predicted_value": predicted_value,
+                "approximate_persistency": approximate_persistency,
+                "extend_cycles": extend_cycles,
+                "days_to_target": days_to_target,
+            }
+            for (
+                lactation_id, cow_id, parity, treatment_group, predicted_value, approximate_persistency
+            ), extend_cycles, days_to_target in zip(
+                rows,
+                extrapolations["extend_cycles"].tolist(),
+                extrapolations["days_to_target"].tolist()
+            )
+        ]
+        return Response({"scenario": scenario, "predictions": data}, status=status.HTTP_200_OK)
+
+
+@method_decorator(conditional_on_data_version, name="get")
+@method_decorator(cached_response, name="get")
 class TreatmentListView(APIView):
     def get(self, request):
         lactations = Lactation.objects.filter(cow__owner=request.user).select_related('cow')
@@ -778,6 +410,8 @@ class UpdateTreatmentGroupView(APIView):
             if new_treatment_group in dict(Lactation.TREATMENT_GROUP_CHOICES).keys():
                 lactation.treatment_group = new_treatment_group
                 lactation.save()
+                bump_data_version(lactation.cow.owner_id)
+                invalidate_user_cache(lactation.cow.owner_id)
                 return Response({
                     "status": "success",
                     "message": f"Treatment group updated to {new_treatment_group}"
@@ -795,9 +429,103 @@ class UpdateTreatmentGroupView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
 
-class LactationDataListView(generics.ListAPIView):
-    serializer_class = LactationDataSerializer
+class BulkUpdateTreatmentGroupView(APIView):
+    """Assign treatment groups to many of the user's lactations in one UPDATE.
+
+    The body holds either a list of assignments, each a lactation_id and a
+    treatment_group, or a filter (the filters of the predictions list, or
+    lactation_ids) and one treatment_group for every lactation it selects.
+    Lactations of other users are never selected. Assignments are applied
+    together or not at all, and any lactation that is not found is reported
+    with 404.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = BulkTreatmentGroupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        # Ownership is checked per row with EXISTS, as SQLite plans a join
+        # against a long id list as one index search per cow and id
+        lactations = Lactation.objects.filter(
+            Exists(Cow.objects.filter(id=OuterRef("cow_id"), owner=request.user))
+        )
+        if "assignments" in data:
+            with transaction.atomic():
+                updated, missing = self.assign(lactations, data["assignments"])
+                if missing:
+                    transaction.set_rollback(True)
+            if missing:
+                return Response({
+                    "status": "error",
+                    "message": "Lactations not found",
+                    "lactation_ids": missing
+                }, status=status.HTTP_404_NOT_FOUND)
+        else:
+            updated = self.filter_lactations(lactations, data["filter"]).update(
+                treatment_group=data["treatment_group"]
+            )
+
+        if updated:
+            bump_data_version(request.user.id)
+            invalidate_user_cache(request.user.id)
+        return Response({
+            "status": "success",
+            "updated": updated,
+            "message": f"Treatment group updated for {updated} lactations"
+        }, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def assign(lactations, assignments: list) -> tuple:
+        """Apply assignments with one UPDATE ... CASE, returning the rows updated and the ids not found."""
+        lactation_ids = {}
+        for assignment in assignments:
+            lactation_ids.setdefault(assignment["treatment_group"], []).append(assignment["lactation_id"])
+        selected = lactations.filter(id__in=[assignment["lactation_id"] for assignment in assignments])
+        updated = selected.update(treatment_group=Case(
+            *[When(id__in=ids, then=Value(group)) for group, ids in lactation_ids.items()],
+            output_field=CharField()
+        ))
+        missing = []
+        if updated != len(assignments):
+            found = set(selected.values_list("id", flat=True))
+            missing = [assignment["lactation_id"] for assignment in assignments if assignment["lactation_id"] not in found]
+        return updated, missing
+
+    @staticmethod
+    def filter_lactations(lactations, filters: dict):
+        if "lactation_ids" in filters:
+            lactations = lactations.filter(id__in=filters["lactation_ids"])
+        if "cow_id" in filters:
+            lactations = lactations.filter(cow__cow_id__icontains=filters["cow_id"])
+        if "parity" in filters:
+            lactations = lactations.filter(parity=filters["parity"])
+        if "parity_type" in filters:
+            lactations = lactations.filter(parity_type=filters["parity_type"])
+        if "treatment_group" in filters:
+            lactations = lactations.filter(treatment_group=filters["treatment_group"])
+        if "min_predicted_value" in filters:
+            lactations = lactations.filter(prediction__prediction_value__gte=filters["min_predicted_value"])
+        if "max_predicted_value" in filters:
+            lactations = lactations.filter(prediction__prediction_value__lte=filters["max_predicted_value"])
+        return lactations
+
+
+@method_decorator(conditional_on_data_version, name="get")
+class LactationDataListView(APIView):
+    """Stream the user's daily records as a JSON array, or as CSV with ?format=csv.
+
+    The records are read through a server-side cursor with the cow and parity
+    joined in SQL, and written to the response a chunk at a time. They are
+    not kept in the response cache, which would need the whole result in
+    memory. With max_points, each lactation is downsampled to that many
+    records with LTTB as it streams past.
+    """
     permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, CSVRenderer]
+
+    FIELDS = ['cow_id', 'parity', 'dim', 'date', 'milk_yield']
 
     def get_queryset(self):
         queryset = LactationData.objects.filter(
@@ -813,6 +541,61 @@ class LactationDataListView(generics.ListAPIView):
 
         return queryset
 
+    def get(self, request):
+        serializer = LactationDataQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        max_points = serializer.validated_data.get("max_points")
+
+        columns = ["lactation__cow__cow_id", "lactation__parity", "dim", "date", "milk_yield"]
+        if max_points:
+            # Rows carry their lactation until they are downsampled
+            columns.insert(0, "lactation_id")
+        rows = (self.get_queryset()
+                .order_by("lactation_id", "dim")
+                .values_list(*columns)
+                .iterator(chunk_size=ROWS_PER_CHUNK))
+        if max_points:
+            rows = downsample_rows(rows, max_points, x_index=3, y_index=5)
+
+        if request.accepted_renderer.format == "csv":
+            response = streaming_response(request, csv_chunks(rows, self.FIELDS), "text/csv")
+            response["Content-Disposition"] = 'attachment; filename="lactation_data.csv"'
+            return response
+        return streaming_response(request, json_array_chunks(rows, self.FIELDS), "application/json")
+
+
+@method_decorator(conditional_on_data_version, name="get")
+@method_decorator(cached_response, name="get")
+class LactationCurveListView(APIView):
+    """List the user's lactations with their records as dim and milk_yield arrays.
+
+    Curves are returned as JSON, as an Arrow IPC stream with ?format=arrow
+    when pyarrow is installed, or in the float32 layout of
+    encode_curves_binary with ?format=bin. Query parameters filter by cow_id,
+    parity and treatment_group, and max_points downsamples each curve with
+    LTTB.
+    """
+    permission_classes = [IsAuthenticated]
+    renderer_classes = curve_renderers()
+
+    def get(self, request):
+        serializer = LactationCurveQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        query = serializer.validated_data
+
+        lactations = Lactation.objects.filter(cow__owner=request.user)
+        if "cow_id" in query:
+            lactations = lactations.filter(cow__cow_id=query["cow_id"])
+        if "parity" in query:
+            lactations = lactations.filter(parity=query["parity"])
+        if "treatment_group" in query:
+            lactations = lactations.filter(treatment_group=query["treatment_group"])
+
+        return Response(get_curves(lactations, query.get("max_points")), status=status.HTTP_200_OK)
+
+
+@method_decorator(conditional_on_data_version, name="get")
+@method_decorator(cached_response, name="get")
 class MultiparousFeaturesListView(generics.ListAPIView):
     serializer_class = MultiparousFeaturesSerializer
     permission_classes = [IsAuthenticated]
@@ -831,6 +614,8 @@ class MultiparousFeaturesListView(generics.ListAPIView):
 
         return queryset
 
+@method_decorator(conditional_on_data_version, name="get")
+@method_decorator(cached_response, name="get")
 class PrimiparousFeaturesListView(generics.ListAPIView):
     serializer_class = PrimiparousFeaturesSerializer
     permission_classes = [IsAuthenticated]
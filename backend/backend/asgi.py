@@ -12,17 +12,30 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-from api.routing import websocket_urlpatterns
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-# application = get_asgi_application()
+# Set up Django before importing anything that uses models
+django_asgi_app = get_asgi_application()
+
+from django.conf import settings
+
+from api.jobs import start_in_process_runner
+from api.middleware import JWTAuthMiddleware
+from api.routing import websocket_urlpatterns
+
+if settings.UPLOAD_JOB_RUNNER == "thread":
+    # Run the uploads queued before the last restart, and fail those it interrupted
+    start_in_process_runner()
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
-        URLRouter(
-            websocket_urlpatterns
+        JWTAuthMiddleware(
+            URLRouter(
+                websocket_urlpatterns
+            )
         )
     ),
 })
\ No newline at end of file
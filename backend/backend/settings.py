@@ -194,6 +194,15 @@ CORS_ALLOW_HEADERS = [
 MEDIA_URL = "/media/"   # URL where media files can be accessed
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# Uploads are processed as background jobs. "worker" leaves them queued for
+# `python manage.py run_upload_worker`, "thread" runs them in the web process.
+UPLOAD_JOB_RUNNER = os.getenv('UPLOAD_JOB_RUNNER', 'worker')
+UPLOAD_WORKER_POLL_INTERVAL = float(os.getenv('UPLOAD_WORKER_POLL_INTERVAL', '2'))
+# A running job records a heartbeat every interval; one silent for longer than
+# UPLOAD_JOB_STALE_AFTER lost its runner, e.g. to a restart, and is failed
+UPLOAD_JOB_HEARTBEAT_INTERVAL = float(os.getenv('UPLOAD_JOB_HEARTBEAT_INTERVAL', '30'))
+UPLOAD_JOB_STALE_AFTER = float(os.getenv('UPLOAD_JOB_STALE_AFTER', '300'))
+
 ASGI_APPLICATION = "backend.asgi.application"
 
 # Get Redis URL from environment
@@ -202,11 +211,69 @@ REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
 # Parse the URL to get components
 redis_url = urlparse(REDIS_URL)
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": [(redis_url.hostname, redis_url.port)]
+CHANNEL_LAYERS_BACKEND = os.getenv('CHANNEL_LAYERS_BACKEND') or 'channels_redis.core.RedisChannelLayer'
+
+if CHANNEL_LAYERS_BACKEND == 'channels.layers.InMemoryChannelLayer':
+    # Only reaches websockets in the same process, so uploads must run with
+    # UPLOAD_JOB_RUNNER=thread under an ASGI server (daphne)
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": CHANNEL_LAYERS_BACKEND,
         },
-    },
-}
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": CHANNEL_LAYERS_BACKEND,
+            "CONFIG": {
+                "hosts": [(redis_url.hostname, redis_url.port)]
+            },
+        },
+    }
+
+# Minimum seconds between per-lactation progress messages for an upload
+PROGRESS_MIN_INTERVAL = float(os.getenv('PROGRESS_MIN_INTERVAL', '0.5'))
+
+# Processes used to smooth lactations while cleaning an upload (-1 uses every CPU)
+SMOOTHING_WORKERS = int(os.getenv('SMOOTHING_WORKERS', '1'))
+
+# Smoother used to find milk yield outliers, one of api.processing.clean.SMOOTHERS
+OUTLIER_SMOOTHER = os.getenv('OUTLIER_SMOOTHER', 'lowess')
+
+# How Dijkstra curves are fitted: "batch" (all lactations at once) or "lmfit" (one at a time)
+DIJKSTRA_FIT_METHOD = os.getenv('DIJKSTRA_FIT_METHOD', 'batch')
+
+# Draw every extrapolation plot when an upload finishes, instead of on its first request
+PRERENDER_PLOTS = os.getenv('PRERENDER_PLOTS', 'False') == 'True'
+
+# Cache of the read endpoints: "locmem", "file" or "redis". Uses Redis when
+# REDIS_URL is set in the environment and local memory otherwise
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE') or ('redis' if os.getenv('REDIS_URL') else 'locmem')
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', '300'))
+
+if RESPONSE_CACHE == 'redis':
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+            "TIMEOUT": RESPONSE_CACHE_TIMEOUT,
+        },
+    }
+elif RESPONSE_CACHE == 'file':
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.getenv('RESPONSE_CACHE_DIR', os.path.join(BASE_DIR, "cache")),
+            "TIMEOUT": RESPONSE_CACHE_TIMEOUT,
+        },
+    }
+else:
+    # Per process, so a worker cannot invalidate it; cached responses are
+    # still keyed by the user's data version
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "responses",
+            "TIMEOUT": RESPONSE_CACHE_TIMEOUT,
+        },
+    }
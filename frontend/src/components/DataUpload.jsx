@@ -2,9 +2,13 @@ import React, { useState, useEffect, useRef } from "react";
 import api from "../api";
 import "../styles/DataUpload.css"
 import { CSSTransition } from "react-transition-group";
-// import { createWebSocket } from '../utils/websocket';
+import { createWebSocket } from '../utils/websocket';
+import { ACCESS_TOKEN } from "../constants";
 
 const API_URL = import.meta.env.VITE_API_URL;
+// Milliseconds between checks of a queued or running upload job
+const JOB_POLL_INTERVAL = 1000;
+const FINISHED_JOB_STATUSES = ["succeeded", "failed"];
 
 function DataUpload({ fetchFiles, userId }) {
     const [selectedFile, setSelectedFile] = useState(null);
@@ -13,76 +17,68 @@ function DataUpload({ fetchFiles, userId }) {
     const [logs, setLogs] = useState([])
     const [isLogVisible, setIsLogVisible] = useState(false);
     const logTerminalRef = useRef(null);
+    const isMountedRef = useRef(true);
+    // Whether the websocket sent progress for the current upload
+    const progressReceivedRef = useRef(false);
+    // Stage of the lactation count shown on the last log line
+    const lactationLogStageRef = useRef(null);
+
+    useEffect(() => {
+        isMountedRef.current = true;
+        return () => {
+            isMountedRef.current = false;
+        };
+    }, []);
+
+    // Show the progress of uploads sent over the websocket
+    useEffect(() => {
+        const token = localStorage.getItem(ACCESS_TOKEN);
+        if (!userId || !token) {
+            return;
+        }
 
-    // useEffect(() => {
-    //     // Initial setup logging
-    //     console.log('=== DataUpload WebSocket Setup ===');
-    //     console.log('Environment:', {
-    //         VITE_API_URL: import.meta.env.VITE_API_URL,
-    //         userId: userId
-    //     });
-
-    //     let socket;
-    //     try {
-    //         const wsPath = `/ws/data-upload/${userId}/`;
-    //         console.log('Creating WebSocket with path:', wsPath);
-            
-    //         socket = createWebSocket(wsPath);
-            
-    //         socket.onopen = (event) => {
-    //             console.log('=== WebSocket Connected ===');
-    //             console.log('Connection URL:', socket.url);
-    //             console.log('ReadyState:', socket.readyState);
-    //         };
-            
-    //         socket.onmessage = (event) => {
-    //             console.log('=== WebSocket Message Received ===');
-    //             console.log('Raw data:', event.data);
-    //             try {
-    //                 const data = JSON.parse(event.data);
-    //                 console.log('Parsed data:', data);
-    //             } catch (error) {
-    //                 console.error('Failed to parse message:', error);
-    //             }
-    //         };
-            
-    //         socket.onerror = (error) => {
-    //             console.error('=== WebSocket Error ===');
-    //             console.error('Error details:', {
-    //                 error: error,
-    //                 url: socket.url,
-    //                 readyState: socket.readyState
-    //             });
-    //         };
-            
-    //         socket.onclose = (event) => {
-    //             console.log('=== WebSocket Closed ===');
-    //             console.log('Close details:', {
-    //                 code: event.code,
-    //                 reason: event.reason,
-    //                 wasClean: event.wasClean
-    //             });
-    //         };
-            
-    //     } catch (error) {
-    //         console.error('=== WebSocket Creation Failed ===');
-    //         console.error('Error:', error);
-    //         console.error('Environment state:', {
-    //             VITE_API_URL: import.meta.env.VITE_API_URL,
-    //             userId: userId,
-    //             protocol: window.location.protocol
-    //         });
-    //     }
-        
-    //     // Cleanup
-    //     return () => {
-    //         if (socket) {
-    //             console.log('=== Cleaning up WebSocket ===');
-    //             console.log('Closing connection to:', socket.url);
-    //             socket.close();
-    //         }
-    //     };
-    // }, [userId]);
+        let socket;
+        try {
+            socket = createWebSocket(`/ws/data-upload/${userId}/?token=${encodeURIComponent(token)}`);
+        } catch (error) {
+            console.error('Could not open the upload progress websocket:', error);
+            return;
+        }
+
+        socket.onmessage = (event) => {
+            let data;
+            try {
+                data = JSON.parse(event.data);
+            } catch (error) {
+                console.error('Failed to parse progress message:', error);
+                return;
+            }
+            progressReceivedRef.current = true;
+
+            if (data.messages) {
+                setLogs((prevLogs) => [...prevLogs, ...data.messages]);
+                lactationLogStageRef.current = null;
+            }
+            if (data.total !== undefined) {
+                // Lactation counts of a stage update one log line in place
+                const line = `${data.progress} (${data.processed}/${data.total})`;
+                const replaceLast = lactationLogStageRef.current === data.stage;
+                setLogs((prevLogs) => replaceLast ? [...prevLogs.slice(0, -1), line] : [...prevLogs, line]);
+                lactationLogStageRef.current = data.stage;
+            } else if (!data.messages) {
+                setLogs((prevLogs) => [...prevLogs, data.progress]);
+                lactationLogStageRef.current = null;
+            }
+        };
+
+        socket.onerror = (error) => {
+            console.error('Upload progress websocket error:', error);
+        };
+
+        return () => {
+            socket.close();
+        };
+    }, [userId]);
 
     // Handle file selection
     const handleFileChange = (e) => {
@@ -90,6 +86,18 @@ function DataUpload({ fetchFiles, userId }) {
         setMessage("") // Clear any messages
     };
 
+    // Poll the upload job until it has succeeded or failed
+    const waitForJob = async (jobId) => {
+        while (isMountedRef.current) {
+            const res = await api.get(`/api/jobs/${jobId}/`);
+            if (FINISHED_JOB_STATUSES.includes(res.data.status)) {
+                return res.data;
+            }
+            await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL));
+        }
+        return null;
+    };
+
     // Handle file upload
     const handleFileUpload = async () => {
         if (!selectedFile) {
@@ -102,6 +110,7 @@ function DataUpload({ fetchFiles, userId }) {
         formData.append("file", selectedFile);
 
         setIsProcessing(true);
+        progressReceivedRef.current = false;
         // setMessage("Processing file...");
         setIsLogVisible(true);
 
@@ -112,9 +121,25 @@ function DataUpload({ fetchFiles, userId }) {
                 }
             });
 
-            // Assuming backend sends a success message
-            setLogs((prevLogs) => [...prevLogs, "File processed successfully!"]);
-            console.log("Processed file path:", res.data.processed_file); 
+            // The upload is processed in the background, so wait for its job
+            setLogs((prevLogs) => [...prevLogs, res.data.message]);
+            const job = await waitForJob(res.data.job_id);
+            if (!job) {
+                return;
+            }
+
+            // Messages already streamed over the websocket are not repeated
+            if (!progressReceivedRef.current) {
+                setLogs((prevLogs) => [...prevLogs, ...job.messages]);
+            }
+            if (job.status === "succeeded") {
+                setLogs((prevLogs) => [...prevLogs, "File processed successfully!"]);
+            } else {
+                if (!progressReceivedRef.current) {
+                    setLogs((prevLogs) => [...prevLogs, ...job.errors]);
+                }
+                setMessage(`Error: ${job.errors.join(" ")}`);
+            }
             fetchFiles();
 
         } catch (error) {
@@ -124,7 +149,9 @@ function DataUpload({ fetchFiles, userId }) {
                 setMessage("Error processing the file. Please try again.");
             }
         } finally {
-            setIsProcessing(false);
+            if (isMountedRef.current) {
+                setIsProcessing(false);
+            }
         }
     };
 
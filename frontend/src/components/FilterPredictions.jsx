@@ -3,7 +3,18 @@ import "../styles/FilterPredictions.css"
 import { FontAwesomeIcon } from '@fortawesome/react-fontawesome';
 import { faFilter } from '@fortawesome/free-solid-svg-icons';
 
-function FilterPredictions({ cowIdFilter, setCowIdFilter, parityFilter, setParityFilter, isHidden, onToggleFilter, toggleExpandAllCards }) {
+// Sort orders of the predictions list, applied by the server
+const ORDERINGS = [
+    { value: 'created_at', label: 'Oldest first' },
+    { value: '-created_at', label: 'Newest first' },
+    { value: 'cow_id', label: 'Cow ID' },
+    { value: 'parity', label: 'Parity' },
+    { value: '-predicted_value', label: 'Predicted value (high to low)' },
+    { value: 'predicted_value', label: 'Predicted value (low to high)' },
+    { value: 'treatment_group', label: 'Treatment group' },
+];
+
+function FilterPredictions({ cowIdFilter, setCowIdFilter, parityFilter, setParityFilter, ordering, setOrdering, isHidden, onToggleFilter, toggleExpandAllCards }) {
     const [expandAll, setExpandAll] = useState(false);
 
     const handleExpandAll = () => {
@@ -41,6 +52,17 @@ function FilterPredictions({ cowIdFilter, setCowIdFilter, parityFilter, setParit
                             onChange={(e) => setParityFilter(e.target.value)}
                             placeholder="Enter Parity"
                         />
+
+                        <label htmlFor="ordering">Sort by:</label>
+                        <select
+                            id="ordering"
+                            value={ordering}
+                            onChange={(e) => setOrdering(e.target.value)}
+                        >
+                            {ORDERINGS.map(({ value, label }) => (
+                                <option key={value} value={value}>{label}</option>
+                            ))}
+                        </select>
                     </>
                 )}
             </div>
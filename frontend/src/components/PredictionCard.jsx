@@ -34,6 +34,27 @@ function PredictionCard({
         setIsExpanded(isExpandedAll);
     }, [isExpandedAll]);
 
+    // Plots are served behind authentication, so they are fetched with the
+    // access token when the card is first expanded
+    const [plotUrl, setPlotUrl] = useState(null);
+
+    useEffect(() => {
+        if (!isExpanded || !plotPath || plotUrl) {
+            return;
+        }
+        api.get(plotPath, { responseType: 'blob' })
+            .then((response) => setPlotUrl(URL.createObjectURL(response.data)))
+            .catch((error) => console.error('Error loading plot:', error));
+    }, [isExpanded, plotPath, plotUrl]);
+
+    useEffect(() => {
+        return () => {
+            if (plotUrl) {
+                URL.revokeObjectURL(plotUrl);
+            }
+        };
+    }, [plotUrl]);
+
     const toggleExpand = () => {
         setIsExpanded(!isExpanded);
     };
@@ -122,7 +143,7 @@ function PredictionCard({
           {/* Expanded content */}
           <div className={`expanded-content ${isExpanded ? 'expanded' : ''}`}>
             <div className="plot-container">
-              <img src={plotPath} alt="Prediction Plot" className="prediction-plot" />
+              {plotUrl && <img src={plotUrl} alt="Prediction Plot" className="prediction-plot" />}
             </div>
             <div className="table-container">
               <table>
@@ -1,16 +1,52 @@
-import React, { useEffect, useState } from "react";
+import React, { useCallback, useEffect, useRef, useState } from "react";
 import Navbar from "../components/Navbar";
 import PredictionCard from "../components/PredictionCard";
 import FilterPredictions from '../components/FilterPredictions';
 import TreatmentSidebar from "../components/TreatmentSidebar";
+import LoadingIndicator from "../components/LoadingIndicator";
 import api from '../api';
 import '../styles/Predictions.css';
 
+// Predictions fetched per request, the next page is fetched on scrolling to the end
+const PAGE_SIZE = 100;
+// Columns shown by the prediction cards
+const PREDICTION_FIELDS = [
+    'cow_id', 'parity', 'predicted_value', 'lactation_id', 'treatment_group', 'plot_path',
+    ...Array.from({ length: 10 }, (_, i) => `extend_${i + 1}_cycle`),
+    'days_to_target',
+];
+// Delay after the last keystroke before a filter is sent to the server
+const FILTER_DELAY = 300;
+
+// Query parameters of the first page for the current filters and sort order
+const buildQuery = (cowIdFilter, parityFilter, ordering) => {
+    const params = new URLSearchParams({
+        page_size: PAGE_SIZE,
+        fields: PREDICTION_FIELDS.join(','),
+        ordering,
+    });
+    if (cowIdFilter.trim() !== '') {
+        params.set('cow_id', cowIdFilter.trim());
+    }
+    const parity = parseInt(parityFilter);
+    if (parity >= 1) {
+        params.set('parity', parity);
+    }
+    return params.toString();
+};
+
 function Predictions() {
     const [predictions, setPredictions] = useState([]);
-    const [filteredPredictions, setFilteredPredictions] = useState([]);
+    const [nextUrl, setNextUrl] = useState(null);
+    const [isLoading, setIsLoading] = useState(false);
     const [cowIdFilter, setCowIdFilter] = useState('');
     const [parityFilter, setParityFilter] = useState('');
+    const [ordering, setOrdering] = useState('created_at');
+    const [query, setQuery] = useState(() => buildQuery('', '', 'created_at'));
+
+    // Responses to requests made before the query last changed are dropped
+    const requestRef = useRef(0);
+    const loadMoreRef = useRef(null);
 
     const [isFilterHidden, setIsFilterHidden] = useState(false); 
     const [isTreatmentHidden, setIsTreatmentHidden] = useState(true);  
@@ -34,28 +70,53 @@ function Predictions() {
         setIsExpandedAll(expandAll);
     };
 
-    // Fetch all predictions from backend
+    // Send filter changes to the server once the user stops typing
     useEffect(() => {
-        api.get('api/predictions/')
-            .then(response => {
-                console.log('Fetched predictions:', response.data);
-                setPredictions(response.data);
-                setFilteredPredictions(response.data);
-            })
-            .catch(error => {
-                console.error('Error fetching predictions:', error);
-            });
+        const timeout = setTimeout(() => {
+            setQuery(buildQuery(cowIdFilter, parityFilter, ordering));
+        }, FILTER_DELAY);
+        return () => clearTimeout(timeout);
+    }, [cowIdFilter, parityFilter, ordering]);
+
+    const fetchPage = useCallback(async (url, reset) => {
+        const request = reset ? ++requestRef.current : requestRef.current;
+        setIsLoading(true);
+        try {
+            const response = await api.get(url);
+            if (request !== requestRef.current) {
+                return;
+            }
+            setPredictions(prev => reset ? response.data.results : prev.concat(response.data.results));
+            setNextUrl(response.data.next);
+        } catch (error) {
+            console.error('Error fetching predictions:', error);
+        } finally {
+            if (request === requestRef.current) {
+                setIsLoading(false);
+            }
+        }
     }, []);
 
-    // Filtering logic
+    // Fetch the first page whenever the filters or the sort order change
+    useEffect(() => {
+        fetchPage(`api/predictions/?${query}`, true);
+    }, [query, fetchPage]);
+
+    // Fetch the next page when the end of the list scrolls into view
     useEffect(() => {
-        const filtered = predictions.filter(prediction => {
-            const matchesCowId = cowIdFilter === '' || prediction.cow_id.includes(cowIdFilter);
-            const matchesParity = parityFilter === '' || prediction.parity === parseInt(parityFilter);
-            return matchesCowId && matchesParity;
+        const sentinel = loadMoreRef.current;
+        if (!sentinel || !nextUrl || isLoading) {
+            return;
+        }
+        const observer = new IntersectionObserver((entries) => {
+            if (entries[0].isIntersecting) {
+                observer.disconnect();
+                fetchPage(nextUrl, false);
+            }
         });
-        setFilteredPredictions(filtered);
-    }, [cowIdFilter, parityFilter, predictions]);
+        observer.observe(sentinel);
+        return () => observer.disconnect();
+    }, [nextUrl, isLoading, fetchPage]);
 
     const refreshTreatmentSidebar = () => {
         setRefreshSidebar(prev => !prev);
@@ -78,6 +139,8 @@ function Predictions() {
                 setCowIdFilter={setCowIdFilter}
                 parityFilter={parityFilter}
                 setParityFilter={setParityFilter}
+                ordering={ordering}
+                setOrdering={setOrdering}
                 isHidden={isFilterHidden}
                 onToggleFilter={handleToggleFilter}
                 toggleExpandAllCards={toggleExpandAllCards}
@@ -86,8 +149,8 @@ function Predictions() {
             <div className={`cards-container 
                 ${isFilterHidden ? 'expand-filter' : ''} 
                 ${isTreatmentHidden ? 'expand-treatment' : ''}`}>
-                {filteredPredictions.length > 0 ? (
-                    filteredPredictions.map(prediction => (
+                {predictions.length > 0 ? (
+                    predictions.map(prediction => (
                         <PredictionCard
                             key={`${prediction.cow_id}-${prediction.parity}`}
                             cowId={prediction.cow_id}
@@ -112,8 +175,10 @@ function Predictions() {
                         />
                     ))
                 ) : (
-                    <p>No predictions available at the moment.</p>
+                    !isLoading && <p>No predictions available at the moment.</p>
                 )}
+                <div ref={loadMoreRef} />
+                {isLoading && <LoadingIndicator />}
             </div>
         </div>
     );